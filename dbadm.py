@@ -24,9 +24,10 @@ import logging
 import getpass
 from passlib.context import CryptContext
 from libs.user_db import *
-from libs         import auth
+from libs         import auth, llm_cache
 import sys
 import os
+from datetime import date, timedelta
 
 parser = argparse.ArgumentParser(description="Inspect Docs DB")
 parser.add_argument("--db", help="sqllite DB File Path (default: taken from appcode)")
@@ -54,6 +55,7 @@ if args.db:
 
 users_db = UserDatabase(db_file)
 params_db = ParamsDatabase(db_file)
+usage_db = UsageDatabase(db_file)
 #pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 def command(args=None):
@@ -212,6 +214,45 @@ def create_login():
   user = users_db.get_user_by_email(email)
   users_db.add_user_credentials(UserCredentials(user.id, username, secret))
 
+def usage_report(args=None):
+  # Tokens used per user and model over the last N days (default 30)
+  days = int(args[0]) if args else int(input("Days [30]: ") or "30")
+  since = (date.today() - timedelta(days=max(days, 1) - 1)).isoformat()
+  report = usage_db.get_usage_report(since)
+  if not report:
+    print(f"No usage since {since}")
+    return
+  print(f"{'Username':<20}{'Model':<30}{'Calls':>8}{'Cached':>8}{'Prompt':>12}{'Completion':>12}")
+  for row in report:
+    print(f"{str(row['username']):<20}{row['llmID']:<30}{row['calls']:>8}{row['cached']:>8}{row['prompt_tokens']:>12}{row['completion_tokens']:>12}")
+  print(f"{'Total':<50}{sum(row['calls'] for row in report):>8}{sum(row['cached'] for row in report):>8}"
+        f"{sum(row['prompt_tokens'] for row in report):>12}{sum(row['completion_tokens'] for row in report):>12}")
+
+def set_quota(args=None):
+  # Daily & monthly token quotas of a user, blank for no limit. "-" as the daily quota removes the user's
+  #   own quotas, the server defaults apply again
+  username = args[0] if args else input("Username: ")
+  user_id = users_db.get_user_id_by_username(username)
+  if user_id is None:
+    print("No user found")
+    return
+  print(f"Current quota: {usage_db.get_quota(user_id)}")
+  daily = args[1] if args and len(args) > 1 else input("Daily token quota: ")
+  if daily == "-":
+    usage_db.delete_quota(user_id)
+    return
+  monthly = args[2] if args and len(args) > 2 else input("Monthly token quota: ")
+  usage_db.set_quota(user_id, int(daily) if daily else None, int(monthly) if monthly else None)
+  print(f"New quota: {usage_db.get_quota(user_id)}")
+
+def clear_cache(args=None):
+  # Empties the LLM response cache shared by all users & workers, the DB of the server's --cacheDB
+  db_name = args[0] if args else (input("Cache DB [./llm_cache.db]: ") or "./llm_cache.db")
+  if not os.path.exists(db_name):
+    print(f"No cache DB at {db_name}")
+    return
+  print(f"Deleted [{llm_cache.ResponseCache(db_name).clear()}] cached responses")
+
 
 func_list = {
     "cmd"        : command,       # Execute a System Command
@@ -222,6 +263,9 @@ func_list = {
     "prfdel"     : delete_profile,# Delete a profile by ID, email or Username
     "all"        : all_users,     # Print all Users and Usernames    
     "params"     : show_params,
+    "usage"      : usage_report,  # Tokens used per User and Model in the last N days
+    "quota"      : set_quota,     # Set a User's daily & monthly token quotas
+    "cachclr"    : clear_cache,   # Clear the LLM response cache
     "help"       : help,
     "quit"       : quit
   }
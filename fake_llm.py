@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+# Stand-in for an Azure OpenAI deployment to exercise failover, hedging, rate limiting and load
+#   without spending quota. Point the 'endpoint' of a MODELS entry (or one of its 'backends')
+#   at http://127.0.0.1:<port>/ and give it any api-key.
+
+import json
+import random
+import asyncio
+import argparse
+import uvicorn
+
+from fastapi             import FastAPI, Request
+from fastapi.responses   import JSONResponse, StreamingResponse
+
+parser = argparse.ArgumentParser(description="Fake Azure OpenAI endpoint for local testing")
+parser.add_argument("--port", type=int, default="9100", help="Port to listen on")
+parser.add_argument("--latency", type=float, default="0.5", help="Seconds before a response starts")
+parser.add_argument("--jitter", type=float, default="0.2", help="Random extra seconds added to the latency")
+parser.add_argument("--slowRate", type=float, default="0", help="Fraction of calls that take 10 times longer")
+parser.add_argument("--failRate", type=float, default="0", help="Fraction of calls answered with a 500")
+parser.add_argument("--throttleRate", type=float, default="0", help="Fraction of calls answered with a 429")
+parser.add_argument("--retryAfter", type=int, default="1", help="Retry-After seconds sent with a 429")
+parser.add_argument("--chunks", type=int, default="8", help="Chunks a streamed response is split into")
+parser.add_argument("--completionTokens", type=int, default="100", help="Tokens in a response, capped by the request's max_tokens")
+parser.add_argument("--tokenRate", type=float, default="0", help="Tokens generated per second after the latency, 0 is instant")
+args, _ = parser.parse_known_args()
+
+app = FastAPI(title="Fake Azure OpenAI")
+stats = {'calls': 0, 'failed': 0, 'throttled': 0}
+
+def completion_tokens(body: dict) -> int:
+    return min(args.completionTokens, body.get('max_tokens') or args.completionTokens)
+
+def answer_text(body: dict) -> str:
+    if 'messages' in body:
+        prompt = str(body['messages'][-1]['content'])
+    else:
+        prompt = str(body.get('prompt'))
+    # About a token per word, padded to the configured response length
+    words = f"Fake answer for: {prompt[-60:]}".split()
+    words += ["lorem"] * (completion_tokens(body) - len(words))
+    return " ".join(words[:max(1, completion_tokens(body))])
+
+def generation_time(body: dict) -> float:
+    return completion_tokens(body) / args.tokenRate if args.tokenRate > 0 else 0.0
+
+def failure() -> JSONResponse | None:
+    draw = random.random()
+    if draw < args.throttleRate:
+        stats['throttled'] += 1
+        return JSONResponse({'error': {'code': '429', 'message': 'Rate limit is exceeded'}}, status_code=429,
+                            headers={'retry-after': str(args.retryAfter)})
+    if draw < args.throttleRate + args.failRate:
+        stats['failed'] += 1
+        return JSONResponse({'error': {'code': '500', 'message': 'Internal server error'}}, status_code=500)
+    return None
+
+async def wait(body: dict):
+    latency = args.latency + random.uniform(0, args.jitter) + generation_time(body)
+    if random.random() < args.slowRate:
+        latency *= 10
+    await asyncio.sleep(latency)
+
+def usage(body: dict, text: str) -> dict:
+    prompt = len(json.dumps(body.get('messages', body.get('prompt')))) // 4
+    return {'prompt_tokens': prompt, 'completion_tokens': len(text) // 4, 'total_tokens': prompt + len(text) // 4}
+
+async def stream(deployment: str, body: dict, chat: bool):
+    text = answer_text(body)
+    size = max(1, len(text) // args.chunks + 1)
+    await asyncio.sleep(args.latency + random.uniform(0, args.jitter))
+    for start in range(0, len(text), size):
+        await asyncio.sleep(generation_time(body) / args.chunks)
+        piece = text[start:start+size]
+        if chat:
+            choice = {'index': 0, 'delta': {'content': piece}, 'finish_reason': None}
+            kind = 'chat.completion.chunk'
+        else:
+            choice = {'index': 0, 'text': piece, 'finish_reason': None, 'logprobs': None}
+            kind = 'text_completion'
+        yield "data: " + json.dumps({'id': 'fake', 'object': kind, 'created': 0, 'model': deployment, 'choices': [choice]}) + "\n\n"
+    yield "data: [DONE]\n\n"
+
+@app.post("/openai/deployments/{deployment}/chat/completions")
+async def chat_completions(deployment: str, request: Request):
+    body = await request.json()
+    stats['calls'] += 1
+    error = failure()
+    if error is not None:
+        return error
+
+    text = answer_text(body)
+    if body.get('stream'):
+        return StreamingResponse(stream(deployment, body, True), media_type="text/event-stream")
+
+    await wait(body)
+    return {'id': 'fake', 'object': 'chat.completion', 'created': 0, 'model': deployment,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+            'usage': usage(body, text)}
+
+@app.post("/openai/deployments/{deployment}/completions")
+async def completions(deployment: str, request: Request):
+    body = await request.json()
+    stats['calls'] += 1
+    error = failure()
+    if error is not None:
+        return error
+
+    text = answer_text(body)
+    if body.get('stream'):
+        return StreamingResponse(stream(deployment, body, False), media_type="text/event-stream")
+
+    await wait(body)
+    return {'id': 'fake', 'object': 'text_completion', 'created': 0, 'model': deployment,
+            'choices': [{'index': 0, 'text': text, 'finish_reason': 'stop', 'logprobs': None}],
+            'usage': usage(body, text)}
+
+@app.get("/stats")
+def get_stats() -> dict:
+    return stats
+
+@app.post("/settings")
+async def update_settings(request: Request) -> dict:
+    # Tests turn failures and latency on and off while the server runs, e.g. {"failRate": 0}
+    for name, value in (await request.json()).items():
+        if name in ('latency', 'jitter', 'slowRate', 'failRate', 'throttleRate'):
+            setattr(args, name, float(value))
+    return {name: getattr(args, name) for name in ('latency', 'jitter', 'slowRate', 'failRate', 'throttleRate')}
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
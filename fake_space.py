@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+# Stand-in for a HuggingFace Space running a Gradio text generation app, to exercise the
+#   HuggingFaceSpaces provider without the Hub. It speaks the part of the Gradio queue protocol
+#   (sse_v1) that gradio_client uses and has two generator endpoints with the inputs of the Spaces
+#   in libs.params: '/chat' like llama-2-7b-chat and fn_index 1 like codellama-playground.
+#   Set CODEDOC_FAKE_SPACE=http://127.0.0.1:<port>/ to get the 'fake-space' model.
+
+import json
+import uuid
+import random
+import asyncio
+import argparse
+import uvicorn
+
+from fastapi             import FastAPI, Request
+from fastapi.responses   import JSONResponse, StreamingResponse
+
+parser = argparse.ArgumentParser(description="Fake Gradio Space for local testing")
+parser.add_argument("--port", type=int, default="9400", help="Port to listen on")
+parser.add_argument("--latency", type=float, default="0.3", help="Seconds before the first output")
+parser.add_argument("--jitter", type=float, default="0.1", help="Random extra seconds added to the latency")
+parser.add_argument("--concurrency", type=int, default="4", help="Predictions the Space runs at the same time, the others queue")
+parser.add_argument("--completionTokens", type=int, default="40", help="Words in a response, capped by the request's max_new_tokens")
+parser.add_argument("--tokenRate", type=float, default="50", help="Words generated per second, 0 is instant")
+parser.add_argument("--failRate", type=float, default="0", help="Fraction of predictions that end in an error")
+args, _ = parser.parse_known_args()
+
+app = FastAPI(title="Fake Gradio Space")
+stats = {'calls': 0, 'failed': 0, 'cancelled': 0, 'running': 0, 'max_running': 0}
+slots = None
+sessions = {}       # Session hash -> queue of the messages of its events
+tasks = {}          # Event ID -> task of the prediction
+
+def textbox(id: int, label: str) -> dict:
+    return {'id': id, 'type': 'textbox', 'props': {'label': label}}
+
+def slider(id: int, label: str) -> dict:
+    return {'id': id, 'type': 'slider', 'props': {'label': label}}
+
+# Component IDs of the inputs of each endpoint, the output is the last component
+ENDPOINTS = [
+    ('chat', [textbox(1, 'Message'), textbox(2, 'System prompt'), slider(3, 'Max new tokens'), slider(4, 'Temperature'),
+              slider(5, 'Top-p'), slider(6, 'Top-k'), slider(7, 'Repetition penalty')], textbox(8, 'Response')),
+    ('predict', [textbox(11, 'Prompt'), slider(12, 'Temperature'), slider(13, 'Max new tokens'), slider(14, 'Top-p'),
+                 slider(15, 'Repetition penalty')], textbox(16, 'Output'))
+]
+MAX_TOKENS_INPUT = {'chat': 2, 'predict': 2}     # Position of the max new tokens input
+
+def parameter(component: dict) -> dict:
+    kind = 'str' if component['type'] == 'textbox' else 'float'
+    return {'label': component['props']['label'], 'parameter_name': component['props']['label'].lower().replace(' ', '_').replace('-', '_'),
+            'parameter_has_default': False, 'parameter_default': None, 'type': {'type': 'string' if kind == 'str' else 'number'},
+            'python_type': {'type': kind, 'description': ''}, 'component': component['type'].capitalize()}
+
+@app.get("/config")
+def get_config() -> dict:
+    components = [component for _, inputs, output in ENDPOINTS for component in inputs + [output]]
+    dependencies = [{'api_name': name, 'inputs': [component['id'] for component in inputs], 'outputs': [output['id']],
+                     'backend_fn': True, 'show_api': True, 'types': {'continuous': False, 'generator': True}, 'queue': True}
+                    for name, inputs, output in ENDPOINTS]
+    return {'version': '4.26.0', 'protocol': 'sse_v1', 'mode': 'blocks', 'components': components, 'dependencies': dependencies}
+
+@app.get("/info")
+def get_info() -> dict:
+    return {'named_endpoints': {f"/{name}": {'parameters': [parameter(component) for component in inputs], 'returns': [parameter(output)]}
+                                for name, inputs, output in ENDPOINTS},
+            'unnamed_endpoints': {}}
+
+def answer_words(fn_index: int, data: list) -> list:
+    name = ENDPOINTS[fn_index][0]
+    prompt = str(data[0])
+    try:
+        max_words = int(data[MAX_TOKENS_INPUT[name]])
+    except (TypeError, ValueError):
+        max_words = args.completionTokens
+    count = max(1, min(args.completionTokens, max_words))
+    words = f"Fake answer for: {prompt[-60:]}".split()
+    words += ["lorem"] * (count - len(words))
+    return words[:count]
+
+def message(event_id: str, msg: str, **fields) -> dict:
+    return {'msg': msg, 'event_id': event_id, **fields}
+
+async def predict(session: asyncio.Queue, event_id: str, fn_index: int, data: list):
+    session.put_nowait(message(event_id, 'estimation', rank=max(0, stats['running'] - args.concurrency), queue_size=stats['running'], rank_eta=None))
+    text = ""
+    try:
+        async with slots:
+            stats['running'] += 1
+            stats['max_running'] = max(stats['max_running'], stats['running'])
+            try:
+                session.put_nowait(message(event_id, 'process_starts'))
+                await asyncio.sleep(args.latency + random.uniform(0, args.jitter))
+                if random.random() < args.failRate:
+                    stats['failed'] += 1
+                    session.put_nowait(message(event_id, 'process_completed', output={'error': 'Fake Space failure'}, success=False))
+                    return
+                for word in answer_words(fn_index, data):
+                    text = f"{text} {word}" if text else word
+                    session.put_nowait(message(event_id, 'process_generating', output={'data': [text], 'is_generating': True}, success=True))
+                    if args.tokenRate > 0:
+                        await asyncio.sleep(1 / args.tokenRate)
+            finally:
+                stats['running'] -= 1
+        session.put_nowait(message(event_id, 'process_completed', output={'data': [text], 'is_generating': False}, success=True))
+    except asyncio.CancelledError:
+        stats['cancelled'] += 1
+        session.put_nowait(message(event_id, 'process_completed', output={'error': 'Cancelled'}, success=False))
+    finally:
+        tasks.pop(event_id, None)
+
+@app.post("/queue/join")
+async def queue_join(request: Request):
+    body = await request.json()
+    fn_index = body.get('fn_index', 0)
+    if fn_index >= len(ENDPOINTS):
+        return JSONResponse({'detail': f"Invalid function index {fn_index}"}, status_code=422)
+    stats['calls'] += 1
+    event_id = uuid.uuid4().hex
+    session = sessions.setdefault(body['session_hash'], asyncio.Queue())
+    tasks[event_id] = asyncio.create_task(predict(session, event_id, fn_index, body.get('data', [])))
+    return {'event_id': event_id}
+
+@app.get("/queue/data")
+async def queue_data(session_hash: str):
+    # The messages of all the events of the session, gradio_client closes the stream when it has what it waited for
+    session = sessions.setdefault(session_hash, asyncio.Queue())
+
+    async def events():
+        while True:
+            try:
+                msg = await asyncio.wait_for(session.get(), 15)
+            except asyncio.TimeoutError:
+                msg = {'msg': 'heartbeat'}
+            yield f"data: {json.dumps(msg)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.post("/reset")
+async def reset(request: Request):
+    body = await request.json()
+    task = tasks.get(body.get('event_id'))
+    if task is not None:
+        task.cancel()
+    return {'success': task is not None}
+
+@app.get("/heartbeat/{session_hash}")
+async def heartbeat(session_hash: str):
+    async def beats():
+        while True:
+            yield f"data: {json.dumps({'msg': 'heartbeat'})}\n\n"
+            await asyncio.sleep(15)
+
+    return StreamingResponse(beats(), media_type="text/event-stream")
+
+@app.get("/stats")
+def get_stats() -> dict:
+    return stats
+
+@app.on_event("startup")
+async def create_slots():
+    global slots
+
+    slots = asyncio.Semaphore(args.concurrency)
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
@@ -95,6 +95,46 @@ class FetchAPI {
     return await response.json();
   }
 
+  async postStream(url, data, onEvent) {
+    // POST a JSON body and read back Server-Sent Events, EventSource can only do GET
+    const response = await fetch(url, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        'Accept': 'text/event-stream'
+      },
+      body: JSON.stringify(data)
+    });
+    await this.handleResponse(response);
+
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = "";
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += value.replace(/\r\n/g, "\n");
+
+      let boundary;
+      while ((boundary = buffer.indexOf("\n\n")) != -1) {
+        const block = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+
+        let event = "message";
+        let lines = [];
+        block.split("\n").forEach(line => {
+          if (line.startsWith("event:")) {
+            event = line.slice(6).trim();
+          } else if (line.startsWith("data:")) {
+            lines.push(line.slice(5).trimStart());
+          }
+        });
+        if (lines.length > 0) {
+          onEvent(event, JSON.parse(lines.join("\n")));
+        }
+      }
+    }
+  }
+
   async handleResponse(response) {
     if (!response.ok) {
       const code = response.status;
@@ -358,6 +398,25 @@ class LLMContextService {
 }
 
 
+async function streamEvents(url, data, onToken) {
+  let usage = null;
+  let error = null;
+  await new FetchAPI().postStream(url, data, (event, data) => {
+    if (event == "token") {
+      onToken(data.text);
+    } else if (event == "usage") {
+      usage = data;
+    } else if (event == "error") {
+      error = data.msg;
+    }
+  });
+
+  if (error) {
+    throw new Error(error);
+  }
+  return usage;
+}
+
 class LLMService {
   constructor() {
   }
@@ -370,6 +429,11 @@ class LLMService {
     // Gets a model_resp JSON attribute
     return response.model_resp;
   }
+
+  async streamLLM(params, onToken) {
+    // Calls onToken(text) as the model generates, returns the usage stats of the stream
+    return await streamEvents('/llm/stream', params.toJSON(), onToken);
+  }
 }
 
 class ChatService {
@@ -384,6 +448,11 @@ class ChatService {
     // Gets a model_resp JSON attribute
     return response.model_resp;
   }
+
+  async streamLLM(message, onToken) {
+    // Calls onToken(text) as the model generates, returns the usage stats of the stream
+    return await streamEvents('/chat/stream', message.toJSON(), onToken);
+  }
 }
 
 class LoginService {
@@ -49,7 +49,13 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 120
 
 sqlite_dbname = 'codegen_user.db'
-users_db = UserDatabase(sqlite_dbname)
+users_db = None     # Opened by the first request, a connection must not be shared by forked workers
+
+def get_users_db() -> UserDatabase:
+    global users_db
+    if users_db is None:
+        users_db = UserDatabase(sqlite_dbname)
+    return users_db
 
 fake_users_db = {
     "shalin": {
@@ -195,7 +201,7 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)],
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = get_user(users_db, username=token_data.username)
+    user = get_user(get_users_db(), username=token_data.username)
     if user is None:
         raise credentials_exception
     return user
@@ -213,7 +219,7 @@ async def get_current_active_user(
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestFormStrict, Depends()],
     response: Response):
-    user = authenticate_user(users_db, form_data.username, form_data.password)
+    user = authenticate_user(get_users_db(), form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+import os
+import re
+import gzip
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None        # No file locks (Windows), only a single worker should record then
+
+from langchain.callbacks.manager import CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun
+from langchain.llms.base import LLM
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult, GenerationChunk
+
+__all__ = ["Cassette", "CassetteMiss", "CassetteLLM", "CassetteChat", "get_cassette", "normalize_prompt", "MODES"]
+
+MODES = ('record', 'replay', 'auto')   # 'auto' replays what it has and records the rest
+REPLAY_CHUNK_WORDS = 4                  # Words in each streamed chunk on replay
+
+cassettes = {}          # Path -> Cassette shared by all the models recording to it
+cassettes_lock = threading.Lock()
+
+class CassetteMiss(ValueError):
+    """Replay of a prompt the cassette has no recording of."""
+
+
+def normalize_prompt(prompt) -> str:
+    # Chat prompts are lists of messages, keep the roles. Whitespace differences do not make a new prompt
+    if isinstance(prompt, list):
+        prompt = "\n".join(f"{msg.type}: {msg.content}" if isinstance(msg, BaseMessage) else str(msg) for msg in prompt)
+    return re.sub(r"\s+", " ", str(prompt)).strip()
+
+class Cassette:
+    """Recorded responses in a gzipped JSON lines file, keyed by the hash of the normalized prompt.
+
+    Every recording is appended as its own gzip member under a file lock so that several workers
+    can record to the same file. The file is read again when another worker has appended to it,
+    the last recording of a prompt wins.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.records = {}
+        self.loaded_size = -1
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(prompt) -> str:
+        return hashlib.sha256(normalize_prompt(prompt).encode()).hexdigest()[:32]
+
+    def load(self):
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if size == self.loaded_size:
+            return
+        records = {}
+        if size > 0:
+            with gzip.open(self.path, "rt", encoding="utf-8") as tape:
+                for line in tape:
+                    record = json.loads(line)
+                    records[record['key']] = record
+        self.records = records
+        self.loaded_size = size
+
+    def get(self, prompt) -> dict | None:
+        with self.lock:
+            self.load()
+            return self.records.get(self.make_key(prompt))
+
+    def record(self, prompt, text: str, ttft: float, duration: float, chunks: int):
+        record = {
+            'key': self.make_key(prompt),
+            'prompt': normalize_prompt(prompt),
+            'response': text,
+            'ttft': round(ttft, 3),
+            'duration': round(duration, 3),
+            'chunks': chunks,
+            'tm': int(time.time())
+        }
+        with self.lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, "ab") as tape:
+                if fcntl is not None:
+                    fcntl.flock(tape, fcntl.LOCK_EX)
+                try:
+                    current = os.fstat(tape.fileno()).st_size == self.loaded_size
+                    tape.write(gzip.compress((json.dumps(record) + "\n").encode("utf-8")))
+                    tape.flush()
+                    size = os.fstat(tape.fileno()).st_size
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(tape, fcntl.LOCK_UN)
+            self.records[record['key']] = record
+            # Only skip the next reread when no other worker appended since we last read
+            self.loaded_size = size if current else -1
+
+def get_cassette(path: str) -> Cassette:
+    with cassettes_lock:
+        if path not in cassettes:
+            cassettes[path] = Cassette(path)
+        return cassettes[path]
+
+def replay_chunks(text: str) -> list:
+    words = re.split(r"(?<=\s)(?=\S)", text)
+    return ["".join(words[i:i+REPLAY_CHUNK_WORDS]) for i in range(0, len(words), REPLAY_CHUNK_WORDS)] or [""]
+
+
+class CassetteMixin:
+    """What the LLM and the chat flavour share, the recorded model is the MODELS entry `wraps`."""
+
+    def lookup(self, prompt) -> dict | None:
+        if self.mode == 'record':
+            return None
+        record = get_cassette(self.cassette).get(prompt)
+        if record is None and self.mode == 'replay':
+            raise CassetteMiss(f"No recording of this prompt in cassette [{self.cassette}]")
+        return record
+
+    def wrapped(self, kwargs: dict):
+        from libs.providers import registry
+
+        return registry.bind_sampling(self.wraps, kwargs)
+
+    def response_delay(self, record: dict) -> float:
+        return self.latency if self.latency is not None else record['duration']
+
+    def stream_delays(self, record: dict, chunks: int) -> tuple:
+        # Seconds before the first chunk and between the next ones, the recorded cadence unless configured
+        first = self.latency if self.latency is not None else record['ttft']
+        if self.chunk_delay is not None:
+            return first, self.chunk_delay
+        return first, max(0.0, record['duration'] - record['ttft']) / max(1, chunks - 1)
+
+    def record(self, prompt, text: str, start: float, first: float | None, chunks: int):
+        end = time.perf_counter()
+        get_cassette(self.cassette).record(prompt, text, (first or end) - start, end - start, chunks)
+
+    def replay_stream(self, record: dict) -> Iterator[str]:
+        chunks = replay_chunks(record['response'])
+        first, delay = self.stream_delays(record, len(chunks))
+        time.sleep(first)
+        for index, chunk in enumerate(chunks):
+            if index > 0:
+                time.sleep(delay)
+            yield chunk
+
+    async def areplay_stream(self, record: dict) -> AsyncIterator[str]:
+        chunks = replay_chunks(record['response'])
+        first, delay = self.stream_delays(record, len(chunks))
+        await asyncio.sleep(first)
+        for index, chunk in enumerate(chunks):
+            if index > 0:
+                await asyncio.sleep(delay)
+            yield chunk
+
+    def generate_text(self, prompt, kwargs: dict) -> str:
+        record = self.lookup(prompt)
+        if record is not None:
+            time.sleep(self.response_delay(record))
+            return record['response']
+
+        start = time.perf_counter()
+        text = text_of(self.wrapped(kwargs).invoke(prompt))
+        self.record(prompt, text, start, None, 1)
+        return text
+
+    # The async flavours read and append to the tape on a thread, the file lock may wait on other workers
+
+    async def agenerate_text(self, prompt, kwargs: dict) -> str:
+        record = await asyncio.to_thread(self.lookup, prompt)
+        if record is not None:
+            await asyncio.sleep(self.response_delay(record))
+            return record['response']
+
+        start = time.perf_counter()
+        text = text_of(await self.wrapped(kwargs).ainvoke(prompt))
+        await asyncio.to_thread(self.record, prompt, text, start, None, 1)
+        return text
+
+    def stream_text(self, prompt, kwargs: dict) -> Iterator[str]:
+        record = self.lookup(prompt)
+        if record is not None:
+            yield from self.replay_stream(record)
+            return
+
+        start = time.perf_counter()
+        first = None
+        texts = []
+        for chunk in self.wrapped(kwargs).stream(prompt):
+            first = first or time.perf_counter()
+            texts.append(text_of(chunk))
+            yield texts[-1]
+        self.record(prompt, "".join(texts), start, first, len(texts))
+
+    async def astream_text(self, prompt, kwargs: dict) -> AsyncIterator[str]:
+        record = await asyncio.to_thread(self.lookup, prompt)
+        if record is not None:
+            async for chunk in self.areplay_stream(record):
+                yield chunk
+            return
+
+        start = time.perf_counter()
+        first = None
+        texts = []
+        async for chunk in self.wrapped(kwargs).astream(prompt):
+            first = first or time.perf_counter()
+            texts.append(text_of(chunk))
+            yield texts[-1]
+        await asyncio.to_thread(self.record, prompt, "".join(texts), start, first, len(texts))
+
+def text_of(model_resp) -> str:
+    if isinstance(model_resp, BaseMessage):
+        return str(model_resp.content)
+    return str(model_resp)
+
+
+class CassetteLLM(CassetteMixin, LLM):
+    """Record/replay stand-in for a model taking a prompt string.
+
+    Example:
+        .. code-block:: python
+
+            llm = CassetteLLM(cassette="cassettes/azure-openai-instruct.jsonl.gz", wraps="azure-openai-instruct", mode="replay")
+    """
+
+    cassette: str
+    """Path of the gzipped JSON lines file of recordings."""
+
+    wraps: str
+    """MODELS ID of the model recorded."""
+
+    mode: str = 'replay'
+    latency: Optional[float] = None
+    """Seconds before the response (first chunk when streaming), the recorded latency if not set."""
+
+    chunk_delay: Optional[float] = None
+    """Seconds between the streamed chunks, the recorded cadence if not set."""
+
+    @property
+    def _llm_type(self) -> str:
+        return "cassette"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"cassette": self.cassette, "wraps": self.wraps, "mode": self.mode}
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        return self.generate_text(prompt, kwargs)
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        return await self.agenerate_text(prompt, kwargs)
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[GenerationChunk]:
+        for text in self.stream_text(prompt, kwargs):
+            yield GenerationChunk(text=text)
+
+    async def _astream(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> AsyncIterator[GenerationChunk]:
+        async for text in self.astream_text(prompt, kwargs):
+            yield GenerationChunk(text=text)
+
+
+class CassetteChat(CassetteMixin, BaseChatModel):
+    """Record/replay stand-in for a chat model, same settings as CassetteLLM."""
+
+    cassette: str
+    wraps: str
+    mode: str = 'replay'
+    latency: Optional[float] = None
+    chunk_delay: Optional[float] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "cassette-chat"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"cassette": self.cassette, "wraps": self.wraps, "mode": self.mode}
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.generate_text(messages, kwargs)))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=await self.agenerate_text(messages, kwargs)))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        for text in self.stream_text(messages, kwargs):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        async for text in self.astream_text(messages, kwargs):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text))
+
+
+if __name__ == '__main__':
+  print ('Cannot execute as a program, it is a module')
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+import ast
+from pathlib             import Path
+from textwrap            import TextWrapper
+from typing              import Annotated
+
+from fastapi             import Depends, APIRouter, HTTPException
+from fastapi.responses   import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+
+from libs.data           import CommentRequest, CommentBulkRequest
+from libs.auth           import get_current_active_user, User
+from libs                import functions
+from libs                import files
+
+__all__ = ["router", "CommentSyntax", "register_syntax", "SYNTAXES", "transform"]
+
+MARKER = "codedoc:"     # Opens every generated doc block, so that it can be told apart from the code's own comments
+
+router = APIRouter()
+
+class CommentSyntax:
+    """How generated docs are written into one kind of file, and where they go.
+
+    A block is an opening line with the marker and the title, the wrapped doc lines, and a closing
+    line. locate(source) returns the places for the docs: dicts with the unit's name, the line it
+    goes before, and the syntax of that place (the JS of a page's <script> blocks for instance).
+    """
+
+    def __init__(self, name: str, opening: str, closing: str, prefix: str = "", suffix: str = "",
+                 escapes: dict | None = None, locate=None):
+        self.name = name
+        self.opening = opening      # Format with the block's title
+        self.closing = closing
+        self.prefix = prefix        # Around every doc line, for the single line comment syntaxes
+        self.suffix = suffix
+        self.escapes = escapes or {}
+        self.locate = locate
+
+    def block(self, title: str, doc: str, indent: str, width: int) -> list:
+        lines = [f"{indent}{self.opening.format(title=title)}"]
+        for line in doc.strip("\n").split("\n"):
+            for old, new in self.escapes.items():
+                line = line.replace(old, new)
+            if len(line.strip()) == 0:
+                lines.append(f"{indent}{self.prefix}{self.suffix}".rstrip())
+                continue
+            # Like the notebooks, every line wrapped on its own, continuation lines keep the list item's indent
+            lead = line[:len(line) - len(line.lstrip())]
+            wrapper = TextWrapper(width=width, subsequent_indent=lead + ("  " if line.lstrip()[:2] in ("- ", "* ") else ""),
+                                  fix_sentence_endings=True, break_long_words=False)
+            lines.extend(f"{indent}{self.prefix}{wrapped}{self.suffix}" for wrapped in wrapper.wrap(line))
+        lines.append(f"{indent}{self.closing}")
+        return lines
+
+    def opens(self, line: str) -> bool:
+        return line.strip().startswith(self.opening.split("{title}")[0])
+
+    def closes(self, line: str) -> bool:
+        return line.strip() == self.closing
+
+def leading_lines(source: str) -> int:
+    # The file doc goes below a #! line
+    return 1 if source.startswith("#!") else 0
+
+def indent_of(lines: list, line: int) -> str:
+    text = lines[line - 1] if 0 < line <= len(lines) else ""
+    return text[:len(text) - len(text.lstrip())]
+
+def js_places(source: str, suffix: str) -> list:
+    lines = source.split("\n")
+    return [{'name': func['name'], 'scope': func['scope'], 'line': func['start_line'],
+             'indent': indent_of(lines, func['start_line']), 'syntax': 'js'}
+            for func in functions.extract_functions(source, suffix)['functions']]
+
+def locate_js(source: str) -> list:
+    return js_places(source, '.js')
+
+def locate_page(source: str) -> list:
+    # Functions of the <script> blocks, in JS comments
+    return js_places(source, '.html')
+
+def locate_python(source: str) -> list:
+    places = []
+
+    def visit(node, scope: list):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                line = min([child.lineno] + [decorator.lineno for decorator in child.decorator_list])
+                places.append({'name': child.name, 'scope': ".".join(scope), 'line': line,
+                               'indent': " " * child.col_offset, 'syntax': 'python'})
+                visit(child, scope + [child.name])
+
+    visit(ast.parse(source), [])
+    return places
+
+SYNTAXES = {
+    'js':     CommentSyntax('js', "/* " + MARKER + " {title}", "*/", escapes={"*/": "* /"}, locate=locate_js),
+    'ejs':    CommentSyntax('ejs', "<%# " + MARKER + " {title} %>", "<%# /codedoc %>", prefix="<%# ", suffix=" %>",
+                            escapes={"%>": "% >"}, locate=locate_page),
+    'html':   CommentSyntax('html', "<!-- " + MARKER + " {title}", "-->", escapes={"-->": "-- >"}, locate=locate_page),
+    'python': CommentSyntax('python', "# " + MARKER + " {title}", "# /codedoc", prefix="# ", locate=locate_python),
+}
+SUFFIXES = {'.js': 'js', '.mjs': 'js', '.cjs': 'js', '.ejs': 'ejs', '.html': 'html', '.htm': 'html', '.py': 'python'}
+
+def register_syntax(syntax: CommentSyntax, suffixes: list):
+    SYNTAXES[syntax.name] = syntax
+    for suffix in suffixes:
+        SUFFIXES[suffix.lower()] = syntax.name
+
+def syntax_for(filepath: Path) -> CommentSyntax | None:
+    name = SUFFIXES.get(filepath.suffix.lower())
+    return SYNTAXES[name] if name is not None else None
+
+def transform(lines, syntax: CommentSyntax, insertions: dict, stats: dict):
+    """Single pass over the lines of a file, dropping the generated doc blocks of every syntax it
+    uses and adding the blocks of insertions (line number -> lines) before their lines."""
+
+    syntaxes = [syntax] + [SYNTAXES[name] for name in stats.get('syntaxes', []) if SYNTAXES[name] is not syntax]
+    inside = None
+    last = "\n"
+    number = 0
+    for number, line in enumerate(lines, start=1):
+        for block_line in insertions.get(number, []):
+            yield block_line + "\n"
+        if inside is None:
+            inside = next((candidate for candidate in syntaxes if candidate.opens(line)), None)
+            if inside is None:
+                last = line
+                yield line
+                continue
+            stats['stripped'] += 1
+        if inside.closes(line):
+            inside = None
+    # After the last line: -1 and the line numbers past it, the empty line after a final newline
+    trailing = [insertions[line] for line in sorted(insertions) if line > number] + [insertions.get(-1, [])]
+    if any(trailing) and not last.endswith("\n"):
+        yield "\n"     # Last line without a newline, the block must not be glued to it
+    for block in trailing:
+        for block_line in block:
+            yield block_line + "\n"
+
+def saved_docs(filepath: Path, source: str) -> dict:
+    # The most recent doc of each function of this version, from the manifests of /functions/
+    docs = functions.known_docs(functions.family_manifests(filepath))
+    found = {}
+    for func in functions.extract_functions(source, filepath.suffix.lower())['functions']:
+        generated = sorted(functions.unit_docs(docs, func).values(), key=lambda doc: doc['tm'])
+        if generated:
+            found[f"{func['scope']}.{func['name']}" if func['scope'] else func['name']] = generated[-1]['model_resp']
+    return found
+
+def plan(filepath: Path, syntax: CommentSyntax, mode: str, file_doc: str | None, docs: dict | None, width: int) -> tuple:
+    """Blocks to insert by line number, from the positions of the units in the file's AST."""
+
+    source = filepath.read_text()
+    places = syntax.locate(source)
+    stats = {'stripped': 0, 'inserted': 0, 'syntaxes': sorted({place['syntax'] for place in places})}
+    generated = [syntax] + [SYNTAXES[name] for name in stats['syntaxes']]
+    lines = source.split("\n")
+    stats['blocks'] = sum(1 for line in lines if any(candidate.opens(line) for candidate in generated))
+    insertions = {}
+    if mode == 'strip':
+        return insertions, stats
+
+    if docs is None:
+        docs = saved_docs(filepath, source) if filepath.suffix.lower() in functions.JS_SUFFIXES + functions.DOC_PAGE_SUFFIXES else {}
+    if file_doc:
+        line = leading_lines(source) + 1
+        insertions.setdefault(line if line <= source.count("\n") + 1 else -1, []).extend(syntax.block(filepath.name, file_doc, "", width))
+        stats['inserted'] += 1
+
+    for place in places:
+        qualified = f"{place['scope']}.{place['name']}" if place['scope'] else place['name']
+        doc = docs.get(qualified, docs.get(place['name']))
+        if not doc:
+            continue
+        # Generated blocks in the file are dropped, the new one goes above them (and any decorators)
+        line = place['line']
+        while line > 1 and block_start(lines, line - 1, generated) < line - 1:
+            line = block_start(lines, line - 1, generated)
+        insertions.setdefault(line, []).extend(SYNTAXES[place['syntax']].block(qualified, doc, place['indent'], width))
+        stats['inserted'] += 1
+    return insertions, stats
+
+def block_start(lines: list, closing: int, syntaxes: list) -> int:
+    # Line of the opening of the generated block ending at line closing, closing itself if there is none
+    if not any(candidate.closes(lines[closing - 1]) for candidate in syntaxes):
+        return closing
+    for number in range(closing - 1, 0, -1):
+        if any(candidate.opens(lines[number - 1]) for candidate in syntaxes):
+            return number
+        if any(candidate.closes(lines[number - 1]) for candidate in syntaxes):
+            break
+    return closing
+
+def file_lines(filepath: Path):
+    with filepath.open() as source:
+        yield from source
+
+def source_file(file_path: str, editable: bool) -> tuple:
+    filepath = functions.source_path(file_path, editable)
+    syntax = syntax_for(filepath)
+    if syntax is None:
+        raise HTTPException(status_code=415, detail={'msg': f"No comment syntax for [{filepath.suffix}] files"})
+    return filepath, syntax
+
+def write_version(filepath: Path, syntax: CommentSyntax, insertions: dict, stats: dict) -> dict:
+    # Through the same versioning as /files/, the next version of the file
+    basedir = files.OUTPUT_CODE_DIR if filepath.is_relative_to(files.OUTPUT_CODE_DIR) else files.INPUT_CODE_DIR
+    name = filepath.relative_to(basedir).as_posix()
+    curfilepath, newfilepath, filename_wo_ver, curVer, newVer = files.create_version(name)
+    with newfilepath.open("w") as output:
+        output.writelines(transform(file_lines(filepath), syntax, insertions, stats))
+    try:
+        functions.update_manifest(newfilepath)
+    except Exception as excp:
+        print(f"Updating the function manifest of [{newfilepath}] failed [{excp}]")
+    return {'name': newfilepath.relative_to(files.OUTPUT_CODE_DIR).as_posix(), 'version': newVer,
+            'inserted': stats['inserted'], 'stripped': stats['stripped']}
+
+def comment_tree(request: CommentBulkRequest) -> dict:
+    if request.dir_path.find("..") != -1:
+        raise HTTPException(status_code=403, detail={'msg': "Forbidden access"})
+    root = Path(files.INPUT_CODE_DIR) / request.dir_path
+    if not root.is_dir():
+        raise HTTPException(status_code=404, detail={'msg': f"Could not find {request.dir_path}"})
+
+    results = []
+    for filepath in sorted(root.rglob("*")):
+        relative = filepath.relative_to(files.INPUT_CODE_DIR)
+        if not filepath.is_file() or any(part.startswith(('_', '.')) for part in relative.parts):
+            continue
+        syntax = syntax_for(filepath)
+        if syntax is None:
+            continue
+        current = files.get_latest_version(relative)
+        try:
+            insertions, stats = plan(current, syntax, request.mode, None, None, request.width)
+            if request.mode == 'insert' and stats['inserted'] == 0:
+                results.append({'file': relative.as_posix(), 'skipped': "No saved function docs"})
+                continue
+            if request.mode == 'strip' and stats['blocks'] == 0:
+                results.append({'file': relative.as_posix(), 'skipped': "No generated docs"})
+                continue
+            results.append({'file': relative.as_posix(), **write_version(current, syntax, insertions, stats)})
+        except HTTPException as excp:
+            results.append({'file': relative.as_posix(), 'error': excp.detail.get('msg') if isinstance(excp.detail, dict) else str(excp.detail)})
+        except Exception as excp:
+            results.append({'file': relative.as_posix(), 'error': str(excp)})
+    return {'dir_path': request.dir_path, 'files': results}
+
+@router.post("/comments/")
+async def comment_file(request: CommentRequest, current_user: Annotated[User, Depends(get_current_active_user)]):
+    filepath, syntax = source_file(request.file_path, request.editable)
+    try:
+        insertions, stats = await run_in_threadpool(plan, filepath, syntax, request.mode, request.file_doc, request.docs, request.width)
+    except SyntaxError as excp:     # esprima errors are collected by extract_functions, Python's are raised
+        raise HTTPException(status_code=422, detail={'msg': f"Could not parse {filepath.name} [{excp}]"})
+    if request.save:
+        return await run_in_threadpool(write_version, filepath, syntax, insertions, stats)
+    return StreamingResponse(transform(file_lines(filepath), syntax, insertions, stats), media_type="text/plain",
+                             headers={'X-Docs-Inserted': str(stats['inserted'])})
+
+@router.post("/comments/bulk")
+async def comment_files(request: CommentBulkRequest, current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    return await run_in_threadpool(comment_tree, request)
+
+
+if __name__ == '__main__':
+  print ('Cannot execute as a program, it is a module')
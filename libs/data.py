@@ -22,11 +22,11 @@
 __version__ = "0.1"
 __author__  = "Shalin Garg"
 
-from typing    import List
+from typing    import List, Dict, Literal
 from pydantic  import BaseModel
 import os
 
-__all__ = ["EnvVars", "LLMParams", "File", "LLMParamsSnap", "LLMParamsHistory", "ChatMessage", "ChatExchange"]
+__all__ = ["EnvVars", "LLMParams", "LLMBatch", "File", "LLMParamsSnap", "LLMParamsHistory", "ChatMessage", "ChatExchange", "SummaryRequest", "FunctionDocRequest", "CommentRequest", "CommentBulkRequest"]
 
 class EnvVars:
     @classmethod
@@ -67,6 +67,45 @@ class LLMParams(BaseModel):
     code_snippet: str | None = None
     user_prompt: str
     snap_id: str | None = None
+    use_cache: bool = True      # False forces a fresh generation even for a deterministic request
+    auto_context: bool = False  # Add the code of the input directory most relevant to the prompt to the context
+
+class LLMBatch(BaseModel):
+    items: List[LLMParams] | None = None        # Either a list of complete requests
+    template: LLMParams | None = None           #   or one request repeated for every code snippet
+    code_snippets: List[str] | None = None
+    parallelism: int | None = None              # Capped by the server's --batchParallelism
+    stream: bool = False                        # NDJSON results in completion order
+
+class SummaryRequest(BaseModel):
+    file_path: str                              # Relative to the input directory
+    params: LLMParams                           # user_prompt is what to extract from every chunk
+    reduce_prompt: str | None = None            # How the partial summaries are combined
+    chunk_tokens: int | None = None
+    parallelism: int | None = None              # Capped by the server's --batchParallelism
+
+class FunctionDocRequest(BaseModel):
+    file_path: str                              # JS file or EJS/HTML page, relative to the input directory
+    editable: bool = False                      #   or to the output directory, a saved version
+    params: LLMParams                           # Sent for every function with the function as code_snippet
+    functions: List[str] | None = None          # Names of the functions to document, all of them if None
+    incremental: bool = True                    # Reuse the docs of functions unchanged since an earlier version
+    call_context: bool = False                  # Add the code of the function's callers and callees to the context
+    parallelism: int | None = None              # Capped by the server's --batchParallelism
+
+class CommentRequest(BaseModel):
+    file_path: str                              # Relative to the input directory
+    editable: bool = False                      #   or to the output directory, a saved version
+    mode: Literal['insert', 'strip'] = 'insert' # Generated doc blocks already in the file are replaced either way
+    file_doc: str | None = None                 # Doc of the whole file, on top of it
+    docs: Dict[str, str] | None = None          # Function name (or scope.name) -> doc, the saved function docs if None
+    width: int = 100                            # Doc lines are wrapped at this many characters
+    save: bool = False                          # Saved as the next version instead of returned
+
+class CommentBulkRequest(BaseModel):
+    dir_path: str = ""                          # Every file below it, in its latest version, relative to the input directory
+    mode: Literal['insert', 'strip'] = 'insert' # Inserts the saved function docs
+    width: int = 100
 
 class ChatExchange(BaseModel):
     user: str
@@ -74,7 +113,8 @@ class ChatExchange(BaseModel):
 
 class ChatMessage(BaseModel):
     params: LLMParams
-    history: List[ChatExchange]
+    history: List[ChatExchange] | None = None
+    session_id: str | None = None       # History kept by the server, only the new user turn is sent
 
 class File(BaseModel):
     name: str           # loc/loc/program_name.ver.js ver=1, 2, 3
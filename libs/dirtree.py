@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+import os
+import time
+import hashlib
+import asyncio
+import threading
+from functools           import lru_cache
+from pathlib             import Path
+from natsort             import os_sort_keygen
+
+from fastapi.concurrency import run_in_threadpool
+
+try:
+    from watchfiles import awatch
+except ImportError:
+    awatch = None       # No notifications, the trees are rescanned when older than RESCAN_SECONDS
+
+__all__ = ["DirTree", "get_tree", "path_changed", "start", "stop", "RESCAN_SECONDS"]
+
+RESCAN_SECONDS = 10         # Age at which an unwatched tree is scanned again
+WATCH_TIMEOUT_MS = 1000     # The watcher reports in at least this often, the first time once it is watching
+WATCH_DEBOUNCE_MS = 200     # Changes within this long come as one batch
+
+trees = {}                  # Resolved base directory -> DirTree
+trees_lock = threading.Lock()
+watchers = []
+stop_event = None
+sort_key = lru_cache(maxsize=100000)(os_sort_keygen())     # Of names, the same ones come up in many directories
+
+def hidden_file(name: str) -> bool:
+    return name.startswith('_') or name.startswith('.')
+
+def hidden_dir(name: str) -> bool:
+    # .git and the like, the files of '_' directories are listed
+    return name.startswith('.')
+
+class Node:
+    """A directory of the tree, with the summary of its subtree computed when first asked for."""
+
+    __slots__ = ('dirs', 'files', 'digest', 'count', 'order')
+
+    def __init__(self):
+        self.dirs = {}          # Name -> Node
+        self.files = set()
+        self.invalidate()
+
+    def invalidate(self):
+        self.digest = None      # Hash of the names in the subtree, the ETag of its listings
+        self.count = None       # Files in the subtree
+        self.order = None       # Names of the directories and files together, sorted like the OS file browser does
+
+    def sorted(self) -> list:
+        if self.order is None:
+            self.order = sorted([*self.dirs, *self.files], key=self.entry_key)
+        return self.order
+
+    def entry_key(self, name: str):
+        # A directory goes where its first file goes among full paths, 'a.txt' before 'a/b.txt'
+        child = self.dirs.get(name)
+        if child is not None and len(child.sorted()) > 0:
+            return sort_key(f"{name}/{child.sorted()[0]}")
+        return sort_key(name)
+
+    def summary(self) -> tuple:
+        if self.digest is None:
+            sha = hashlib.sha1()
+            count = 0
+            for name in self.sorted():
+                if name in self.dirs:
+                    digest, subcount = self.dirs[name].summary()
+                    sha.update(f"d:{name}:{digest}\n".encode())
+                    count += subcount
+                else:
+                    sha.update(f"f:{name}\n".encode())
+                    count += 1
+            self.digest = sha.hexdigest()
+            self.count = count
+        return self.digest, self.count
+
+class DirTree:
+    """In memory index of the files under a base directory, for the /files/ listings.
+
+    Scanned once, then kept current by the filesystem notifications of the watcher (start()) and the
+    write paths of libs.files (path_changed()). Without notifications the tree is scanned again
+    when a listing finds it older than RESCAN_SECONDS. Every directory caches its sorted entries and
+    a digest of its subtree, a change only invalidates the directories on its path.
+    """
+
+    def __init__(self, basedir: str):
+        self.root_path = Path(basedir).resolve()
+        self.root = None
+        self.flat = None        # Sorted relative paths of all the files
+        self.scanned = 0.0
+        self.watched = False
+        self.lock = threading.RLock()
+
+    def scan(self, path: Path) -> Node:
+        node = Node()
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not hidden_dir(entry.name):
+                            node.dirs[entry.name] = self.scan(Path(entry.path))
+                    elif not hidden_file(entry.name) and entry.is_file():
+                        node.files.add(entry.name)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            pass
+        return node
+
+    def build(self):
+        start = time.perf_counter()
+        root = self.scan(self.root_path)
+        with self.lock:
+            self.root = root
+            self.flat = None
+            self.scanned = time.monotonic()
+        print(f"Indexed the tree of [{self.root_path}] in [{round((time.perf_counter() - start)*1000, 1)}] ms")
+
+    def fresh(self) -> Node:
+        if self.root is None or (not self.watched and time.monotonic() - self.scanned > RESCAN_SECONDS):
+            self.build()
+        return self.root
+
+    def node(self, relative: str) -> Node | None:
+        node = self.fresh()
+        for part in Path(relative).parts:
+            node = node.dirs.get(part)
+            if node is None:
+                return None
+        return node
+
+    def changed(self, relative: str):
+        """Bring the entry at the relative path in line with the filesystem, whatever happened to it."""
+
+        parts = Path(relative).parts
+        if len(parts) == 0 or any(hidden_dir(part) for part in parts[:-1]):
+            return
+        with self.lock:
+            if self.root is None:
+                return      # Scanned in full by the first listing
+            parent = self.root
+            ancestors = [parent]
+            for part in parts[:-1]:
+                if part not in parent.dirs:
+                    break
+                parent = parent.dirs[part]
+                ancestors.append(parent)
+
+            name = parts[len(ancestors) - 1]
+            path = self.root_path / Path(*parts[:len(ancestors)])
+            if path.is_dir() and not path.is_symlink():
+                if hidden_dir(name) or name in parent.dirs:
+                    return  # The changes of its content come on their own
+                # New directory, it may already have content of its own
+                parent.dirs[name] = self.scan(path)
+                self.flat = None
+            elif len(ancestors) < len(parts):
+                return      # Directory gone or not a directory
+            elif path.is_file():
+                if hidden_file(name) or name in parent.files:
+                    return
+                parent.files.add(name)
+            elif name in parent.files:
+                parent.files.discard(name)
+            elif name in parent.dirs:
+                del parent.dirs[name]
+            else:
+                return
+
+            # Listed again from the sorted entries the other directories kept
+            self.flat = None
+            for node in ancestors:
+                node.invalidate()
+
+    def collect(self, node: Node, prefix: str, out: list):
+        # Directory by directory, the order of the full paths unless a file sorts amid a directory of its name
+        for name in node.sorted():
+            if name in node.dirs:
+                self.collect(node.dirs[name], prefix + name + "/", out)
+            else:
+                out.append(prefix + name)
+
+    def files(self, offset: int = 0, limit: int | None = None) -> tuple:
+        """Relative paths of the files, sorted as before the index, and the digest of the tree."""
+
+        with self.lock:
+            root = self.fresh()
+            if self.flat is None:
+                self.flat = []
+                self.collect(root, "", self.flat)
+            digest, count = root.summary()
+            end = None if limit is None else offset + limit
+            return self.flat[offset:end], count, digest
+
+    def listing(self, relative: str, depth: int = 1, offset: int = 0, limit: int | None = None) -> tuple:
+        """Nested listing of a directory, expanded depth levels deep and paginated over its own entries.
+
+        Directories not expanded only give the count of the files under them, the client asks for
+        them when they are opened. Returns None when the directory is not in the tree.
+        """
+
+        with self.lock:
+            node = self.node(relative)
+            if node is None:
+                return None, None
+            # Directories first, as file browsers show them
+            entries = [(True, name) for name in node.sorted() if name in node.dirs] + \
+                      [(False, name) for name in node.sorted() if name not in node.dirs]
+            end = None if limit is None else offset + limit
+            page = entries[offset:end]
+            result = {
+                'name': Path(relative).name,
+                'path': Path(relative).as_posix() if relative else "",
+                'total': len(entries),
+                'dirs': [self.expand(node.dirs[name], name, depth - 1) for is_dir, name in page if is_dir],
+                'files': [name for is_dir, name in page if not is_dir]
+            }
+            return result, node.summary()[0]
+
+    def expand(self, node: Node, name: str, depth: int) -> dict:
+        entry = {'name': name, 'count': node.summary()[1]}
+        if depth > 0:
+            entry['dirs'] = [self.expand(node.dirs[child], child, depth - 1) for child in node.sorted() if child in node.dirs]
+            entry['files'] = [child for child in node.sorted() if child not in node.dirs]
+        return entry
+
+    def apply(self, changes: set):
+        for _, changed_path in changes:
+            try:
+                relative = Path(changed_path).relative_to(self.root_path)
+            except ValueError:
+                continue
+            self.changed(relative.as_posix())
+
+def get_tree(basedir: str) -> DirTree:
+    root = Path(basedir).resolve()
+    tree = trees.get(root)
+    if tree is None:
+        with trees_lock:
+            tree = trees.setdefault(root, DirTree(basedir))
+    return tree
+
+def path_changed(path: Path):
+    """Tell the trees about a file or directory created or removed by this worker, ahead of the watcher."""
+
+    resolved = Path(path).resolve()
+    for root, tree in list(trees.items()):
+        if resolved != root and resolved.is_relative_to(root):
+            tree.changed(resolved.relative_to(root).as_posix())
+
+async def watch(tree: DirTree):
+    if awatch is None:
+        return
+    try:
+        async for changes in awatch(tree.root_path, watch_filter=None, debounce=WATCH_DEBOUNCE_MS, stop_event=stop_event,
+                                    rust_timeout=WATCH_TIMEOUT_MS, yield_on_timeout=True):
+            if not tree.watched:
+                # Watching from here on, a scan now misses nothing
+                await run_in_threadpool(tree.build)
+                tree.watched = True
+            if len(changes) > 0:
+                await run_in_threadpool(tree.apply, changes)
+    except asyncio.CancelledError:
+        raise
+    except Exception as excp:
+        print(f"Watching [{tree.root_path}] failed [{excp}], its listings rescan every [{RESCAN_SECONDS}] seconds")
+    tree.watched = False
+
+def start(basedirs: list) -> list:
+    """Watch the base directories, returns the tasks for the caller to hold on to."""
+
+    global stop_event
+
+    if awatch is None:
+        print(f"watchfiles not installed, directory listings rescan every [{RESCAN_SECONDS}] seconds")
+        return []
+    stop_event = asyncio.Event()
+    watchers.extend(asyncio.create_task(watch(get_tree(basedir))) for basedir in basedirs if Path(basedir).is_dir())
+    return list(watchers)
+
+async def stop():
+    # The watchers notice within WATCH_TIMEOUT_MS, cancelling them instead leaves their thread behind
+    if stop_event is not None:
+        stop_event.set()
+    await asyncio.gather(*watchers, return_exceptions=True)
+    watchers.clear()
+
+
+if __name__ == '__main__':
+  print ('Cannot execute as a program, it is a module')
@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+import time
+import openai
+import asyncio
+import threading
+from contextlib          import asynccontextmanager
+from concurrent.futures  import ThreadPoolExecutor
+
+from langchain_core.language_models     import BaseChatModel, BaseLLM, LLM
+from langchain.schema    import BaseMessage
+
+from libs.providers      import registry
+from libs                import llm_cache
+from libs                import ratelimit
+from libs                import failover
+from libs                import metrics
+from libs                import scheduler
+from libs                import usage
+
+__all__ = ["LLMCall", "configure", "ainvoke", "astream", "has_async_api", "response_text", "LLM_CONCURRENCY"]
+
+LLM_CONCURRENCY = 32     # Generations a single worker keeps in flight
+executor = None
+async_api_cache = {}
+in_flight = {}           # Request key -> task of the generation other identical requests wait on
+
+def configure(concurrency: int, weights: dict | None = None):
+    global LLM_CONCURRENCY, executor
+
+    LLM_CONCURRENCY = concurrency
+    if executor is not None:
+        executor.shutdown(wait=False)
+    # Sync only providers get one thread per allowed generation, they can never need more
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="llm")
+    scheduler.configure(concurrency, weights)
+
+def has_async_api(client) -> bool:
+    # LangChain silently falls back to the default executor when a model does not override the
+    #   async methods, we rather send those to our own bounded pool
+    cls = type(client)
+    if cls not in async_api_cache:
+        if isinstance(client, BaseChatModel):
+            native = cls._agenerate is not BaseChatModel._agenerate
+        elif isinstance(client, LLM):
+            native = cls._acall is not LLM._acall or cls._agenerate is not LLM._agenerate
+        elif isinstance(client, BaseLLM):
+            native = cls._agenerate is not BaseLLM._agenerate
+        else:
+            native = hasattr(client, 'ainvoke')
+        async_api_cache[cls] = native
+
+    return async_api_cache[cls]
+
+def response_text(model_resp) -> str:
+    # Chat models answer with (chunks of) AIMessage, the plain LLMs with a string
+    if isinstance(model_resp, BaseMessage):
+        return str(model_resp.content)
+    else:
+        return str(model_resp)
+
+class LLMCall:
+    """One generation on its way to a provider, the runnable is already bound with the sampling parameters."""
+
+    def __init__(self, llmID: str, model_obj: dict, runnable, message, sampling: dict, use_cache: bool = True, tokens: dict = None):
+        self.llmID = llmID
+        self.model_obj = model_obj
+        self.runnable = runnable
+        self.message = message          # Fully formatted prompt string or list of chat messages
+        self.sampling = sampling
+        self.use_cache = use_cache
+        self.cached = False             # Set when the response came out of the cache
+        self.coalesced = False          # Set when an identical request in flight supplied the response
+        self.admission = {'queue_depth': 0, 'wait_ms': 0.0, 'retries': 0}
+        self.route = {'backend': None, 'failovers': 0, 'hedged': False}
+        self.tokens = tokens            # Token accounting of the prompt sections, see libs.tokens
+        self.priority, self.user = scheduler.current()     # Set by the request handler, see libs.scheduler
+
+    def estimated_tokens(self) -> int:
+        # What the provider charges against the TPM budget, the prompt plus all the tokens it may generate
+        if self.tokens is not None:
+            return self.tokens['prompt'] + self.tokens['max_completion']
+        if isinstance(self.message, list):
+            chars = sum(len(str(getattr(msg, 'content', msg))) for msg in self.message)
+        else:
+            chars = len(str(self.message))
+        max_tokens = self.sampling.get('max_tokens') or self.sampling.get('max_output_tokens') or self.sampling.get('max_new_tokens') or 0
+        return chars // 4 + max_tokens
+
+    def cache_key(self) -> str | None:
+        cache = llm_cache.get_cache()
+        if cache is None or not self.use_cache:
+            return None
+        if self.sampling.get('temperature', 1) > llm_cache.CACHE_MAX_TEMPERATURE:
+            return None
+        return cache.make_key(self.model_obj, self.sampling, self.message)
+
+    def flight_key(self) -> str | None:
+        # Same rules as the cache, a call that opted out of reuse or samples gets a response of its own
+        if not self.use_cache or self.sampling.get('temperature', 1) > llm_cache.CACHE_MAX_TEMPERATURE:
+            return None
+        return llm_cache.ResponseCache.make_key(self.model_obj, self.sampling, self.message)
+
+async def ainvoke(call: LLMCall):
+    """Run the call without blocking the event loop.
+
+    At most LLM_CONCURRENCY calls are in flight per worker, the rest wait for a free slot.
+    Deterministic calls are answered from the response cache when possible. Identical ones
+    arriving while one is in flight share its response instead of going to the provider again.
+    """
+
+    start = time.perf_counter()
+    source = 'error'
+    try:
+        model_resp = await coalesce(call)
+        source = 'cache' if call.cached else 'coalesced' if call.coalesced else 'provider'
+        return model_resp
+    finally:
+        metrics.LLM_SECONDS.labels(call.llmID, 'invoke', source).observe(time.perf_counter() - start)
+
+async def coalesce(call: LLMCall):
+    key = call.cache_key()
+    if key is not None:
+        cached = await asyncio.to_thread(llm_cache.get_cache().get, key)
+        if cached is not None:
+            call.cached = True
+            return cached
+
+    flight = key or call.flight_key()
+    if flight is None:
+        return await invoke_provider(call)
+    task = in_flight.get(flight)
+    if task is not None:
+        call.coalesced = True
+    else:
+        # A task of its own so the generation carries on for the others if this caller goes away
+        task = asyncio.create_task(lead(call, key))
+        in_flight[flight] = task
+        task.add_done_callback(lambda _: in_flight.pop(flight, None))
+
+    return await asyncio.shield(task)
+
+async def lead(call: LLMCall, key: str | None):
+    if key is None:
+        return await invoke_provider(call)
+
+    # Across workers the response is handed over through the cache, so only cacheable calls coalesce there
+    cache = llm_cache.get_cache()
+    async with cache.flight_lock(key) as waited:
+        if waited:
+            cached = await asyncio.to_thread(cache.get, key)
+            if cached is not None:
+                call.coalesced = True
+                return cached
+
+        model_resp = await invoke_provider(call)
+        await asyncio.to_thread(cache.put, key, call.llmID, response_text(model_resp))
+
+    return model_resp
+
+async def astream(call: LLMCall):
+    """Stream the output chunks of the call as the provider emits them.
+
+    Holds one of the LLM_CONCURRENCY slots until the stream is exhausted or abandoned. A cached
+    response comes back as a single chunk, a completed stream is added to the cache.
+    """
+
+    start = time.perf_counter()
+    source = 'error'
+    try:
+        key = call.cache_key()
+        if key is not None:
+            cached = await asyncio.to_thread(llm_cache.get_cache().get, key)
+            if cached is not None:
+                call.cached = True
+                source = 'cache'
+                yield cached
+                return
+
+        texts = []
+        async for chunk in stream_provider(call):
+            if key is not None:
+                texts.append(response_text(chunk))
+            yield chunk
+
+        if key is not None:
+            await asyncio.to_thread(llm_cache.get_cache().put, key, call.llmID, "".join(texts))
+        source = 'provider'
+    finally:
+        metrics.LLM_SECONDS.labels(call.llmID, 'stream', source).observe(time.perf_counter() - start)
+
+async def admit(call: LLMCall, controller):
+    stats = await controller.acquire(call.estimated_tokens())
+    call.admission['queue_depth'] = max(call.admission['queue_depth'], stats['queue_depth'])
+    call.admission['wait_ms'] = round(call.admission['wait_ms'] + stats['wait_ms'], 1)
+
+async def retry_or_raise(call: LLMCall, controller, excp: Exception, attempt: int, retries: int):
+    if attempt >= retries:
+        raise excp
+
+    delay = ratelimit.retry_delay(excp, attempt)
+    if isinstance(excp, openai.RateLimitError):
+        # The whole deployment is over its quota, hold back everybody else queued for it as well
+        controller.backoff(delay)
+    print(f"Retrying [{call.llmID}] in {delay:.1f}s after [{type(excp).__name__}]")
+    call.admission['retries'] += 1
+    await asyncio.sleep(delay)
+
+@asynccontextmanager
+async def provider_slot(call: LLMCall, controller):
+    # Rate limit budget first, then one of the LLM_CONCURRENCY slots of the worker, given out fairly
+    slots = scheduler.get_scheduler()
+    queued = metrics.LLM_QUEUED.labels(call.llmID)
+    queued.inc()
+    try:
+        await admit(call, controller)
+        start = time.perf_counter()
+        granted = await slots.acquire(call.priority, call.user)
+        call.admission['wait_ms'] = round(call.admission['wait_ms'] + (granted - start)*1000, 1)
+    finally:
+        queued.dec()
+
+    in_flight = metrics.LLM_IN_FLIGHT.labels(call.llmID)
+    in_flight.inc()
+    try:
+        yield
+    finally:
+        in_flight.dec()
+        slots.release(call.priority, granted)
+
+def backend_runnable(call: LLMCall, backend):
+    # The call comes bound to the MODELS entry itself, other backends get the same sampling parameters
+    if backend.index == 0:
+        return call.runnable
+    return registry.bind_sampling(call.llmID, call.sampling, backend.index)
+
+async def invoke_provider(call: LLMCall):
+    """Send the call to the backends of its model in turn until one answers.
+
+    Only the last backend tried retries 429s and transient failures, the others fail over at once.
+    Models with 'hedge' set also send a duplicate to the next backend when the first one is slower
+    than its p95.
+    """
+
+    if scheduler.get_scheduler() is None:
+        configure(LLM_CONCURRENCY)
+    await usage.check_quota(call.user, call.tokens['prompt'] if call.tokens is not None else 0)
+
+    backends = failover.route(call.llmID)
+    if call.model_obj.get('hedge') and len(backends) > 1:
+        return await invoke_hedged(call, backends[0], backends[1])
+
+    for backend in backends[:-1]:
+        try:
+            return await invoke_backend(call, backend, 0)
+        except ratelimit.RETRYABLE_ERRORS as excp:
+            print(f"Failing over [{call.llmID}] from [{backend.name}] after [{type(excp).__name__}]")
+            call.route['failovers'] += 1
+
+    return await invoke_backend(call, backends[-1], ratelimit.MAX_RETRIES)
+
+async def invoke_hedged(call: LLMCall, primary, secondary):
+    first = asyncio.create_task(invoke_backend(call, primary, 0))
+    tasks = {first}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=primary.hedge_delay())
+        if first in done:
+            if first.exception() is None:
+                return first.result()
+            if not isinstance(first.exception(), ratelimit.RETRYABLE_ERRORS):
+                raise first.exception()
+            call.route['failovers'] += 1
+            return await invoke_backend(call, secondary, ratelimit.MAX_RETRIES)
+
+        # Slower than usual, whichever of the two answers first wins
+        call.route['hedged'] = True
+        tasks.add(asyncio.create_task(invoke_backend(call, secondary, 0)))
+        while True:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+            if len(tasks) == 0:
+                raise done.pop().exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def invoke_backend(call: LLMCall, backend, retries: int):
+    """Admit the call against the budgets of the backend and run it, retrying 429s and transient failures."""
+
+    controller = ratelimit.get_controller(backend.model_obj)
+    runnable = backend_runnable(call, backend)
+    attempt = 0
+    while True:
+        try:
+            async with provider_slot(call, controller):
+                backend.attempt()
+                start = time.perf_counter()
+                if has_async_api(registry.get_client(call.llmID, backend.index)):
+                    model_resp = await runnable.ainvoke(call.message)
+                else:
+                    loop = asyncio.get_running_loop()
+                    model_resp = await loop.run_in_executor(executor, runnable.invoke, call.message)
+            latency = time.perf_counter() - start
+            backend.success(latency)
+            metrics.PROVIDER_SECONDS.labels(call.llmID, backend.name, 'invoke').observe(latency)
+            metrics.PROVIDER_TTFT.labels(call.llmID, backend.name, 'invoke').observe(latency)
+            call.route['backend'] = backend.name
+            return model_resp
+        except ratelimit.RETRYABLE_ERRORS as excp:
+            metrics.PROVIDER_ERRORS.labels(call.llmID, backend.name, type(excp).__name__).inc()
+            backend.failure()
+            await retry_or_raise(call, controller, excp, attempt, retries)
+            attempt += 1
+
+async def stream_provider(call: LLMCall):
+    """Like invoke_provider() but streaming and never hedged, failing over is only possible before the first chunk went out."""
+
+    if scheduler.get_scheduler() is None:
+        configure(LLM_CONCURRENCY)
+    await usage.check_quota(call.user, call.tokens['prompt'] if call.tokens is not None else 0)
+
+    backends = failover.route(call.llmID)
+    for backend in backends[:-1]:
+        streaming = False
+        try:
+            async for chunk in stream_backend(call, backend, 0):
+                streaming = True
+                yield chunk
+            return
+        except ratelimit.RETRYABLE_ERRORS as excp:
+            if streaming:
+                raise
+            print(f"Failing over [{call.llmID}] from [{backend.name}] after [{type(excp).__name__}]")
+            call.route['failovers'] += 1
+
+    async for chunk in stream_backend(call, backends[-1], ratelimit.MAX_RETRIES):
+        yield chunk
+
+async def stream_backend(call: LLMCall, backend, retries: int):
+    controller = ratelimit.get_controller(backend.model_obj)
+    runnable = backend_runnable(call, backend)
+    attempt = 0
+    while True:
+        streaming = False
+        try:
+            async with provider_slot(call, controller):
+                backend.attempt()
+                start = time.perf_counter()
+                if has_async_api(registry.get_client(call.llmID, backend.index)):
+                    chunks = runnable.astream(call.message)
+                else:
+                    chunks = stream_in_executor(runnable, call.message)
+                async for chunk in chunks:
+                    if not streaming:
+                        # Stream durations say nothing about the latency hedging is after
+                        backend.success()
+                        metrics.PROVIDER_TTFT.labels(call.llmID, backend.name, 'stream').observe(time.perf_counter() - start)
+                        call.route['backend'] = backend.name
+                        streaming = True
+                    yield chunk
+            metrics.PROVIDER_SECONDS.labels(call.llmID, backend.name, 'stream').observe(time.perf_counter() - start)
+            return
+        except ratelimit.RETRYABLE_ERRORS as excp:
+            metrics.PROVIDER_ERRORS.labels(call.llmID, backend.name, type(excp).__name__).inc()
+            if streaming:
+                raise
+            backend.failure()
+            await retry_or_raise(call, controller, excp, attempt, retries)
+            attempt += 1
+
+async def stream_in_executor(runnable, message):
+    # Sync only provider, iterate its stream on the pool and hand the chunks over to the loop
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+    stop = threading.Event()    # The consumer went away, the pool thread and the connection are let go
+
+    def hand_over(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            stop.set()      # Loop closed
+
+    def produce():
+        chunks = runnable.stream(message)
+        try:
+            for chunk in chunks:
+                if stop.is_set():
+                    break
+                hand_over(chunk)
+        except Exception as excp:
+            hand_over(excp)
+        finally:
+            # Closed on this thread, a generator cannot be closed while another thread runs it
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+            hand_over(done)
+
+    producer = loop.run_in_executor(executor, produce)
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is done:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+    await producer
+
+if __name__ == '__main__':
+  print ('Cannot execute as a program, it is a module')
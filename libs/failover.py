@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+import time
+from collections         import deque
+from typing              import Annotated
+
+from fastapi             import Depends, APIRouter
+
+from libs.auth           import get_current_active_user, User
+from libs.providers      import registry
+
+__all__ = ["router", "CircuitBreaker", "Backend", "route", "get_backends"]
+
+FAILURE_THRESHOLD = 3       # Consecutive failures that open the circuit of a backend
+OPEN_SECONDS = 30.0         # An open circuit keeps the backend out this long, then lets one trial call through
+LATENCY_SAMPLES = 100       # Recent latencies kept per backend for the hedging delay
+MIN_HEDGE_SAMPLES = 20      # Fewer samples than this and the p95 is not trusted
+DEFAULT_HEDGE_DELAY = 5.0   # Seconds before hedging while the p95 is not known yet
+
+router = APIRouter()
+backends = {}       # llmID -> [Backend]
+
+class CircuitBreaker:
+    """Closed while the backend works, open after FAILURE_THRESHOLD failures in a row.
+
+    Once OPEN_SECONDS have passed an open circuit turns half open, a single trial call is let
+    through and its outcome closes or reopens the circuit.
+    """
+
+    def __init__(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = 0.0
+        self.trial = 0.0        # When the trial call of the half open circuit started
+
+    def available(self) -> bool:
+        if self.state == 'closed':
+            return True
+        # Open long enough and no trial in flight, or the trial never reported back
+        now = time.monotonic()
+        return now - self.opened >= OPEN_SECONDS and now - self.trial >= OPEN_SECONDS
+
+    def attempt(self):
+        if self.state != 'closed':
+            self.state = 'half_open'
+            self.trial = time.monotonic()
+
+    def success(self):
+        self.state = 'closed'
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= FAILURE_THRESHOLD:
+            self.state = 'open'
+            self.opened = time.monotonic()
+
+
+class Backend:
+    """One deployment serving a model, with its health and recent latencies."""
+
+    def __init__(self, index: int, model_obj: dict):
+        self.index = index
+        self.model_obj = model_obj
+        self.name = f"{model_obj.get('endpoint', model_obj['provider'])}/{model_obj['id_for_prvdr']}"
+        self.breaker = CircuitBreaker()
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def success(self, latency: float = None):
+        self.breaker.success()
+        if latency is not None:
+            self.latencies.append(latency)
+
+    def attempt(self):
+        self.breaker.attempt()
+
+    def failure(self):
+        self.breaker.failure()
+
+    def p95(self) -> float | None:
+        if len(self.latencies) < MIN_HEDGE_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def hedge_delay(self) -> float:
+        p95 = self.p95()
+        return p95 if p95 is not None else DEFAULT_HEDGE_DELAY
+
+    def toDict(self) -> dict:
+        p95 = self.p95()
+        return {
+            'backend': self.name,
+            'state': self.breaker.state,
+            'failures': self.breaker.failures,
+            'samples': len(self.latencies),
+            'p95_ms': round(p95*1000, 1) if p95 is not None else None
+        }
+
+def get_backends(llmID: str) -> list:
+    if llmID not in backends:
+        backends[llmID] = [Backend(index, model_obj) for index, model_obj in enumerate(registry.backends(llmID))]
+    return backends[llmID]
+
+def route(llmID: str) -> list:
+    """Backends to try for a call, in order. Open circuits are skipped unless nothing else is left."""
+
+    candidates = get_backends(llmID)
+    healthy = [backend for backend in candidates if backend.breaker.available()]
+    if len(healthy) > 0:
+        return healthy
+
+    # All circuits open, the one open longest is the most likely to have recovered
+    return sorted(candidates, key=lambda backend: backend.breaker.opened)
+
+@router.get("/llm/backends/")
+def get_backend_health(current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    # Health as seen by this worker
+    return {llmID: [backend.toDict() for backend in models] for llmID, models in backends.items()}
+
+
+if __name__ == '__main__':
+  print ('Cannot execute as a program, it is a module')
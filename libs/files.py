@@ -25,11 +25,12 @@ __author__  = "Shalin Garg"
 import re
 import os
 import shutil
+import hashlib
 import magic
 from typing              import Annotated
 from pathlib             import Path
 from natsort             import os_sorted
-from fastapi             import Depends, APIRouter, Request, HTTPException
+from fastapi             import Depends, APIRouter, Request, Response, HTTPException, BackgroundTasks
 from fastapi.responses   import FileResponse
 from fastapi             import UploadFile
 
@@ -38,6 +39,7 @@ from PyPDF2              import PdfReader
 from libs.data           import File
 from libs.auth           import get_current_active_user, User
 from libs.github_api     import GithubAPI
+from libs                import dirtree
 
 __all__ = ["router", "INPUT_CODE_DIR", "OUTPUT_CODE_DIR"]
 
@@ -52,9 +54,15 @@ repobranch = ""
 if not reponame or len(reponame) == 0:
     print("Documentation Repository not set")
 else:
-    githubAPI = GithubAPI()
     repobranch = os.getenv("DOCS_REPO_BRANCH")
 
+def get_github() -> GithubAPI:
+    # Connected by the first request that needs it, not by every worker at import
+    global githubAPI
+    if githubAPI is None:
+        githubAPI = GithubAPI()
+    return githubAPI
+
 def get_editable_file(file_path: Path):
     # Find the highest versioned file in the output folder
     stem = file_path.stem    # string - /outputdir/html/css/styles
@@ -75,6 +83,21 @@ def get_version(file_path):
     else:
         return 0
 
+def get_latest_version(relative: Path) -> Path:
+    # The most recent saved version of an input file, the input file itself if it was never saved
+    versions = []
+    for candidate in (Path(OUTPUT_CODE_DIR) / relative).parent.glob(relative.name.split('.')[0] + ".*"):
+        split_name = candidate.name.split('.')
+        if len(split_name) >= 3 and split_name[-2].isdigit():
+            split_name.pop(-2)
+        elif len(split_name) == 2 and split_name[-1].isdigit():
+            split_name.pop(-1)
+        else:
+            continue
+        if ".".join(split_name) == relative.name and candidate.is_file():
+            versions.append((get_version(candidate), candidate))
+    return max(versions)[1] if versions else Path(INPUT_CODE_DIR) / relative
+
 def get_file_version_names(fileName: File):
     file_path = Path(fileName)   # a/b/n1, a/b/n1.py, n1.1.py, n1.tar.1.gz, n1.1, n1.tar.gz
     dir_path  = file_path.parent      # a/b,    a/b,
@@ -130,9 +153,31 @@ def get_file_version_names(fileName: File):
 
     return (curfilepath, newfilepath, filename_wo_ver, curVer, newVer)
 
+def create_version(fileName: str) -> tuple:
+    # Reserves the next version of the file, an empty file for the caller to write
+    curfilepath, newfilepath, filename_wo_ver, curVer, newVer = get_file_version_names(fileName)
+
+    if newfilepath.exists():
+        raise HTTPException(status_code=409, detail={'msg': f"File [{fileName}] with new version [{newVer}] already exists."})
+
+    # Create the directory structure, don't raise exceptions if paths exist
+    newfilepath.parent.mkdir(mode=0o744, parents=True, exist_ok=True)
+
+    try:
+        newfilepath.touch(mode=0o644, exist_ok=False)  # Raises FileExistsError if file already exists (expecting this to take care of any race conditions too)
+    except FileExistsError:
+        raise HTTPException(status_code=409, detail={'msg': f"File [{fileName}] with new version [{newVer}] already exists."})
+    dirtree.path_changed(newfilepath)
+
+    return (curfilepath, newfilepath, filename_wo_ver, curVer, newVer)
+
 @router.get("/files/")
 def get_dirlist(current_user: Annotated[User, Depends(get_current_active_user)],
-                editable: bool = False) -> dict:
+                request: Request, response: Response,
+                editable: bool = False, dir: str | None = None, depth: int = 1,
+                offset: int = 0, limit: int | None = None):
+    # Without dir, the flat list of all the files. With dir ("" for the top), the nested listing of
+    #   that directory expanded depth levels, for the client to open the others as needed
     basedir  = None
     if editable:
         basedir = OUTPUT_CODE_DIR
@@ -140,17 +185,26 @@ def get_dirlist(current_user: Annotated[User, Depends(get_current_active_user)],
         basedir = INPUT_CODE_DIR
 
     filepath = Path(basedir + "/")
-    if filepath.is_dir():
-        files_paths = []
-        for file in filepath.glob("**/*"):
-            if not (file.name.startswith('_') or file.name.startswith('.')):
-                if not file.is_dir():
-                    files_paths.append(file.relative_to(basedir).as_posix())
-        # files = os.listdir("./" + dir_path)
-        #files_paths = sorted([f"{request.url._url}/{f}" for f in files if not (f.startswith('.') or f.startswith('_'))])
-        return {'dirname': "/", 'files': os_sorted(files_paths)}
-    else:
+    if not filepath.is_dir():
         raise HTTPException(status_code=404, detail={'msg': f"Could not read {filepath.name}"})
+    if (dir is not None and dir.find("..") != -1) or offset < 0 or (limit is not None and limit < 1):
+        raise HTTPException(status_code=403, detail={'msg': "Forbidden access"})
+
+    tree = dirtree.get_tree(basedir)
+    if dir is None:
+        files_paths, total, digest = tree.files(offset, limit)
+        result = {'dirname': "/", 'files': files_paths, 'total': total}
+    else:
+        result, digest = tree.listing(dir.strip("/"), max(depth, 1), offset, limit)
+        if result is None:
+            raise HTTPException(status_code=404, detail={'msg': f"Could not read {dir}"})
+
+    # Same names, same ETag in every worker
+    etag = '"' + hashlib.sha1(f"{digest}|{dir}|{depth}|{offset}|{limit}".encode()).hexdigest()[:20] + '"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={'ETag': etag})
+    response.headers['ETag'] = etag
+    return result
 
 @router.get("/gitfiles/")
 def get_gitdirlist(current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
@@ -159,7 +213,7 @@ def get_gitdirlist(current_user: Annotated[User, Depends(get_current_active_user
         raise HTTPException(status_code=404, detail={'msg': 'No Git Repository configured'})
 
     try:
-        files_paths = githubAPI.get_full_dirtree(reponame, repobranch)
+        files_paths = get_github().get_full_dirtree(reponame, repobranch)
         return {'dirname': "/", 'files': os_sorted(files_paths)}
     except Exception as excp:
         raise HTTPException(status_code=excp.status, detail={'msg': excp.message})
@@ -202,7 +256,7 @@ def get_gitfile(file_path: str, current_user: Annotated[User, Depends(get_curren
         raise HTTPException(status_code=404, detail={'msg': 'No Git Repository configured'})
 
     try:
-        file_content = githubAPI.get_file_contents(reponame, file_path, repobranch)
+        file_content = get_github().get_file_contents(reponame, file_path, repobranch)
         return File(name=file_path, version=-1, content=file_content)
     except Exception as excp:
         raise HTTPException(status_code=excp.status, detail={'msg': excp.message})
@@ -229,29 +283,31 @@ def delete_file(file_path:str, editable: bool,
         filepath.rmdir()
     else:
         raise HTTPException(status_code=404, detail={'msg': f"Could not find {filepath.name}"})
+    dirtree.path_changed(filepath)
     
     return {'name': file_path, 'deleted': True}
 
 @router.put("/files/{dir_path:path}")
-def save_file(dir_path: str, fileData: File, request: Request,
+def save_file(dir_path: str, fileData: File, request: Request, background_tasks: BackgroundTasks,
               current_user: Annotated[User, Depends(get_current_active_user)]) -> File:
     if dir_path.find("..") != -1 or fileData.name.find("..") != -1:
         raise HTTPException(status_code=403, detail={'msg': "Forbidden access"})
 
-    curfilepath, newfilepath, filename_wo_ver, curVer, newVer = get_file_version_names(fileData.name)
-
-    if newfilepath.exists():
-        raise HTTPException(status_code=409, detail={'msg': f"File [{fileData.name}] with new version [{newVer}] already exists."})
+    curfilepath, newfilepath, filename_wo_ver, curVer, newVer = create_version(fileData.name)
 
-    # Create the directory structure, don't raise exceptions if paths exist
-    newfilepath.parent.mkdir(mode=0o744, parents=True, exist_ok=True)
+    newfilepath.write_text(fileData.content)
 
+    # Keep the docs of the functions that did not change for the re-documentation of this version
     try:
-        newfilepath.touch(mode=0o644, exist_ok=False)  # Raises FileExistsError if file already exists (expecting this to take care of any race conditions too)
-    except FileExistsError:
-        raise HTTPException(status_code=409, detail={'msg': f"File [{fileData.name}] with new version [{newVer}] already exists."})
+        from libs import functions
+        functions.update_manifest(newfilepath)
+    except Exception as excp:
+        print(f"Updating the function manifest of [{newfilepath}] failed [{excp}]")
 
-    newfilepath.write_text(fileData.content)
+    # The code indexes follow the latest version of every file, parsed and written after the response
+    from libs import retrieval, symbols
+    background_tasks.add_task(retrieval.file_changed, fileData.name)
+    background_tasks.add_task(symbols.file_changed, fileData.name)
 
     # Update git as well
     if reponame and len(reponame) > 0:
@@ -259,7 +315,7 @@ def save_file(dir_path: str, fileData: File, request: Request,
         fileExistsInGit = False
         try:
             if curfilepath.exists():
-                gitContent = githubAPI.get_file_contents(reponame, filename_wo_ver, repobranch)
+                gitContent = get_github().get_file_contents(reponame, filename_wo_ver, repobranch)
                 fileExistsInGit = True
                 #print(gitContent)
                 localContent = curfilepath.read_text()
@@ -281,11 +337,11 @@ def save_file(dir_path: str, fileData: File, request: Request,
         try:
             #print("Checking in to GIT " + filename_wo_ver)
             if fileExistsInGit:
-                fileData.commit = githubAPI.update_file(reponame, filename_wo_ver, fileData.content, repobranch,
+                fileData.commit = get_github().update_file(reponame, filename_wo_ver, fileData.content, repobranch,
                     f"Updating versioned file [{newfilepath.relative_to(OUTPUT_CODE_DIR).as_posix()}]",
                     current_user.fullname, current_user.email)
             else:
-                fileData.commit = githubAPI.create_new_file(reponame, filename_wo_ver, fileData.content, repobranch,
+                fileData.commit = get_github().create_new_file(reponame, filename_wo_ver, fileData.content, repobranch,
                     f"Updating versioned file [{newfilepath.relative_to(OUTPUT_CODE_DIR).as_posix()}]",
                     current_user.fullname, current_user.email)
         except Exception as exp:
@@ -298,7 +354,7 @@ def save_file(dir_path: str, fileData: File, request: Request,
     return fileData
 
 @router.post("/uploadfiles/{dir_path:path}")
-async def create_upload_files(dir_path:str, files: list[UploadFile],
+async def create_upload_files(dir_path:str, files: list[UploadFile], background_tasks: BackgroundTasks,
                               current_user: Annotated[User, Depends(get_current_active_user)]):
     if dir_path.find("..") != -1:
         raise HTTPException(status_code=403, detail={'msg': "Forbidden access"})
@@ -323,14 +379,11 @@ async def create_upload_files(dir_path:str, files: list[UploadFile],
             curfilepath.touch(mode=0o644, exist_ok=False)  # Raises FileExistsError if file already exists (expecting this to take care of any race conditions too)
         except FileExistsError:
             raise HTTPException(status_code=409, detail={'msg': f"File [{file.filename}] already exists at [{dir_path}]."})
+        dirtree.path_changed(curfilepath)
 
         try:
             if file_mime == "application/pdf":
-                reader = PdfReader(file.file)
-                text = ""
-                for page in reader.pages:
-                    text+=page.extract_text()
-                new_text = text.replace('\u25AA',"").replace("z\n","")
+                new_text = pdf_text(file.file)
 
                 with curfilepath.open("w") as buffer:
                     buffer.write(new_text)
@@ -342,8 +395,31 @@ async def create_upload_files(dir_path:str, files: list[UploadFile],
         finally:
             file.file.close()
 
+        # Indexed in the threadpool after the response, parsing a large file must not hold up the event loop
+        from libs import retrieval, symbols
+        background_tasks.add_task(retrieval.file_changed, (Path(dir_path) / file.filename).as_posix())
+        background_tasks.add_task(symbols.file_changed, (Path(dir_path) / file.filename).as_posix())
+
     return resp_obj
 
+def pdf_text(stream) -> str:
+    reader = PdfReader(stream)
+    text = ""
+    for page in reader.pages:
+        text+=page.extract_text()
+    return text.replace('\u25AA',"").replace("z\n","")
+
+def read_document(filepath: Path) -> str:
+    """Text of a stored document: PDFs are extracted like on upload, text is decoded leniently."""
+
+    file_mime = magic.from_file(str(filepath), mime=True)
+    if file_mime == "application/pdf":
+        with filepath.open("rb") as stream:
+            return pdf_text(stream)
+    if not any(mime.match(file_mime) for mime in SUPP_MIME_TYPES):
+        raise HTTPException(status_code=415, detail={'msg': f"Unsupported File Type [{file_mime}]"})
+    return filepath.read_text(errors="replace")
+
 def string_diff(s1: str, s2: str) -> str:
     d1, d2 = [], []
     i1 = i2 = 0
@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+import re
+import json
+import time
+import hashlib
+import asyncio
+from pathlib             import Path
+from typing              import Annotated
+
+import esprima
+from fastapi             import Depends, APIRouter, HTTPException
+from fastapi.concurrency import run_in_threadpool
+
+from libs.data           import FunctionDocRequest
+from libs.auth           import get_current_active_user, User
+from libs                import files
+from libs                import scheduler
+from libs.scheduler      import Priority
+
+__all__ = ["router", "configure", "extract_functions", "document_functions", "update_manifest", "MAX_FUNCTION_LINES"]
+
+MAX_FUNCTION_LINES = 150    # Longer functions holding functions of their own are documented through those
+MAX_PARALLELISM = 8
+JS_SUFFIXES = ('.js', '.mjs', '.cjs')
+DOC_PAGE_SUFFIXES = ('.ejs', '.html', '.htm')
+SCRIPT_BLOCK = re.compile(r"<script\b[^>]*>(.*?)</script>", re.DOTALL | re.IGNORECASE)
+FUNCTION_TYPES = ('FunctionDeclaration', 'FunctionExpression', 'ArrowFunctionExpression')
+
+router = APIRouter()
+runner = None           # Coroutine function turning LLMParams into the result of /llm/
+
+def configure(parallelism: int, llm_runner):
+    global MAX_PARALLELISM, runner
+
+    MAX_PARALLELISM = parallelism
+    runner = llm_runner
+
+def parse(source: str):
+    # Modules first, scripts (jQuery pages, EJS blocks) tolerate what does not parse
+    try:
+        return esprima.parseModule(source, {'range': True, 'loc': True})
+    except esprima.Error:
+        return esprima.parseScript(source, {'range': True, 'loc': True, 'tolerant': True})
+
+def key_name(key) -> str | None:
+    if key is None:
+        return None
+    if key.type == 'Identifier':
+        return key.name
+    if key.type == 'Literal':
+        return str(key.value)
+    return None
+
+def member_name(node) -> str | None:
+    # obj.prop.name as written, for assignments like `module.exports.handler = function ...`
+    if node.type == 'Identifier':
+        return node.name
+    if node.type == 'ThisExpression':
+        return 'this'
+    if node.type == 'MemberExpression' and not node.computed:
+        base = member_name(node.object)
+        return f"{base}.{node.property.name}" if base else node.property.name
+    return None
+
+def callback_name(call, line: int) -> str:
+    # Anonymous function passed to a call, named after the call: `$('.clone-btn').on('click')` handler
+    callee = member_name(call.callee) or "callback"
+    literals = [str(arg.value) for arg in call.arguments if arg.type == 'Literal' and isinstance(arg.value, str)]
+    return f"{callee}({', '.join(repr(lit) for lit in literals[:2])}) handler@{line}"
+
+def normalized(value):
+    # AST without positions and raw literal spellings, formatting and comments do not change it
+    if isinstance(value, dict):
+        return {key: normalized(item) for key, item in value.items() if key not in ('range', 'loc', 'raw')}
+    if isinstance(value, list):
+        return [normalized(item) for item in value]
+    return value
+
+def ast_hash(node, shape: str | None = None) -> str:
+    # Methods include the shape of their class, a change of its other members can change what they do
+    digest = hashlib.sha256(json.dumps(normalized(node.toDict()), sort_keys=True, default=str).encode()).hexdigest()[:16]
+    return digest if shape is None else hashlib.sha256(f"{shape}:{digest}".encode()).hexdigest()[:16]
+
+def class_hash(node) -> str:
+    # Declaration, heritage and members of the class, without the bodies of its methods
+    tree = normalized(node.toDict())
+    for member in tree['body']['body']:
+        if member.get('type') == 'MethodDefinition' and isinstance(member.get('value'), dict):
+            member['value'] = {key: value for key, value in member['value'].items() if key != 'body'}
+    return hashlib.sha256(json.dumps(tree, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+def children(node):
+    for value in vars(node).values():
+        if isinstance(value, esprima.nodes.Node):
+            yield value
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, esprima.nodes.Node):
+                    yield item
+
+def function_name(node, parent, line_offset: int = 0) -> str:
+    # The name a function is known by: its own, that of the variable, key or member it is assigned to, or its call's
+    name = None
+    if node.id is not None:
+        name = node.id.name
+    elif parent is not None and parent.type == 'VariableDeclarator':
+        name = key_name(parent.id)
+    elif parent is not None and parent.type == 'AssignmentExpression':
+        name = member_name(parent.left)
+    elif parent is not None and parent.type in ('Property', 'MethodDefinition'):
+        name = key_name(parent.key)
+    elif parent is not None and parent.type in ('CallExpression', 'NewExpression'):
+        name = callback_name(parent, node.loc.start.line + line_offset)
+    return name or f"anonymous@{node.loc.start.line + line_offset}"
+
+def script_blocks(source: str, suffix: str) -> list:
+    # (offset, JS) of a JS file, or of every <script> block of a page
+    if suffix in JS_SUFFIXES:
+        return [(0, source)]
+    return [(match.start(1), match.group(1)) for match in SCRIPT_BLOCK.finditer(source)]
+
+def collect(node, parent, scope: list, found: list, line_offset: int = 0, shape: str | None = None):
+    # Outermost functions with their names and the class/object/function they sit in, and the classes
+    if node.type in FUNCTION_TYPES:
+        name = function_name(node, parent, line_offset)
+
+        nested = []
+        for child in children(node):
+            collect(child, node, scope + [name], nested, line_offset, shape)
+        lines = node.loc.end.line - node.loc.start.line + 1
+        if lines > MAX_FUNCTION_LINES and len(nested) > 0:
+            found.extend(nested)
+            return
+
+        # Methods and properties include their key, `async`, `static` & co in the range
+        outer = parent if parent is not None and parent.type in ('Property', 'MethodDefinition', 'VariableDeclarator') else node
+        found.append({
+            'name': name,
+            'hash': ast_hash(node, shape),
+            'kind': 'method' if parent is not None and parent.type == 'MethodDefinition' else
+                    'arrow' if node.type == 'ArrowFunctionExpression' else 'function',
+            'scope': ".".join(scope),
+            'params': [key_name(param) or param.type for param in node.params],
+            'range': [outer.range[0], node.range[1]],
+            'start_line': outer.loc.start.line,
+            'end_line': node.loc.end.line
+        })
+        return
+
+    if node.type in ('ClassDeclaration', 'ClassExpression'):
+        shape = class_hash(node)
+        assigned = node.id is None and parent is not None and parent.type == 'VariableDeclarator'
+        name = node.id.name if node.id is not None else key_name(parent.id) if assigned else None
+        if name is not None:
+            found.append({
+                'name': name,
+                'hash': shape,
+                'kind': 'class',
+                'scope': ".".join(scope[:-1] if assigned else scope),     # The declarator already added the name
+                'params': [],
+                'range': list(node.range),
+                'start_line': node.loc.start.line,
+                'end_line': node.loc.end.line
+            })
+        if node.id is not None:
+            scope = scope + [node.id.name]
+    elif node.type == 'VariableDeclarator' and node.init is not None and node.init.type in ('ObjectExpression', 'ClassExpression'):
+        scope = scope + [key_name(node.id) or "object"]
+
+    for child in children(node):
+        collect(child, node, scope, found, line_offset, shape)
+
+def extract_functions(source: str, suffix: str = '.js') -> dict:
+    """Functions of a JS file, or of the <script> blocks of an EJS/HTML page, with their source ranges.
+
+    The classes are listed apart, for the manifests: their hash covers everything but the method
+    bodies, and is part of the hash of their methods.
+    """
+
+    found = []
+    errors = []
+    for offset, block in script_blocks(source, suffix):
+        line_offset = source.count("\n", 0, offset)
+        try:
+            tree = parse(block)
+        except esprima.Error as excp:
+            errors.append({'line': getattr(excp, 'lineNumber', 0) + line_offset, 'msg': str(excp)})
+            continue
+        for error in getattr(tree, 'errors', None) or []:
+            errors.append({'line': getattr(error, 'lineNumber', 0) + line_offset, 'msg': str(getattr(error, 'description', error))})
+
+        block_found = []
+        collect(tree, None, [], block_found, line_offset)
+        for func in block_found:
+            start, end = func['range']
+            func['source'] = block[start:end]
+            func['range'] = [start + offset, end + offset]
+            func['start_line'] += line_offset
+            func['end_line'] += line_offset
+            found.append(func)
+
+    return {'functions': [func for func in found if func['kind'] != 'class'],
+            'classes': [func for func in found if func['kind'] == 'class'], 'errors': errors}
+
+def source_path(file_path: str, editable: bool = False) -> Path:
+    if file_path.find("..") != -1:
+        raise HTTPException(status_code=403, detail={'msg': "Forbidden access"})
+    filepath = Path(files.OUTPUT_CODE_DIR if editable else files.INPUT_CODE_DIR) / file_path
+    if not filepath.is_file():
+        raise HTTPException(status_code=404, detail={'msg': f"Could not read {filepath.name}"})
+    return filepath
+
+def read_functions(filepath: Path) -> dict:
+    return extract_functions(filepath.read_text(), filepath.suffix.lower())
+
+# Manifests: the functions and classes of every version of a file with the hash of their normalized AST and
+#   the documentation generated for them. They sit next to the versions in OUTPUT_CODE_DIR as
+#   hidden files, those of the original in INPUT_CODE_DIR being version 0, so that the docs of a
+#   function whose AST did not change are reused by every later version
+
+def manifest_path(filepath: Path) -> Path:
+    relative = filepath.relative_to(files.OUTPUT_CODE_DIR if filepath.is_relative_to(files.OUTPUT_CODE_DIR) else files.INPUT_CODE_DIR)
+    return Path(files.OUTPUT_CODE_DIR) / relative.parent / f".{relative.name}.manifest.json"
+
+def unversioned(name: str) -> tuple:
+    # header.2.js -> (header.js, 2), Makefile.3 -> (Makefile, 3), header.js -> (header.js, 0)
+    parts = name.split('.')
+    if len(parts) >= 3 and parts[-2].isdigit():
+        return ".".join(parts[:-2] + parts[-1:]), int(parts[-2])
+    if len(parts) == 2 and parts[-1].isdigit():
+        return parts[0], int(parts[-1])
+    return name, 0
+
+def family_manifests(filepath: Path) -> list:
+    """Manifests of all the versions of the file, newest first."""
+
+    base, _ = unversioned(filepath.name)
+    folder = manifest_path(filepath).parent
+    found = []
+    for path in folder.glob(f".{base.split('.')[0]}*.manifest.json"):
+        name = path.name[1:-len(".manifest.json")]
+        other, version = unversioned(name)
+        if other == base:
+            found.append((version, path))
+    manifests = []
+    for version, path in sorted(found, reverse=True):
+        try:
+            manifests.append(json.loads(path.read_text()))
+        except (OSError, ValueError) as excp:
+            print(f"Skipping unreadable manifest [{path}] [{excp}]")
+    return manifests
+
+def unit_key(func: dict) -> tuple:
+    return (func['scope'], func['name'], func['hash'])
+
+def known_docs(manifests: list) -> dict:
+    # (scope, name, hash) -> {params key -> doc}, the newest version's doc wins. Callbacks are named
+    #   after their line, so the docs are also kept by hash alone for the functions that only moved
+    docs = {}
+    for manifest in reversed(manifests):
+        for unit in manifest['units']:
+            docs.setdefault(unit_key(unit), {}).update(unit.get('docs', {}))
+            docs.setdefault(unit['hash'], {}).update(unit.get('docs', {}))
+    return docs
+
+def unit_docs(docs: dict, func: dict) -> dict:
+    return {**docs.get(func['hash'], {}), **docs.get(unit_key(func), {})}
+
+def write_manifest(filepath: Path, functions: list, docs: dict):
+    _, version = unversioned(filepath.name)
+    manifest = {
+        'file': filepath.name,
+        'version': version,
+        'created': int(time.time()*1000),
+        'units': [{**{key: value for key, value in func.items() if key in ('name', 'scope', 'kind', 'hash', 'start_line', 'end_line')},
+                   'docs': unit_docs(docs, func)} for func in functions]
+    }
+    path = manifest_path(filepath)
+    path.parent.mkdir(mode=0o744, parents=True, exist_ok=True)
+    temp = path.with_name(path.name + ".tmp")
+    temp.write_text(json.dumps(manifest))
+    temp.replace(path)
+
+def diff_manifest(functions: list, previous: dict | None) -> dict:
+    # Compared by scope & name, the hash tells whether a function changed
+    if previous is None:
+        return {'against': None, 'added': [func['name'] for func in functions], 'changed': [], 'removed': [], 'unchanged': 0}
+    before = {(unit['scope'], unit['name']): unit['hash'] for unit in previous['units']}
+    now = {(func['scope'], func['name']): func['hash'] for func in functions}
+    added = {key: digest for key, digest in now.items() if key not in before}
+    removed = {key: digest for key, digest in before.items() if key not in now}
+    moved = set(added.values()) & set(removed.values())     # Callbacks renamed only by their new line
+    return {
+        'against': previous['version'],
+        'added': [name for (scope, name), digest in added.items() if digest not in moved],
+        'changed': [name for (scope, name), digest in now.items() if (scope, name) in before and before[(scope, name)] != digest],
+        'removed': [name for (scope, name), digest in removed.items() if digest not in moved],
+        'unchanged': sum(1 for key, digest in now.items() if before.get(key) == digest or (key in added and digest in moved))
+    }
+
+def update_manifest(filepath: Path) -> dict | None:
+    """Manifest of a newly saved version, carrying over the docs of its unchanged functions. Returns the diff to the previous version."""
+
+    if filepath.suffix.lower() not in JS_SUFFIXES + DOC_PAGE_SUFFIXES:
+        return None
+    extracted = read_functions(filepath)
+    units = extracted['functions'] + extracted['classes']
+    manifests = [manifest for manifest in family_manifests(filepath) if manifest['file'] != filepath.name]
+    write_manifest(filepath, units, known_docs(manifests))
+    return diff_manifest(units, manifests[0] if manifests else None)
+
+def params_key(params) -> str:
+    # Docs are only reused for the same model and instructions, not for other sampling parameters
+    fields = [params.llmID, params.system_prompt, params.context, params.user_prompt, params.max_new_tokens]
+    return hashlib.sha256(json.dumps(fields).encode()).hexdigest()[:16]
+
+def call_context(request: FunctionDocRequest, func: dict) -> str:
+    # Code of what the function calls and what calls it, from the symbol index of the input files
+    from libs import symbols
+    from libs.params import MODELS
+
+    path = Path(request.file_path)
+    try:
+        result = symbols.neighborhood(MODELS.get(request.params.llmID, {}), f"{func['scope']}.{func['name']}" if func['scope'] else func['name'],
+                                      path.with_name(unversioned(path.name)[0]).as_posix())
+    except HTTPException:
+        return ""
+    return symbols.neighborhood_context(result)
+
+async def document_function(request: FunctionDocRequest, func: dict, slots: asyncio.Semaphore) -> dict:
+    # Errors stay with their function, like the items of /llm/batch
+    where = f"Module: {request.file_path}\nFunction: {func['scope'] + '.' if func['scope'] else ''}{func['name']} (lines {func['start_line']}-{func['end_line']})"
+    context = f"{request.params.context}\n\n{where}" if request.params.context else where
+    if request.call_context:
+        related = await run_in_threadpool(call_context, request, func)
+        context = f"{context}\n\n{related}" if related else context
+    params = request.params.model_copy(update={'context': context, 'code_snippet': func['source']})
+    summary = {key: value for key, value in func.items() if key != 'source'}
+    async with slots:
+        try:
+            return {**summary, **(await runner(params)), 'reused': False}
+        except HTTPException as excp:
+            msg = excp.detail.get('msg') if isinstance(excp.detail, dict) else str(excp.detail)
+            return {**summary, 'error': msg, 'status': excp.status_code}
+        except Exception as excp:
+            return {**summary, 'error': str(excp)}
+
+async def document_functions(request: FunctionDocRequest) -> dict:
+    start = time.perf_counter()
+    filepath = source_path(request.file_path, request.editable)
+    extracted = await run_in_threadpool(read_functions, filepath)
+    functions = extracted['functions']
+    if request.functions is not None:
+        functions = [func for func in functions if func['name'] in request.functions]
+
+    key = params_key(request.params)
+    docs = {}
+    if request.incremental:
+        docs = await run_in_threadpool(lambda: known_docs(family_manifests(filepath)))
+
+    parallelism = MAX_PARALLELISM
+    if request.parallelism is not None and request.parallelism > 0:
+        parallelism = min(request.parallelism, MAX_PARALLELISM)
+    slots = asyncio.Semaphore(parallelism)
+
+    async def reuse(func: dict) -> dict:
+        return {**{k: v for k, v in func.items() if k != 'source'}, 'model_resp': unit_docs(docs, func)[key]['model_resp'], 'reused': True}
+
+    results = await asyncio.gather(*[reuse(func) if key in unit_docs(docs, func) else document_function(request, func, slots)
+                                     for func in functions])
+
+    # Remember what was generated for this version, next to the docs kept for the other functions
+    for func, result in zip(functions, results):
+        if 'error' not in result:
+            docs.setdefault(unit_key(func), {})[key] = {'model_resp': result['model_resp'], 'tm': int(time.time()*1000)}
+    try:
+        await run_in_threadpool(write_manifest, filepath, extracted['functions'] + extracted['classes'], docs)
+    except OSError as excp:
+        print(f"Writing the manifest of [{filepath}] failed [{excp}]")
+
+    return {'file_path': request.file_path, 'functions': results, 'errors': extracted['errors'],
+            'reused': sum(1 for result in results if result.get('reused')),
+            'total_ms': round((time.perf_counter() - start)*1000, 1)}
+
+@router.get("/functions/{file_path:path}")
+def get_functions(file_path: str, current_user: Annotated[User, Depends(get_current_active_user)],
+                  editable: bool = False) -> dict:
+    filepath = source_path(file_path, editable)
+    extracted = read_functions(filepath)
+    previous = [manifest for manifest in family_manifests(filepath) if manifest['version'] < unversioned(filepath.name)[1]]
+    return {'file_path': file_path,
+            'functions': [{key: value for key, value in func.items() if key != 'source'} for func in extracted['functions']],
+            'classes': [{key: value for key, value in cls.items() if key != 'source'} for cls in extracted['classes']],
+            'diff': diff_manifest(extracted['functions'] + extracted['classes'], previous[0] if previous else None),
+            'errors': extracted['errors']}
+
+@router.post("/functions/")
+async def document_file_functions(request: FunctionDocRequest,
+                                  current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    scheduler.classify(Priority.BATCH, current_user.username)
+    return await document_functions(request)
+
+
+if __name__ == '__main__':
+  print ('Cannot execute as a program, it is a module')
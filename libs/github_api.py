@@ -29,6 +29,8 @@ from github    import Github
 from github    import Auth
 from github    import InputGitAuthor
 
+from libs.metrics import timed, GITHUB_SECONDS
+
 __all__ = []
 
 class GithubAPI:
@@ -45,6 +47,7 @@ class GithubAPI:
   def close(self):
     self.git.close()
   
+  @timed(GITHUB_SECONDS, 'get_repos')
   def get_repos(self):
     all_repos = []
     for repo in self.git.get_user().get_repos():
@@ -52,6 +55,7 @@ class GithubAPI:
 
     return all_repos
 
+  @timed(GITHUB_SECONDS, 'get_full_dirtree')
   def get_full_dirtree(self, reponame: str, branch: str):
     repo = self.git.get_repo(reponame)
     contents = repo.get_contents("")
@@ -65,6 +69,7 @@ class GithubAPI:
 
     return dirtree
 
+  @timed(GITHUB_SECONDS, 'get_file_contents')
   def get_file_contents(self, reponame: str, filename: str, branch: str):
     # throws Exception. exp.status == 404 (Not found)
     repo = self.git.get_repo(reponame)
@@ -72,6 +77,7 @@ class GithubAPI:
 
     return contents.decoded_content.decode('utf-8')   # decoded from base64 as bytes b'file contents.....'
 
+  @timed(GITHUB_SECONDS, 'create_new_file')
   def create_new_file(self, reponame: str, filename: str, contents: str | bytes, branch: str, 
     commitmsg: str, committername: str, committeremail: str):
     committer = InputGitAuthor(committername, committeremail)
@@ -80,6 +86,7 @@ class GithubAPI:
 
     return resp["commit"].sha  # commit hash
 
+  @timed(GITHUB_SECONDS, 'update_file')
   def update_file(self, reponame: str, filename: str, new_contents: str | bytes, branch: str, 
     commitmsg: str, committername: str, committeremail: str):
     # throws Exception. exp.status == 404 (Not found)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+import os
+import json
+import time
+import socket
+import asyncio
+from typing              import Annotated
+
+from fastapi             import Depends, APIRouter, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from sse_starlette.sse   import EventSourceResponse
+
+from libs.data           import LLMParams
+from libs.auth           import get_current_active_user, User, sqlite_dbname
+from libs.user_db        import UserDatabase, JobsDatabase, JobStatus
+from libs                import scheduler
+from libs.scheduler      import Priority
+
+__all__ = ["router", "configure", "start", "stop", "JOB_CONCURRENCY"]
+
+JOB_CONCURRENCY = 4     # Jobs a single worker runs at the same time
+POLL_SECONDS = 2        # Check for jobs submitted to the other workers this often
+HEARTBEAT_SECONDS = 5   # Running jobs are marked alive, and checked for cancellation, this often
+STALE_SECONDS = 60      # A running job not marked alive for this long lost its worker
+MAX_ATTEMPTS = 3        # Runs of a job whose worker keeps dying before it is failed
+EVENT_POLL_SECONDS = 1
+
+router = APIRouter()
+runner = None           # Coroutine function turning LLMParams into the result of the job
+owner = None            # This worker process, set once the job loops start (after any fork)
+running = {}            # Claim token -> (job ID, task running it in this worker)
+wakeup = None
+
+def configure(concurrency: int, job_runner):
+    global JOB_CONCURRENCY, runner
+
+    JOB_CONCURRENCY = concurrency
+    runner = job_runner
+
+def get_user_id(username: str) -> int:
+    user_id = UserDatabase(sqlite_dbname).get_user_id_by_username(username)
+    if user_id is None:
+        raise HTTPException(status_code=404, detail={'msg':f"No user found with name [{username}]"})
+    return user_id
+
+def job_username(user_id: int) -> str | None:
+    # Who the job's LLM calls are queued for, next to the user's own requests
+    credentials = UserDatabase(sqlite_dbname).get_user_credentials_by_userid(user_id)
+    return credentials.username if credentials is not None else None
+
+def get_job(job_id: str, username: str) -> dict:
+    job = JobsDatabase(sqlite_dbname).get_job(job_id, get_user_id(username))
+    if job is None:
+        raise HTTPException(status_code=404, detail={'msg':f"Job [{job_id}] not found"})
+    return job
+
+def job_response(job: dict) -> dict:
+    return {
+        'id': job['id'],
+        'status': job['status'],
+        'created': job['created'],
+        'updated': job['updated'],
+        'attempts': job['attempts'],
+        'params': json.loads(job['params']),
+        'result': json.loads(job['result']) if job['result'] else None,
+        'error': job['error']
+    }
+
+def start() -> list:
+    """Start the loops running the jobs in this worker, returns their tasks for the caller to hold on to."""
+
+    global owner, wakeup
+
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    wakeup = asyncio.Event()
+    return [asyncio.create_task(pump()), asyncio.create_task(heartbeat())]
+
+async def stop():
+    # Jobs cut short by the shutdown go back to the queue for the other (or the next) workers
+    tasks = [task for job_id, task in running.values()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if owner is not None:
+        requeued = await run_in_threadpool(lambda: JobsDatabase(sqlite_dbname).requeue_jobs(owner))
+        if requeued:
+            print(f"Requeued [{requeued}] jobs of worker [{owner}]")
+
+async def pump():
+    # Claim jobs while there is a free slot, then sleep until a job ends, one is submitted or the poll interval
+    while True:
+        try:
+            while len(running) < JOB_CONCURRENCY:
+                # A job cancelled and retried may still be winding down here, it is not run twice
+                busy = [job_id for job_id, task in running.values()]
+                job = await run_in_threadpool(lambda: JobsDatabase(sqlite_dbname).claim_job(
+                    owner, int((time.time() - STALE_SECONDS)*1000), MAX_ATTEMPTS, busy))
+                if job is None:
+                    break
+                task = asyncio.create_task(run_job(job))
+                running[job['claim']] = (job['id'], task)
+                # Also when cancelled before it started, run_job never runs to clean up then
+                task.add_done_callback(lambda task, claim=job['claim']: job_done(claim, task))
+        except Exception as excp:
+            print(f"Claiming jobs failed [{excp}]")
+
+        try:
+            await asyncio.wait_for(wakeup.wait(), POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
+
+def job_done(claim: str, task: asyncio.Task):
+    if running.get(claim, (None, None))[1] is task:
+        del running[claim]
+    wakeup.set()
+
+async def heartbeat():
+    while True:
+        await asyncio.sleep(HEARTBEAT_SECONDS)
+        try:
+            lost = await run_in_threadpool(lambda: JobsDatabase(sqlite_dbname).heartbeat(list(running.keys())))
+        except Exception as excp:
+            print(f"Job heartbeat failed [{excp}]")
+            continue
+        for claim in lost:
+            job_id, task = running.get(claim, (None, None))
+            if task is not None:
+                task.cancel()
+
+async def run_job(job: dict):
+    try:
+        params = LLMParams.model_validate_json(job['params'])
+        scheduler.classify(Priority.BATCH, await run_in_threadpool(job_username, job['user_id']))
+        result = await runner(params)
+        status, result, error = JobStatus.DONE, json.dumps(result), None
+    except asyncio.CancelledError:
+        return      # Cancelled by its user, or the worker is stopping and requeues it
+    except HTTPException as excp:
+        msg = excp.detail.get('msg') if isinstance(excp.detail, dict) else str(excp.detail)
+        status, result, error = JobStatus.FAILED, None, msg
+    except Exception as excp:
+        status, result, error = JobStatus.FAILED, None, str(excp)
+
+    await run_in_threadpool(lambda: JobsDatabase(sqlite_dbname).finish_job(job['id'], job['claim'], status, result, error))
+
+async def job_events(job_id: str, username: str):
+    # 'status' whenever the job changes, then a final 'result' with the whole job once it is over
+    last = None
+    while True:
+        job = await run_in_threadpool(get_job, job_id, username)
+        if job['status'] in (JobStatus.DONE, JobStatus.FAILED, JobStatus.CANCELLED):
+            yield {'event': 'result', 'data': json.dumps(job_response(job))}
+            return
+        if (job['status'], job['attempts']) != last:
+            last = (job['status'], job['attempts'])
+            yield {'event': 'status', 'data': json.dumps({'id': job_id, 'status': job['status'], 'attempts': job['attempts']})}
+        await asyncio.sleep(EVENT_POLL_SECONDS)
+
+@router.post("/jobs/")
+async def submit_job(params: LLMParams,
+                     current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    user_id = await run_in_threadpool(get_user_id, current_user.username)
+    job_id = await run_in_threadpool(lambda: JobsDatabase(sqlite_dbname).add_job(user_id, params.model_dump_json()))
+    if wakeup is not None:
+        wakeup.set()
+    return {'id': job_id, 'status': JobStatus.QUEUED}
+
+@router.get("/jobs/")
+def get_jobs(current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    return {'jobs': JobsDatabase(sqlite_dbname).get_jobs(get_user_id(current_user.username))}
+
+@router.get("/jobs/{job_id}")
+def get_job_status(job_id: str, current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    return job_response(get_job(job_id, current_user.username))
+
+@router.get("/jobs/{job_id}/events")
+def subscribe_job(job_id: str, current_user: Annotated[User, Depends(get_current_active_user)]):
+    get_job(job_id, current_user.username)
+    return EventSourceResponse(job_events(job_id, current_user.username))
+
+@router.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str, current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    user_id = await run_in_threadpool(get_user_id, current_user.username)
+    cancelled = await run_in_threadpool(lambda: JobsDatabase(sqlite_dbname).cancel_job(job_id, user_id))
+    if cancelled == 0:
+        job = await run_in_threadpool(get_job, job_id, current_user.username)
+        raise HTTPException(status_code=409, detail={'msg':f"Job [{job_id}] is already {job['status']}"})
+
+    # Running here it stops now, another worker stops it at its next heartbeat
+    for running_id, task in list(running.values()):
+        if running_id == job_id:
+            task.cancel()
+    return {'id': job_id, 'status': JobStatus.CANCELLED}
+
+@router.post("/jobs/{job_id}/retry")
+async def retry_job(job_id: str, current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    user_id = await run_in_threadpool(get_user_id, current_user.username)
+    retried = await run_in_threadpool(lambda: JobsDatabase(sqlite_dbname).retry_job(job_id, user_id))
+    if retried == 0:
+        job = await run_in_threadpool(get_job, job_id, current_user.username)
+        raise HTTPException(status_code=409, detail={'msg':f"Job [{job_id}] is {job['status']}, only failed or cancelled jobs can be retried"})
+
+    if wakeup is not None:
+        wakeup.set()
+    return {'id': job_id, 'status': JobStatus.QUEUED}
+
+
+if __name__ == '__main__':
+  print ('Cannot execute as a program, it is a module')
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import hashlib
+import threading
+from typing              import Annotated
+from contextlib          import asynccontextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None        # No file locks (Windows), requests are then only coalesced within a worker
+
+from fastapi             import Depends, APIRouter
+from langchain.schema    import BaseMessage
+
+from libs.auth           import get_current_active_user, User
+from libs.metrics        import timed_connection
+
+__all__ = ["router", "ResponseCache", "configure", "get_cache", "flusher", "flush", "CACHE_MAX_TEMPERATURE"]
+
+CACHE_MAX_TEMPERATURE = 0.2     # Above this the user wants variety, a cached answer would defeat it
+LOCK_POLL = 0.05                # Seconds between attempts on a flight lock held by another worker
+LOCK_MAX_AGE = 3600             # Lock files untouched this long are removed by the sweep
+LOCK_SWEEP_SECONDS = 600        # How often the lock files are swept
+FLUSH_SECONDS = 5               # The hit & miss counters and access times are written this often
+
+cache = None
+settings = {'db_name': None, 'ttl': 0, 'max_entries': 0}
+settings_lock = threading.Lock()
+router = APIRouter()
+
+class ResponseCache:
+    """LLM responses shared by all the workers through a SQLite file.
+
+    Entries expire `ttl` seconds after they were stored and once there are more than
+    `max_entries` the least recently used ones are evicted. Lookups only read, the counters and
+    the access times they update are kept in memory and written in batches by flush().
+    """
+
+    def __init__(self, db_name, ttl=7*24*3600, max_entries=10000):
+        self.db_name = db_name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0         # Counters of this worker, the table has the totals of all workers
+        self.misses = 0
+        self.pending = {'hits': 0, 'misses': 0}     # Not yet added to the table
+        self.accessed = {}    # Key -> [last access, hits] not yet written
+        self.swept = 0.0
+        self.lock = threading.Lock()
+        self.lock_dir = db_name + ".locks"
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self.conn = timed_connection(sqlite3.connect(db_name, check_same_thread=False, timeout=10), db_name)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.cursor = self.conn.cursor()
+        self.create_tables()
+
+    def create_tables(self):
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                llm_id TEXT,
+                created INTEGER,
+                accessed INTEGER,
+                hits INTEGER,
+                response TEXT
+            )
+        ''')
+
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS accessed_idx ON llm_cache (
+                accessed
+            )
+        ''')
+
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS llm_cache_stats (
+                name TEXT PRIMARY KEY,
+                value INTEGER
+            )
+        ''')
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(model_obj: dict, sampling: dict, message) -> str:
+        # The resolved model, the sampling parameters and the fully formatted prompt decide the answer
+        if isinstance(message, list):
+            message = [[msg.type, msg.content] if isinstance(msg, BaseMessage) else msg for msg in message]
+        elif isinstance(message, BaseMessage):
+            message = [message.type, message.content]
+
+        data = json.dumps({
+            'provider': model_obj['provider'],
+            'model': model_obj['id_for_prvdr'],
+            'endpoint': model_obj.get('endpoint'),
+            'sampling': sampling,
+            'message': message
+        }, sort_keys=True, default=str)
+
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        now = int(time.time())
+        with self.lock:
+            self.cursor.execute('SELECT created, response FROM llm_cache WHERE key = ?', (key,))
+            row = self.cursor.fetchone()
+            if row and row[0] + self.ttl < now:
+                row = None      # Deleted by the next eviction
+
+            if row:
+                self.hits += 1
+                self.pending['hits'] += 1
+                access = self.accessed.setdefault(key, [now, 0])
+                access[0] = now
+                access[1] += 1
+            else:
+                self.misses += 1
+                self.pending['misses'] += 1
+
+        return row[1] if row else None
+
+    def put(self, key: str, llmID: str, response: str):
+        now = int(time.time())
+        with self.lock:
+            self.cursor.execute("INSERT OR REPLACE INTO llm_cache ('key', 'llm_id', 'created', 'accessed', 'hits', 'response') VALUES (?, ?, ?, ?, 0, ?)",
+                                (key, llmID, now, now, response))
+            self.evict(now)
+            self.conn.commit()
+
+    def evict(self, now: int):
+        self.cursor.execute('DELETE FROM llm_cache WHERE created < ?', (now - self.ttl,))
+        self.cursor.execute('''
+            DELETE FROM llm_cache WHERE key IN (
+                SELECT key FROM llm_cache ORDER BY accessed DESC LIMIT -1 OFFSET ?
+            )
+        ''', (self.max_entries,))
+        if self.cursor.rowcount > 0:
+            self.count_stat('evictions', self.cursor.rowcount)
+
+    def flush(self):
+        """Write the counters and access times of the lookups since the last flush, and now and then sweep the lock files."""
+
+        now = time.time()
+        with self.lock:
+            pending, self.pending = self.pending, {'hits': 0, 'misses': 0}
+            accessed, self.accessed = self.accessed, {}
+            if any(pending.values()) or accessed:
+                try:
+                    self.cursor.executemany('UPDATE llm_cache SET accessed = max(accessed, ?), hits = hits + ? WHERE key = ?',
+                                            [(access, hits, key) for key, (access, hits) in accessed.items()])
+                    for name, count in pending.items():
+                        if count > 0:
+                            self.count_stat(name, count)
+                    self.conn.commit()
+                except sqlite3.Error:
+                    self.conn.rollback()
+                    # Kept for the next flush
+                    for name, count in pending.items():
+                        self.pending[name] += count
+                    for key, (access, hits) in accessed.items():
+                        current = self.accessed.setdefault(key, [access, 0])
+                        current[1] += hits
+                    raise
+
+        if now - self.swept > LOCK_SWEEP_SECONDS:
+            self.swept = now
+            for entry in os.scandir(self.lock_dir):
+                try:
+                    if entry.stat().st_mtime < now - LOCK_MAX_AGE:
+                        os.unlink(entry.path)
+                except OSError:
+                    pass    # Gone already or in use, next time
+
+    def count_stat(self, name: str, count: int = 1):
+        self.cursor.execute("INSERT INTO llm_cache_stats ('name', 'value') VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?",
+                            (name, count, count))
+
+    @asynccontextmanager
+    async def flight_lock(self, key: str):
+        """Exclusive across the workers for one cache key, yields True if another worker held it first.
+
+        The holder generates the response and stores it, whoever waited finds it in the cache.
+        """
+
+        if fcntl is None:
+            yield False
+            return
+
+        waited = False
+        with open(os.path.join(self.lock_dir, key), 'a') as lock_file:
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    waited = True
+                    await asyncio.sleep(LOCK_POLL)
+            try:
+                os.utime(lock_file.name)
+                yield waited
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def clear(self) -> int:
+        with self.lock:
+            self.cursor.execute('DELETE FROM llm_cache')
+            self.conn.commit()
+            return self.cursor.rowcount
+
+    def stats(self) -> dict:
+        with self.lock:
+            self.cursor.execute('SELECT name, value FROM llm_cache_stats')
+            totals = dict(self.cursor.fetchall())
+            self.cursor.execute('SELECT count(*) FROM llm_cache')
+            entries = self.cursor.fetchone()[0]
+
+        return {
+            'entries': entries,
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'worker': {'hits': self.hits, 'misses': self.misses},
+            'total': {
+                'hits': totals.get('hits', 0) + self.pending['hits'],
+                'misses': totals.get('misses', 0) + self.pending['misses'],
+                'evictions': totals.get('evictions', 0)
+            }
+        }
+
+def configure(db_name: str, ttl: int, max_entries: int):
+    global cache
+
+    # The database is opened on first use, in the worker process that uses it
+    settings.update({'db_name': db_name, 'ttl': ttl, 'max_entries': max_entries})
+    cache = None
+
+def get_cache() -> ResponseCache | None:
+    global cache
+
+    if cache is None and settings['max_entries'] > 0:      # 0 is caching disabled
+        with settings_lock:
+            if cache is None:
+                cache = ResponseCache(settings['db_name'], settings['ttl'], settings['max_entries'])
+    return cache
+
+async def flush():
+    if cache is None:
+        return
+    try:
+        await asyncio.to_thread(cache.flush)
+    except Exception as excp:
+        print(f"Writing the cache counters failed [{excp}], keeping them for the next flush")
+
+async def flusher():
+    while True:
+        await asyncio.sleep(FLUSH_SECONDS)
+        await flush()
+
+@router.get("/cache/stats/")
+def get_cache_stats(current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    if get_cache() is None:
+        return {'enabled': False}
+    return {'enabled': True, **cache.stats()}
+
+
+if __name__ == '__main__':
+  print ('Cannot execute as a program, it is a module')
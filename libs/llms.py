@@ -23,19 +23,53 @@ __version__ = "0.1"
 __author__  = "Shalin Garg"
 
 import os
-from typing import Any, Dict, List, Mapping, Optional
+import asyncio
+import threading
+from typing import Any, AsyncIterator, Dict, Iterator, List, Mapping, Optional
 
-from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.callbacks.manager import CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun
 from langchain.llms.base import LLM
 from langchain.llms.utils import enforce_stop_tokens
 from langchain.pydantic_v1 import Extra, root_validator
 from langchain.utils import get_from_dict_or_env
+from langchain_core.outputs import GenerationChunk
 from gradio_client import Client
 
-__all__ = ["EnvVars", "HuggingFaceSpaces"]
+__all__ = ["EnvVars", "HuggingFaceSpaces", "get_space_client"]
 
 DEFAULT_REPO_ID = "gpt2"
 VALID_TASKS = ("text2text-generation", "text-generation", "summarization")
+SPACE_WORKERS = 8           # Predictions a Space client runs at the same time
+STREAM_POLL_SECONDS = 0.02  # How often a streamed job is checked for new outputs
+
+space_clients = {}          # (repo_id, token) -> Client shared by every model on the Space
+space_slots = {}            # (repo_id, token) -> semaphore of its predictions in flight
+space_clients_lock = threading.Lock()
+
+def get_space_client(repo_id: str, token: str | None, max_workers: int = SPACE_WORKERS) -> tuple:
+    """Gradio client of the Space (a repo ID or the URL of any Gradio app) and its prediction slots,
+    connected once per process.
+
+    Connecting fetches the config and API schema of the Space and starts a heartbeat thread. The
+    client is thread safe, its pool runs the predictions and also the reader of the event stream
+    they wait on: a job must hold a slot, so that the reader always has a thread left.
+    """
+
+    key = (repo_id, token)
+    if key in space_clients:
+        return space_clients[key], space_slots[key]
+
+    with space_clients_lock:
+        if key not in space_clients:
+            client = Client(repo_id, token, max_workers=max_workers + 1, verbose=False)
+            if client.session_hash is None:
+                raise ValueError(
+                    f"Got invalid spaces name {repo_id}"
+                )
+            space_slots[key] = threading.BoundedSemaphore(max_workers)
+            space_clients[key] = client
+
+    return space_clients[key], space_slots[key]
 
 class EnvVars:
     @classmethod
@@ -81,6 +115,7 @@ class HuggingFaceSpaces(LLM):
     """
 
     client: Any  #: :meta private:
+    slots: Any  #: :meta private:
     repo_id: str = DEFAULT_REPO_ID
     """Model name to use."""
 
@@ -93,6 +128,9 @@ class HuggingFaceSpaces(LLM):
 
     huggingfacehub_api_token: Optional[str] = None
 
+    max_workers: int = SPACE_WORKERS
+    """Predictions run concurrently against the Space, fixed by the first model connecting to it."""
+
     class Config:
         """Configuration for this pydantic object."""
 
@@ -106,18 +144,7 @@ class HuggingFaceSpaces(LLM):
             values, "huggingfacehub_api_token", "HUGGINGFACEHUB_API_TOKEN", "default"
         )
 
-        repo_id = values["repo_id"]
-        client = Client(
-            repo_id,
-            huggingfacehub_api_token
-        )
-
-        if client.session_hash is None:
-            raise ValueError(
-                f"Got invalid spaces name {repo_id}"
-            )
-        
-        values["client"] = client
+        values["client"], values["slots"] = get_space_client(values["repo_id"], huggingfacehub_api_token, values["max_workers"])
 
         return values
 
@@ -160,19 +187,111 @@ class HuggingFaceSpaces(LLM):
                 response = hf("Tell me a joke.")
         """
 
+        self.slots.acquire()
+        return self.generated_text(prompt, self.submit(prompt, kwargs).result(), stop)
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        job = await self.asubmit(prompt, kwargs)
+        try:
+            response = await asyncio.wrap_future(job.future)
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
+        return self.generated_text(prompt, response, stop)
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[GenerationChunk]:
+        self.slots.acquire()
+        job = self.submit(prompt, kwargs)
+        text = ""
+        try:
+            for output in job:
+                piece, text, stopped = self.next_piece(prompt, output, text, stop)
+                if len(piece) > 0:
+                    chunk = GenerationChunk(text=piece)
+                    if run_manager:
+                        run_manager.on_llm_new_token(piece, chunk=chunk)
+                    yield chunk
+                if stopped:
+                    return
+            job.result()    # Raises what the Space raised
+        finally:
+            if not job.done():
+                job.cancel()
+
+    async def _astream(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> AsyncIterator[GenerationChunk]:
+        # The job collects the outputs of a generator endpoint on a client thread as they come in
+        job = await self.asubmit(prompt, kwargs)
+        text = ""
+        seen = 0
+        try:
+            while True:
+                finished = job.done()
+                outputs = job.outputs()
+                for output in outputs[seen:]:
+                    piece, text, stopped = self.next_piece(prompt, output, text, stop)
+                    if len(piece) > 0:
+                        chunk = GenerationChunk(text=piece)
+                        if run_manager:
+                            await run_manager.on_llm_new_token(piece, chunk=chunk)
+                        yield chunk
+                    if stopped:
+                        return
+                seen = len(outputs)
+                if finished:
+                    break
+                await asyncio.sleep(STREAM_POLL_SECONDS)
+            job.result()
+        finally:
+            if not job.done():
+                job.cancel()
+
+    async def asubmit(self, prompt: str, kwargs: dict):
+        # Rarely contended, the LLM slots of libs.dispatch come first. The slots are shared with the
+        #   sync calls and released on client threads, so they are waited for on a thread too
+        acquiring = asyncio.ensure_future(asyncio.to_thread(self.slots.acquire))
+        try:
+            await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            # The thread still gets the slot, it goes back as soon as it does
+            acquiring.add_done_callback(lambda _: self.slots.release())
+            raise
+        return self.submit(prompt, kwargs)
+
+    def submit(self, prompt: str, kwargs: dict):
+        """Start the prediction on the Space, holding a slot acquired by the caller until it is done.
+
+        The model_kwargs are the inputs of the Space in order after the prompt.
+        """
+
+        try:
+            job = self.start(prompt, kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        job.future.add_done_callback(lambda _: self.slots.release())
+        return job
+
+    def start(self, prompt: str, kwargs: dict):
         _model_kwargs = self.model_kwargs or {}
-        params = {'input':prompt, **_model_kwargs, **kwargs}
-        #print(*tuple(params.values()))
+        # Sampling parameters bound per call replace the model's values, the Space takes no others
+        params = {'input':prompt, **_model_kwargs, **{k: v for k, v in kwargs.items() if k in _model_kwargs}}
 
         if 'api_name' in params:
             api_name = params.pop('api_name')
-            response = self.client.predict(*params.values(), api_name=api_name)
+            return self.client.submit(*params.values(), api_name=api_name)
         elif 'fn_index' in params:
             fn_index = params.pop('fn_index')
-            response = self.client.predict(*params.values(), fn_index=fn_index)
+            return self.client.submit(*params.values(), fn_index=fn_index)
         else:
             raise ValueError(f"api_name or fn_name required as params")
 
+    def generated_text(self, prompt: str, response: Any, stop: Optional[List[str]] = None) -> str:
         if "error" in response and not isinstance(response, str):
             raise ValueError(f"Error raised by Gradio API: {response['error']}")
 
@@ -196,6 +315,21 @@ class HuggingFaceSpaces(LLM):
             text = enforce_stop_tokens(text, stop)
         return text
 
+    def next_piece(self, prompt: str, output: Any, text: str, stop: Optional[List[str]]) -> tuple:
+        # Generator endpoints emit the whole text so far, returns what is new, the text and whether a stop word was hit
+        if isinstance(output, Exception):
+            raise output
+        full = self.generated_text(prompt, output)
+        stopped = False
+        if stop is not None:
+            cut = enforce_stop_tokens(full, stop)
+            stopped = len(cut) < len(full)
+            full = cut
+        if not full.startswith(text):
+            # Not a continuation, the Space rewrote its output: only what follows the common part can still go out
+            common = len(os.path.commonprefix([full, text]))
+            return full[common:], full, stopped
+        return full[len(text):], full, stopped
 
 if __name__ == '__main__':
   print ('Cannot execute as a program, it is a module')
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+import os
+import time
+import atexit
+import shutil
+import asyncio
+import tempfile
+import functools
+from contextlib          import contextmanager
+
+# Every Worker writes its samples to files in this directory and /metrics adds them all up. It must
+#   be set before prometheus_client is imported, the first process to get here picks a fresh one
+#   for the run and the Workers it starts inherit it
+if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix="codedoc_metrics_")
+    atexit.register(shutil.rmtree, os.environ['PROMETHEUS_MULTIPROC_DIR'], True)
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+from prometheus_client   import CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+from prometheus_client   import generate_latest, CONTENT_TYPE_LATEST
+from fastapi             import APIRouter, Request, Response
+
+__all__ = ["router", "instrument", "timed", "timed_connection", "monitor_event_loop", "mark_process_dead"]
+
+# LLM calls take seconds to minutes, the default buckets stop at 10s
+LLM_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120, 300)
+IO_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+HTTP_SECONDS = Histogram('codedoc_http_request_seconds', "Latency of HTTP requests per route",
+                         ['method', 'route', 'status'], buckets=LLM_BUCKETS)
+HTTP_IN_FLIGHT = Gauge('codedoc_http_requests_in_flight', "HTTP requests being handled",
+                       multiprocess_mode='livesum')
+LLM_SECONDS = Histogram('codedoc_llm_request_seconds', "Latency of LLM requests per model, cache and queueing included",
+                        ['model', 'mode', 'source'], buckets=LLM_BUCKETS)
+PROVIDER_SECONDS = Histogram('codedoc_provider_seconds', "Total latency of the provider calls",
+                             ['model', 'backend', 'mode'], buckets=LLM_BUCKETS)
+PROVIDER_TTFT = Histogram('codedoc_provider_ttft_seconds', "Provider time to first token",
+                          ['model', 'backend', 'mode'], buckets=LLM_BUCKETS)
+PROVIDER_ERRORS = Counter('codedoc_provider_errors', "Failed provider calls",
+                          ['model', 'backend', 'error'])
+PROMPT_TOKENS = Counter('codedoc_prompt_tokens', "Prompt tokens sent to the providers", ['model'])
+COMPLETION_TOKENS = Counter('codedoc_completion_tokens', "Completion tokens received from the providers", ['model'])
+LLM_IN_FLIGHT = Gauge('codedoc_llm_in_flight', "Provider calls running", ['model'],
+                      multiprocess_mode='livesum')
+LLM_QUEUED = Gauge('codedoc_llm_queued', "LLM calls waiting for rate limit budget or a concurrency slot", ['model'],
+                   multiprocess_mode='livesum')
+SCHEDULER_WAIT = Histogram('codedoc_scheduler_wait_seconds', "Wait for a provider slot per priority class",
+                           ['priority'], buckets=LLM_BUCKETS)
+SQLITE_SECONDS = Histogram('codedoc_sqlite_seconds', "Latency of SQLite statements and commits",
+                           ['db', 'operation'], buckets=IO_BUCKETS)
+GITHUB_SECONDS = Histogram('codedoc_github_seconds', "Latency of GitHub API calls",
+                           ['operation'], buckets=LLM_BUCKETS)
+LOOP_LAG = Histogram('codedoc_event_loop_lag_seconds', "How late the event loop runs a timer, busy loop when high",
+                     buckets=IO_BUCKETS)
+
+LOOP_INTERVAL = 0.5     # Seconds between event loop lag probes
+
+router = APIRouter()
+
+async def instrument(request: Request, call_next):
+    """HTTP middleware timing every request against its route template, not the raw path."""
+
+    HTTP_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        HTTP_IN_FLIGHT.dec()
+        route = request.scope.get('route')
+        path = getattr(route, 'path', None) or ("static" if request.url.path.startswith("/html") else "unmatched")
+        HTTP_SECONDS.labels(request.method, path, str(status)).observe(time.perf_counter() - start)
+
+def timed(histogram: Histogram, *labels):
+    """Decorator observing the duration of every call of the function, exceptions included."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.labels(*labels).observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+class TimedCursor:
+    """sqlite3 cursor timing each statement, labelled by its verb (SELECT, INSERT...)."""
+
+    def __init__(self, cursor, db: str):
+        self.cursor = cursor
+        self.db = db
+
+    def execute(self, sql: str, *args):
+        start = time.perf_counter()
+        try:
+            return self.cursor.execute(sql, *args)
+        finally:
+            operation = sql.split(None, 1)[0].upper() if sql.strip() else "EMPTY"
+            SQLITE_SECONDS.labels(self.db, operation).observe(time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+class TimedConnection:
+    def __init__(self, conn, db: str):
+        self.conn = conn
+        self.db = db
+
+    def cursor(self):
+        return TimedCursor(self.conn.cursor(), self.db)
+
+    def execute(self, sql: str, *args):
+        return self.cursor().execute(sql, *args)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return self.conn.commit()
+        finally:
+            SQLITE_SECONDS.labels(self.db, "COMMIT").observe(time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+def timed_connection(conn, db_name: str) -> TimedConnection:
+    return TimedConnection(conn, os.path.basename(db_name))
+
+async def monitor_event_loop():
+    # A timer due in LOOP_INTERVAL that fires later shows the loop was busy running something else
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LOOP_INTERVAL)
+        LOOP_LAG.observe(max(0.0, time.perf_counter() - start - LOOP_INTERVAL))
+
+def mark_process_dead(pid: int):
+    # Drops the gauges of a Worker that exited, its counters & histograms stay in the totals
+    multiprocess.mark_process_dead(pid)
+
+@router.get("/metrics")
+def get_metrics() -> Response:
+    # Prometheus text format, summed over all the Workers of this server
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+
+if __name__ == '__main__':
+  print ('Cannot execute as a program, it is a module')
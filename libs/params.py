@@ -38,7 +38,8 @@ from typing import Annotated
 
 __all__ = ["router", "MODELS"]
 
-keys_to_remove = ['api-key', 'id_for_prvdr', 'api_name', 'fn_index', 'enabled']
+keys_to_remove = ['api-key', 'id_for_prvdr', 'api_name', 'fn_index', 'enabled', 'rpm', 'tpm', 'backends', 'hedge', 'cassette', 'wraps',
+                  'mode', 'latency', 'chunk_delay']
 MODELS_FOR_UI = None
 MODELS = {
     'code_llama_playground': {
@@ -46,6 +47,7 @@ MODELS = {
         'id_for_prvdr': 'codellama/codellama-playground', 
         'name': 'Code Llama Playground',
         'code': 'CLP',
+        'context_window': 16384,
         'api-key': None,
         'provider': 'HuggingFaceSpaces',
         'model_kwargs': {
@@ -61,6 +63,7 @@ MODELS = {
         'id_for_prvdr': 'huggingface-projects/llama-2-7b-chat',
         'name': 'Llama2 7B',
         'code': 'L27B',
+        'context_window': 4096,
         'api-key': None,
         'provider': 'HuggingFaceSpaces',
         'model_kwargs': {
@@ -80,6 +83,9 @@ MODELS = {
         'endpoint': 'https://dcrdpaiopenai02.openai.azure.com/',
         'name': 'Azure OpenAI 4T Chat',
         'code': 'AzOp4tC',
+        'context_window': 128000,
+        'rpm': 480,        # Deployment quota, requests & tokens per minute
+        'tpm': 80000,
         'api-key': os.getenv("AZURE_OPENAI_API_KEY2"), 
         'provider': 'AzureChatOpenAI',
         'model_kwargs': {
@@ -98,7 +104,13 @@ MODELS = {
         'endpoint': 'https://dcrdpaiopenai01.openai.azure.com/',
         'name': 'Azure OpenAI Chat',
         'code': 'AzOpC',
+        'context_window': 16384,
+        'rpm': 720,        # Deployment quota, requests & tokens per minute
+        'tpm': 120000,
         'api-key': os.getenv("AZURE_OPENAI_API_KEY"), 
+        # Equivalent deployments to fail over to, each overrides the keys of this entry
+        #'backends': [{'endpoint': 'https://dcrdpaiopenai02.openai.azure.com/', 'api-key': os.getenv("AZURE_OPENAI_API_KEY2")}],
+        #'hedge': True,     # Duplicate a call slower than p95 to the next backend
         'provider': 'AzureChatOpenAI',
         'model_kwargs': {
             'system_prompt': 'You are a helpful agent',
@@ -116,6 +128,9 @@ MODELS = {
         'endpoint': 'https://dcrdpaiopenai01.openai.azure.com/',
         'name': 'Azure OpenAI LLM',
         'code': 'AzOpL',
+        'context_window': 4096,
+        'rpm': 720,        # Deployment quota, requests & tokens per minute
+        'tpm': 120000,
         'api-key': os.getenv("AZURE_OPENAI_API_KEY"), 
         'provider': 'AzureOpenAILLM',
         'model_kwargs': {
@@ -132,6 +147,7 @@ MODELS = {
         'id_for_prvdr': 'text-davinci-003',
         'name': 'OpenAI LLM',
         'code': 'OpLM',
+        'context_window': 4097,
         'api-key': None,
         'provider': 'OpenAI',
         'model_kwargs': {
@@ -148,6 +164,7 @@ MODELS = {
         'id_for_prvdr': 'ChatOpenAI',
         'name': 'OpenAI Chat',
         'code': 'COAI',
+        'context_window': 4096,
         'api-key': None,
         'provider': 'ChatOpenAI',
         'model_kwargs': {
@@ -164,6 +181,7 @@ MODELS = {
         'id_for_prvdr': 'gemini-pro',
         'name': 'Google Gemini Pro Chat',
         'code': 'GGPC',
+        'context_window': 30720,
         'api-key': os.getenv("GOOGLE_API_KEY"),
         'provider': 'ChatGeminiPro',
         'model_kwargs': {
@@ -173,9 +191,93 @@ MODELS = {
             'topp_nucleus_sampling': 0.9,
             'topk': 1
         }
+    },
+    'azure-openai-chat-replay': {
+        'enabled': False,
+        'id_for_prvdr': 'gpt-35-turbo-16k',
+        'name': 'Azure OpenAI Chat (recorded)',
+        'code': 'AzOpCR',
+        'context_window': 16384,
+        'provider': 'Cassette',
+        'wraps': 'azure-openai-chat',      # Model whose responses are recorded/replayed
+        'cassette': 'cassettes/azure-openai-chat.jsonl.gz',
+        'mode': 'replay',   # record, replay or auto (replay what is recorded, record the rest)
+        'latency': None,    # Seconds before the response, None for the recorded latency
+        'chunk_delay': None,    # Seconds between streamed chunks, None for the recorded cadence
+        'model_kwargs': {
+            'system_prompt': 'You are a helpful agent',
+            'max_new_tokens': 10000,
+            'temperature': 0.1,
+            'topp_nucleus_sampling': 0.9,
+            'repetition_penalty': 0.5,
+            'presence_penalty': 0
+        }
     }
 }
 
+if os.getenv("CODEDOC_FAKE_LLM"):
+    # Load tests (loadtest.py) point this at fake_llm.py, the real providers are left alone
+    for model_obj in MODELS.values():
+        model_obj['enabled'] = False
+    for llmID, provider, deployment, api_version, code in (
+            ('fake-chat', 'AzureChatOpenAI', 'gpt-35-turbo-16k', '2023-07-01-preview', 'FkC'),
+            ('fake-llm', 'AzureOpenAILLM', 'gpt-35-turbo-instruct', '2023-09-15-preview', 'FkL')):
+        MODELS[llmID] = {
+            'enabled': True,
+            'id_for_prvdr': deployment,
+            'api_version': api_version,
+            'endpoint': os.getenv("CODEDOC_FAKE_LLM"),
+            'name': f"Fake {provider}",
+            'code': code,
+            'context_window': 16384,
+            'api-key': 'fake',
+            'provider': provider,
+            'model_kwargs': {
+                'system_prompt': 'You are a helpful agent',
+                'max_new_tokens': 256,
+                'temperature': 0.1,
+                'topp_nucleus_sampling': 0.9,
+                'repetition_penalty': 0.5,
+                'presence_penalty': 0
+            }
+        }
+
+if os.getenv("CODEDOC_FAKE_SPACE"):
+    # fake_space.py standing in for a HuggingFace Space, reached through the Gradio client like a real one
+    MODELS['fake-space'] = {
+        'enabled': True,
+        'id_for_prvdr': os.getenv("CODEDOC_FAKE_SPACE"),
+        'name': 'Fake HuggingFace Space',
+        'code': 'FkS',
+        'context_window': 4096,
+        'api-key': None,
+        'provider': 'HuggingFaceSpaces',
+        'model_kwargs': {
+            'system_prompt': 'You are a helpful agent',
+            'max_new_tokens': 256,
+            'temperature': 0.1,
+            'topp_nucleus_sampling': 0.9,
+            'topk': 40,
+            'repetition_penalty': 1,
+            'api_name': '/chat'
+        }
+    }
+
+if os.getenv("CODEDOC_CASSETTE") in ('record', 'replay', 'auto'):
+    # Every enabled model goes through a cassette under its own ID, the model itself moves to <ID>@live
+    cassette_dir = os.getenv("CODEDOC_CASSETTE_DIR", "cassettes")
+    for llmID, model_obj in list(MODELS.items()):
+        if not model_obj.get('enabled') or model_obj['provider'] == 'Cassette':
+            continue
+        MODELS[f"{llmID}@live"] = {**model_obj, 'enabled': False}
+        MODELS[llmID] = {
+            **{key: value for key, value in model_obj.items() if key not in ('endpoint', 'rpm', 'tpm', 'backends', 'hedge')},
+            'provider': 'Cassette',
+            'wraps': f"{llmID}@live",
+            'cassette': os.path.join(cassette_dir, f"{llmID}.jsonl.gz"),
+            'mode': os.getenv("CODEDOC_CASSETTE")
+        }
+
 router = APIRouter()
 
 def copy_dict_and_remove_keys(original_dict, keys_to_remove):
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+import copy
+import openai
+import importlib
+import threading
+
+from fastapi             import HTTPException
+
+from libs.data           import LLMParams
+from libs.params         import MODELS
+from libs                import startup
+
+__all__ = ["ProviderRegistry", "registry", "resolve_model_kwargs", "sampling_kwargs", "prompt_provider"]
+
+# Providers whose clients take a list of messages, all others take a single prompt string
+CHAT_PROVIDERS = ('AzureChatOpenAI', 'ChatOpenAI')
+OPENAI_PROVIDERS = ('AzureChatOpenAI', 'AzureOpenAILLM', 'OpenAI', 'ChatOpenAI')
+
+# Module and class of the client of each provider, imported only once a model needs it as most of
+#   the import time of a worker goes into these packages
+PROVIDER_CLASSES = {
+    'AzureChatOpenAI': ('langchain_community.chat_models', 'AzureChatOpenAI'),
+    'AzureOpenAILLM': ('langchain_community.llms', 'AzureOpenAI'),
+    'OpenAI': ('langchain_community.llms', 'OpenAI'),
+    'ChatOpenAI': ('langchain_community.chat_models', 'ChatOpenAI'),
+    'HuggingFaceSpaces': ('libs.llms', 'HuggingFaceSpaces'),
+    'ChatGeminiPro': ('langchain_google_genai', 'GoogleGenerativeAI'),
+    'Cassette': ('libs.cassette', 'CassetteLLM'),
+    'CassetteChat': ('libs.cassette', 'CassetteChat')
+}
+
+def prompt_provider(model_obj: dict) -> str:
+    # A cassette takes the prompts, and the sampling parameters, in the format of the model it records
+    if model_obj['provider'] == 'Cassette':
+        return MODELS[model_obj['wraps']]['provider']
+    return model_obj['provider']
+
+def provider_class(provider: str):
+    if provider not in PROVIDER_CLASSES:
+        raise HTTPException(status_code=404, detail={'msg':f"Model Provider {provider} not available"})
+
+    module, name = PROVIDER_CLASSES[provider]
+    return getattr(importlib.import_module(module), name)
+
+def resolve_model_kwargs(model_obj: dict, params: LLMParams) -> dict:
+    # Model defaults from MODELS overridden by what the user sent for this request
+    kwargs = copy.deepcopy(model_obj['model_kwargs'])
+    kwargs['temperature'] = params.temperature
+    kwargs['max_new_tokens'] = params.max_new_tokens
+    kwargs['topp_nucleus_sampling'] = params.topp_nucleus_sampling
+    if params.topk is not None and 'topk' in kwargs:
+        kwargs['topk'] = params.topk
+    if params.repetition_penalty is not None and 'repetition_penalty' in kwargs:
+        kwargs['repetition_penalty'] = params.repetition_penalty
+    if params.presence_penalty is not None and 'presence_penalty' in kwargs:
+        kwargs['presence_penalty'] = params.presence_penalty
+    if 'system_prompt' in kwargs:
+        kwargs['system_prompt'] = params.system_prompt
+
+    return kwargs
+
+def sampling_kwargs(model_obj: dict, kwargs: dict) -> dict:
+    # Translate our generic kwargs into the argument names each provider understands per call
+    provider = prompt_provider(model_obj)
+    if provider in OPENAI_PROVIDERS:
+        return {
+            'temperature': kwargs['temperature'],
+            'max_tokens': kwargs['max_new_tokens'],
+            'top_p': kwargs['topp_nucleus_sampling'],
+            'frequency_penalty': kwargs.get('repetition_penalty'),
+            'presence_penalty': kwargs.get('presence_penalty')
+        }
+    elif provider == 'ChatGeminiPro':
+        return {
+            'temperature': kwargs['temperature'],
+            'top_k': kwargs.get('topk'),
+            'top_p': kwargs['topp_nucleus_sampling'],
+            'max_output_tokens': kwargs['max_new_tokens']
+        }
+    elif provider == 'HuggingFaceSpaces':
+        return kwargs
+    else:
+        raise HTTPException(status_code=404, detail={'msg':f"Model Provider {provider} not available"})
+
+
+class ProviderRegistry:
+    """Long lived provider clients, one per MODELS entry in each worker process.
+
+    The clients are built without any sampling parameters so that a single instance (and its
+    HTTP connection pool) can serve every request for the model, the sampling parameters are
+    supplied per call through `bind()`. A model listing 'backends' gets a client for each of
+    them as well, backend 0 is the MODELS entry itself.
+    """
+
+    def __init__(self, models: dict):
+        self.models = models
+        self.clients = {}       # (llmID, backend) -> client
+        self.lock = threading.Lock()
+
+    def backends(self, llmID: str) -> list:
+        """Model objects of the equivalent deployments of the model, each 'backends' item overrides the entry's keys."""
+
+        model_obj = self.models.get(llmID)
+        if model_obj is None:
+            raise HTTPException(status_code=404, detail={'msg':f"Model ID {llmID} not available"})
+
+        base = {key: value for key, value in model_obj.items() if key != 'backends'}
+        return [model_obj] + [{**base, **backend} for backend in model_obj.get('backends', [])]
+
+    def get_client(self, llmID: str, backend: int = 0):
+        client = self.clients.get((llmID, backend))
+        if client is not None:
+            return client
+
+        model_obj = self.backends(llmID)[backend]
+        with self.lock:
+            # Another thread may have built it while we were waiting
+            client = self.clients.get((llmID, backend))
+            if client is None:
+                client = self.build_client(model_obj)
+                self.clients[(llmID, backend)] = client
+
+        return client
+
+    def build_client(self, model_obj: dict):
+        provider = model_obj['provider']
+        client_class = provider_class(provider)
+        if provider in ('AzureChatOpenAI', 'AzureOpenAILLM'):
+            return client_class(
+                openai_api_key=model_obj['api-key'],
+                deployment_name=model_obj['id_for_prvdr'],
+                model_name=model_obj['id_for_prvdr'],
+                openai_api_version=model_obj['api_version'],
+                azure_endpoint=model_obj['endpoint'],
+                max_retries=0    # Retries are paced by libs.ratelimit
+            )
+        elif provider == 'OpenAI':
+            return client_class(model_name=model_obj['id_for_prvdr'], max_retries=0)
+        elif provider == 'ChatOpenAI':
+            return client_class(max_retries=0)
+        elif provider == 'HuggingFaceSpaces':
+            return client_class(
+                task="summarization",
+                repo_id=model_obj['id_for_prvdr'],
+                model_kwargs=copy.deepcopy(model_obj['model_kwargs']))
+        elif provider == 'ChatGeminiPro':
+            if model_obj['api-key'] is None:
+                raise HTTPException(status_code=404, detail={'msg':f"Model Provider {provider} not configured"})
+            return client_class(model=model_obj['id_for_prvdr'], google_api_key=model_obj['api-key'])
+        elif provider == 'Cassette':
+            if prompt_provider(model_obj) in CHAT_PROVIDERS:
+                client_class = provider_class('CassetteChat')
+            return client_class(
+                cassette=model_obj['cassette'],
+                wraps=model_obj['wraps'],
+                mode=model_obj.get('mode', 'replay'),
+                latency=model_obj.get('latency'),
+                chunk_delay=model_obj.get('chunk_delay'))
+
+    def bind(self, llmID: str, kwargs: dict, backend: int = 0):
+        """Return a runnable for the model with this request's sampling parameters applied."""
+
+        return self.bind_sampling(llmID, sampling_kwargs(self.models.get(llmID), kwargs), backend)
+
+    def bind_sampling(self, llmID: str, sampling: dict, backend: int = 0):
+        model_obj = self.models.get(llmID)
+        client = self.get_client(llmID, backend)
+        if model_obj['provider'] == 'ChatGeminiPro':
+            # Gemini ignores per call kwargs, a shallow copy keeps sharing the underlying client
+            return client.copy(update={k: v for k, v in sampling.items() if v is not None})
+
+        return client.bind(**{k: v for k, v in sampling.items() if v is not None})
+
+    def preload(self):
+        # Import the client classes of the enabled models, before forking the workers share them
+        for provider in {model_obj['provider'] for model_obj in self.models.values() if model_obj.get('enabled')}:
+            with startup.phase(f"import {provider} client"):
+                provider_class(provider)
+
+    def warmup(self):
+        # Build clients for all the enabled models and open their connections before traffic arrives
+        for llmID, model_obj in self.models.items():
+            if not model_obj.get('enabled'):
+                continue
+            for backend in range(len(self.backends(llmID))):
+                try:
+                    client = self.get_client(llmID, backend)
+                    if model_obj['provider'] in ('AzureChatOpenAI', 'AzureOpenAILLM'):
+                        # Any authenticated round trip completes the TLS handshake and leaves a
+                        # keep-alive connection in the pool of the long lived client
+                        root_client = getattr(client.client, '_client', None)
+                        if root_client is not None:
+                            root_client.models.list()
+                except openai.APIStatusError:
+                    pass    # Server answered, so the connection is up even if the listing is not allowed
+                except Exception as excp:
+                    print(f"Warmup of model [{llmID}] backend [{backend}] failed [{excp}]")
+
+    async def awarmup(self):
+        # The async handlers use a separate connection pool held by the async client
+        for (llmID, backend), client in list(self.clients.items()):
+            if self.models[llmID]['provider'] not in ('AzureChatOpenAI', 'AzureOpenAILLM'):
+                continue
+            try:
+                root_client = getattr(client.async_client, '_client', None)
+                if root_client is not None:
+                    await root_client.models.list()
+            except openai.APIStatusError:
+                pass
+            except Exception as excp:
+                print(f"Async warmup of model [{llmID}] backend [{backend}] failed [{excp}]")
+
+    def close(self):
+        with self.lock:
+            for client in self.clients.values():
+                root_client = getattr(getattr(client, 'client', None), '_client', None)
+                if root_client is not None and hasattr(root_client, 'close'):
+                    root_client.close()
+            self.clients = {}
+
+
+registry = ProviderRegistry(MODELS)
+
+if __name__ == '__main__':
+  print ('Cannot execute as a program, it is a module')
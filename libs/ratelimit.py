@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+import time
+import random
+import asyncio
+from email.utils         import parsedate_to_datetime
+
+import openai
+from fastapi             import HTTPException
+
+__all__ = ["TokenBucket", "AdmissionController", "configure", "get_controller", "retry_delay", "RETRYABLE_ERRORS"]
+
+MAX_QUEUE = 64          # Requests allowed to wait for budget per endpoint in each worker
+MAX_RETRIES = 3         # Provider calls retried after a 429 or a transient failure
+BASE_DELAY = 1.0        # Seconds of backoff for the first retry when the provider gives no hint
+MAX_DELAY = 60.0
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+workers = 1
+controllers = {}
+
+class TokenBucket:
+    """Continuously refilled bucket holding up to a minute's worth of budget."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        # A request larger than the whole budget can only ever get a full bucket
+        amount = min(amount, self.capacity)
+        self.refill()
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        self.refill()
+        self.level -= min(amount, self.capacity)
+
+
+class AdmissionController:
+    """Requests-per-minute and tokens-per-minute budgets of one provider endpoint/deployment.
+
+    Callers over budget wait their turn in FIFO order, at most MAX_QUEUE of them. A 429 from the
+    provider pauses admission for everybody until its Retry-After has passed.
+    """
+
+    def __init__(self, name: str, rpm: float | None, tpm: float | None, max_queue: int = MAX_QUEUE):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_queue = max_queue
+        self.waiting = 0
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def wait_time(self, tokens: int) -> float:
+        wait = self.blocked_until - time.monotonic()
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens))
+        return wait
+
+    async def acquire(self, tokens: int) -> dict:
+        """Wait until the request fits in the budget, returns the queue depth seen and the wait in ms."""
+
+        if self.waiting >= self.max_queue:
+            raise HTTPException(status_code=429, detail={'msg': f"Too many requests queued for [{self.name}], retry later"},
+                                headers={'Retry-After': str(int(max(1, self.wait_time(tokens))))})
+
+        depth = self.waiting
+        self.waiting += 1
+        start = time.monotonic()
+        try:
+            async with self.lock:
+                wait = self.wait_time(tokens)
+                while wait > 0:
+                    await asyncio.sleep(wait)
+                    wait = self.wait_time(tokens)
+                if self.requests is not None:
+                    self.requests.take(1)
+                if self.tokens is not None:
+                    self.tokens.take(tokens)
+        finally:
+            self.waiting -= 1
+
+        return {'queue_depth': depth, 'wait_ms': round((time.monotonic() - start)*1000, 1)}
+
+    def backoff(self, delay: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+
+def retry_delay(excp: Exception, attempt: int) -> float:
+    # Honor the provider's Retry-After, else exponential backoff, both with jitter so the waiting
+    #   callers do not all come back at the same instant
+    delay = None
+    response = getattr(excp, 'response', None)
+    if response is not None:
+        headers = response.headers
+        try:
+            if headers.get('retry-after-ms'):
+                delay = float(headers['retry-after-ms']) / 1000
+            elif headers.get('retry-after'):
+                value = headers['retry-after']
+                if value.replace('.', '', 1).isdigit():
+                    delay = float(value)
+                else:
+                    delay = parsedate_to_datetime(value).timestamp() - time.time()
+        except (ValueError, TypeError):
+            delay = None
+
+    if delay is None or delay < 0:
+        delay = BASE_DELAY * (2 ** attempt)
+
+    return min(MAX_DELAY, delay) * random.uniform(1.0, 1.25)
+
+def configure(num_workers: int):
+    global workers
+
+    # Budgets in MODELS are for the whole deployment, every worker process gets its share
+    workers = max(1, num_workers)
+    controllers.clear()
+
+def get_controller(model_obj: dict) -> AdmissionController:
+    name = f"{model_obj.get('endpoint', model_obj['provider'])}/{model_obj['id_for_prvdr']}"
+    controller = controllers.get(name)
+    if controller is None:
+        rpm = model_obj.get('rpm')
+        tpm = model_obj.get('tpm')
+        controller = AdmissionController(name, rpm / workers if rpm else None, tpm / workers if tpm else None)
+        controllers[name] = controller
+
+    return controller
+
+
+if __name__ == '__main__':
+  print ('Cannot execute as a program, it is a module')
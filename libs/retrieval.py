@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+import re
+import time
+import sqlite3
+import threading
+from pathlib             import Path
+from typing              import Annotated
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None        # No file locks (Windows), every worker then syncs the index at start
+
+from fastapi             import Depends, APIRouter, HTTPException
+
+from libs.auth           import get_current_active_user, User
+from libs.metrics        import timed_connection
+from libs.params         import MODELS
+from libs                import functions
+from libs                import tokens
+from libs                import files
+
+__all__ = ["router", "CodeIndex", "configure", "get_index", "startup_sync", "file_changed", "auto_context", "CONTEXT_TOKENS"]
+
+CONTEXT_TOKENS = 1500       # Tokens of retrieved code added to the context of an auto_context request
+TOP_K = 8                   # Chunks at most
+CHUNK_LINES = 40            # Lines of the text chunks, and of the code outside the functions of a JS file
+MAX_QUERY_TERMS = 64
+MAX_FILE_BYTES = 1 << 20    # Larger files are not indexed
+STARTUP_SYNC_SECONDS = 300  # A sync at start this recent, by another worker, is not repeated
+TEXT_SUFFIXES = ('.js', '.mjs', '.cjs', '.ejs', '.html', '.htm', '.css', '.py', '.json', '.md', '.txt', '.sql', '.java', '.ts')
+
+WORD = re.compile(r"[A-Za-z_$][A-Za-z0-9_$]*")
+CAMEL = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+STOPWORDS = frozenset("""the and for are but not you all any can had has her was one our out his how its may new now
+    see two who did get let put say she too use this that with from have will what when your them then than they into
+    only also some more most such each which their there these those would could should about above after again below
+    function return const var true false null undefined document describe explain code following""".split())
+
+index = None
+settings = {'db_name': None}
+settings_lock = threading.Lock()
+router = APIRouter()
+
+def split_identifier(word: str) -> list:
+    # createPostRequest -> create post request, line_item_id -> line item id
+    return [part.lower() for piece in word.split('_') for part in CAMEL.findall(piece)]
+
+def index_terms(text: str) -> str:
+    # The parts of the identifiers, so that a prompt about "post requests" finds createPostRequest
+    return " ".join(part for word in WORD.findall(text) for part in split_identifier(word) if len(part) > 1)
+
+def query_terms(text: str) -> list:
+    terms = []
+    for word in WORD.findall(text):
+        for term in [word.lower()] + split_identifier(word):
+            if len(term) > 2 and term not in STOPWORDS and term not in terms:
+                terms.append(term)
+    return terms[:MAX_QUERY_TERMS]
+
+def line_windows(lines: list, first: int, last: int) -> list:
+    # Windows of about CHUNK_LINES lines over lines first..last (1-based), ended at blank lines when there is one
+    windows = []
+    start = first
+    while start <= last:
+        end = min(start + CHUNK_LINES - 1, last)
+        if end < last:
+            for blank in range(end, start + CHUNK_LINES // 2, -1):
+                if len(lines[blank - 1].strip()) == 0:
+                    end = blank
+                    break
+        if any(len(line.strip()) > 0 for line in lines[start - 1:end]):
+            windows.append((start, end))
+        start = end + 1
+    return windows
+
+def make_chunks(source: str, suffix: str) -> list:
+    """(start line, end line, text) of a file: every function of JS files and pages, the rest in windows of lines."""
+
+    lines = source.split("\n")
+    ranges = []
+    if suffix in functions.JS_SUFFIXES + functions.DOC_PAGE_SUFFIXES:
+        ranges = [(func['start_line'], func['end_line']) for func in functions.extract_functions(source, suffix)['functions']]
+    covered = set(line for start, end in ranges for line in range(start, end + 1))
+
+    start = None
+    for number in range(1, len(lines) + 2):
+        if number <= len(lines) and number not in covered:
+            start = number if start is None else start
+        elif start is not None:
+            ranges.extend(line_windows(lines, start, number - 1))
+            start = None
+
+    return [(start, end, "\n".join(lines[start - 1:end])) for start, end in sorted(ranges)]
+
+class CodeIndex:
+    """BM25 full text index of the chunks of the code tree, in a SQLite FTS5 table shared by all the workers.
+
+    Every input file is indexed in its latest saved version, under the name of the input file. A
+    file is only chunked again when its size or modification time changed since it was indexed.
+    """
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.lock = threading.Lock()
+        self.conn = timed_connection(sqlite3.connect(db_name, check_same_thread=False, timeout=10), db_name)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.cursor = self.conn.cursor()
+        self.create_tables()
+
+    def create_tables(self):
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS indexed_files (
+                path TEXT PRIMARY KEY,
+                source TEXT,
+                mtime INTEGER,
+                size INTEGER,
+                chunks INTEGER,
+                indexed INTEGER
+            )
+        ''')
+
+        self.cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS code_chunks USING fts5 (
+                path UNINDEXED,
+                start_line UNINDEXED,
+                end_line UNINDEXED,
+                content,
+                terms
+            )
+        ''')
+        self.conn.commit()
+
+    def update_file(self, relative: Path) -> bool:
+        # Returns whether the file had to be indexed again
+        source = files.get_latest_version(relative)
+        path = relative.as_posix()
+        if not source.is_file() or source.stat().st_size > MAX_FILE_BYTES:
+            return self.remove_file(path)
+
+        stat = source.stat()
+        with self.lock:
+            self.cursor.execute('SELECT source, mtime, size FROM indexed_files WHERE path = ?', (path,))
+            if self.cursor.fetchone() == (source.as_posix(), stat.st_mtime_ns, stat.st_size):
+                return False
+
+        try:
+            chunks = make_chunks(source.read_text(), source.suffix.lower())
+        except (OSError, UnicodeDecodeError) as excp:
+            print(f"Could not index [{source}] [{excp}]")
+            return self.remove_file(path)
+
+        with self.lock:
+            self.cursor.execute('DELETE FROM code_chunks WHERE path = ?', (path,))
+            self.cursor.executemany('INSERT INTO code_chunks (path, start_line, end_line, content, terms) VALUES (?, ?, ?, ?, ?)',
+                                    [(path, start, end, text, index_terms(text)) for start, end, text in chunks])
+            self.cursor.execute('INSERT OR REPLACE INTO indexed_files VALUES (?, ?, ?, ?, ?, ?)',
+                                (path, source.as_posix(), stat.st_mtime_ns, stat.st_size, len(chunks), int(time.time()*1000)))
+            self.conn.commit()
+        return True
+
+    def remove_file(self, path: str) -> bool:
+        with self.lock:
+            self.cursor.execute('DELETE FROM code_chunks WHERE path = ?', (path,))
+            removed = self.cursor.execute('DELETE FROM indexed_files WHERE path = ?', (path,)).rowcount
+            self.conn.commit()
+        return removed > 0
+
+    def sync(self) -> dict:
+        # Index the new and changed files of the input directory, drop the deleted ones
+        start = time.perf_counter()
+        root = Path(files.INPUT_CODE_DIR)
+        found = set()
+        updated = 0
+        for filepath in root.rglob("*"):
+            relative = filepath.relative_to(root)
+            if (not filepath.is_file() or filepath.suffix.lower() not in TEXT_SUFFIXES or
+                    any(part.startswith(('_', '.')) for part in relative.parts)):
+                continue
+            found.add(relative.as_posix())
+            updated += self.update_file(relative)
+
+        with self.lock:
+            self.cursor.execute('SELECT path FROM indexed_files')
+            gone = [path for (path,) in self.cursor.fetchall() if path not in found]
+        for path in gone:
+            self.remove_file(path)
+        return {'files': len(found), 'updated': updated, 'removed': len(gone), 'total_ms': round((time.perf_counter() - start)*1000, 1)}
+
+    def search(self, text: str, limit: int) -> list:
+        terms = query_terms(text)
+        if len(terms) == 0:
+            return []
+        match = " OR ".join('"' + term + '"' for term in terms)
+        with self.lock:
+            self.cursor.execute('''
+                SELECT path, start_line, end_line, content, bm25(code_chunks, 0, 0, 0, 1.0, 0.5) AS score
+                FROM code_chunks WHERE code_chunks MATCH ? ORDER BY score LIMIT ?
+            ''', (match, limit))
+            rows = self.cursor.fetchall()
+        return [{'path': path, 'start_line': start, 'end_line': end, 'content': content, 'score': round(-score, 3)}
+                for path, start, end, content, score in rows]
+
+    def stats(self) -> dict:
+        with self.lock:
+            self.cursor.execute('SELECT COUNT(*), COALESCE(SUM(chunks), 0), MAX(indexed) FROM indexed_files')
+            count, chunks, indexed = self.cursor.fetchone()
+        return {'files': count, 'chunks': chunks, 'last_indexed': indexed}
+
+def configure(db_name: str, context_tokens: int):
+    global index, CONTEXT_TOKENS
+
+    # The database is opened on first use, in the worker process that uses it
+    settings['db_name'] = db_name
+    CONTEXT_TOKENS = context_tokens
+    index = None
+
+def get_index() -> CodeIndex:
+    global index
+
+    if index is None:
+        with settings_lock:
+            if index is None:
+                index = CodeIndex(settings['db_name'])
+    return index
+
+def startup_sync() -> dict | None:
+    """Sync of the index at server start, run once for all the workers sharing the database.
+
+    The first worker to lock the file next to the database syncs and stamps it, the workers that
+    find it locked or recently stamped skip the sync. Returns None when skipped.
+    """
+
+    if fcntl is None:
+        return get_index().sync()
+
+    with open(settings['db_name'] + ".sync", 'a+') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None         # Another worker is syncing
+        try:
+            lock_file.seek(0)
+            try:
+                if time.time() - float(lock_file.read()) < STARTUP_SYNC_SECONDS:
+                    return None
+            except ValueError:
+                pass            # Not stamped yet
+            result = get_index().sync()
+            lock_file.truncate(0)
+            lock_file.write(str(time.time()))
+            return result
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def file_changed(file_name: str):
+    # Called when an input file is uploaded or a new version of it saved, the name with or without version
+    split_name = Path(file_name).name.split('.')
+    if len(split_name) >= 3 and split_name[-2].isdigit():
+        split_name.pop(-2)
+    elif len(split_name) == 2 and split_name[-1].isdigit():
+        split_name.pop(-1)
+    try:
+        get_index().update_file(Path(file_name).with_name(".".join(split_name)))
+    except Exception as excp:
+        print(f"Indexing [{file_name}] failed [{excp}]")
+
+def retrieve(model_obj: dict, query: str, budget: int, k: int = TOP_K, exclude: str | None = None) -> list:
+    """Best ranked chunks for the query that fit the token budget, skipping those already in exclude."""
+
+    picked = []
+    used = 0
+    for chunk in get_index().search(query, k * 4):
+        if exclude and chunk['content'].strip() in exclude:
+            continue
+        count = tokens.count_tokens(model_obj, chunk['content'])
+        if used + count > budget:
+            continue
+        picked.append({**chunk, 'tokens': count})
+        used += count
+        if len(picked) >= k:
+            break
+    return picked
+
+def auto_context(params, model_obj: dict):
+    """The request's context with the code most relevant to its prompt and code snippet appended."""
+
+    query = f"{params.user_prompt}\n{params.code_snippet or ''}"
+    try:
+        chunks = retrieve(model_obj, query, CONTEXT_TOKENS, exclude=params.code_snippet)
+    except sqlite3.Error as excp:
+        print(f"Context retrieval failed [{excp}]")
+        return params
+    if len(chunks) == 0:
+        return params
+    retrieved = "\n\n".join(f"// {chunk['path']} lines {chunk['start_line']}-{chunk['end_line']}\n{chunk['content']}" for chunk in chunks)
+    context = f"{params.context}\n\n{retrieved}" if params.context else retrieved
+    return params.model_copy(update={'context': context})
+
+@router.get("/retrieve/")
+def get_relevant_chunks(q: str, current_user: Annotated[User, Depends(get_current_active_user)],
+                        llmID: str | None = None, k: int = TOP_K, budget: int | None = None) -> dict:
+    model_obj = MODELS.get(llmID) if llmID is not None else next(iter(MODELS.values()), None)
+    if model_obj is None:
+        raise HTTPException(status_code=404, detail={'msg':f"Model ID {llmID} not available"})
+    chunks = retrieve(model_obj, q, budget or CONTEXT_TOKENS, k)
+    return {'chunks': chunks, 'tokens': sum(chunk['tokens'] for chunk in chunks)}
+
+@router.get("/retrieve/stats")
+def get_index_stats(current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    return get_index().stats()
+
+@router.post("/retrieve/reindex")
+def reindex(current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    return get_index().sync()
+
+
+if __name__ == '__main__':
+  print ('Cannot execute as a program, it is a module')
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+import time
+import asyncio
+import contextvars
+from enum                import StrEnum
+from collections         import deque
+from typing              import Annotated
+
+from fastapi             import Depends, APIRouter
+
+from libs.auth           import get_current_active_user, User
+from libs                import metrics
+
+__all__ = ["router", "Priority", "FairScheduler", "configure", "classify", "current", "get_scheduler", "WEIGHTS"]
+
+class Priority(StrEnum):
+    INTERACTIVE = 'chat'        # A user waiting on the other side of /chat/
+    SINGLE = 'llm'              # One /llm/ request
+    BATCH = 'batch'             # /llm/batch, jobs, summaries, function docs
+
+WEIGHTS = {Priority.INTERACTIVE: 8, Priority.SINGLE: 4, Priority.BATCH: 1}
+STATS_SAMPLES = 1000            # Latest waits & runs per class the percentiles are computed over
+
+request_class = contextvars.ContextVar('request_class', default=(Priority.SINGLE, None))
+scheduler = None
+router = APIRouter()
+
+class FairScheduler:
+    """The provider slots of a worker, handed out class by class in proportion to their weights and
+    within a class user by user, so that nobody's batch holds up the others.
+
+    Every class and every user keeps a virtual time, advanced on every slot it gets by the inverse
+    of its weight (1 for the users). A free slot goes to the class with the lowest virtual time that
+    has waiters, then to its user with the lowest one, first come first served for that user. Idle
+    classes and users start again from the lowest virtual time of the busy ones: waiting does not
+    build up credit. Running calls are never interrupted, the order only decides who goes next.
+    """
+
+    def __init__(self, slots: int, weights: dict):
+        self.slots = slots
+        self.free = slots
+        self.weights = {Priority(name): max(float(weight), 0.001) for name, weight in weights.items()}
+        self.class_time = {priority: 0.0 for priority in Priority}
+        self.user_time = {priority: {} for priority in Priority}
+        self.waiting = {priority: {} for priority in Priority}      # Class -> user -> deque of futures
+        self.stats = {priority: {'admitted': 0, 'running': 0, 'waits': deque(maxlen=STATS_SAMPLES),
+                                 'runs': deque(maxlen=STATS_SAMPLES)} for priority in Priority}
+
+    def queued(self, priority: Priority) -> int:
+        return sum(len(queue) for queue in self.waiting[priority].values())
+
+    async def acquire(self, priority: Priority, user: str | None) -> float:
+        # Returns the time the slot was granted, for release()
+        user = user or "anonymous"
+        start = time.perf_counter()
+        if self.free > 0 and all(self.queued(other) == 0 for other in Priority):
+            self.free -= 1
+            self.charge(priority, user)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.enqueue(priority, user, future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self.free += 1      # Granted while being cancelled, the next one gets it
+                    self.dispatch()
+                else:
+                    self.remove(priority, user, future)
+                raise
+
+        wait = time.perf_counter() - start
+        self.stats[priority]['admitted'] += 1
+        self.stats[priority]['running'] += 1
+        self.stats[priority]['waits'].append(wait)
+        metrics.SCHEDULER_WAIT.labels(priority).observe(wait)
+        return time.perf_counter()
+
+    def release(self, priority: Priority, granted: float):
+        self.stats[priority]['running'] -= 1
+        self.stats[priority]['runs'].append(time.perf_counter() - granted)
+        self.free += 1
+        self.dispatch()
+
+    def enqueue(self, priority: Priority, user: str, future):
+        users = self.waiting[priority]
+        if self.queued(priority) == 0:
+            self.class_time[priority] = max(self.class_time[priority], self.floor(self.class_time, self.busy_classes()))
+        if user not in users:
+            times = self.user_time[priority]
+            times[user] = max(times.get(user, 0.0), self.floor(times, users.keys()))
+            users[user] = deque()
+        users[user].append(future)
+
+    def remove(self, priority: Priority, user: str, future):
+        queue = self.waiting[priority].get(user)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            if len(queue) == 0:
+                del self.waiting[priority][user]
+
+    def busy_classes(self) -> list:
+        return [priority for priority in Priority if self.queued(priority) > 0]
+
+    @staticmethod
+    def floor(times: dict, busy) -> float:
+        busy = [times[key] for key in busy if key in times]
+        return min(busy) if busy else 0.0
+
+    def charge(self, priority: Priority, user: str):
+        self.class_time[priority] += 1 / self.weights.get(priority, 1)
+        times = self.user_time[priority]
+        times[user] = times.get(user, 0.0) + 1
+        if len(times) > 1000:
+            # Forget the users who are not waiting, they restart from the floor anyway
+            for idle in [name for name in times if name not in self.waiting[priority]]:
+                del times[idle]
+
+    def dispatch(self):
+        while self.free > 0:
+            busy = self.busy_classes()
+            if len(busy) == 0:
+                return
+            priority = min(busy, key=lambda candidate: (self.class_time[candidate], -self.weights.get(candidate, 1)))
+            users = self.waiting[priority]
+            user = min(users, key=lambda name: self.user_time[priority].get(name, 0.0))
+            future = users[user].popleft()
+            if len(users[user]) == 0:
+                del users[user]
+            if future.done():
+                continue    # Cancelled while waiting
+            self.free -= 1
+            self.charge(priority, user)
+            future.set_result(None)
+
+    def report(self) -> dict:
+        def percentiles(samples) -> dict:
+            ordered = sorted(samples)
+            if len(ordered) == 0:
+                return {'p50_ms': None, 'p95_ms': None, 'max_ms': None}
+            return {'p50_ms': round(ordered[len(ordered)//2]*1000, 1),
+                    'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered)*0.95))]*1000, 1),
+                    'max_ms': round(ordered[-1]*1000, 1)}
+
+        return {
+            'slots': self.slots,
+            'free': self.free,
+            'classes': {priority.value: {
+                'weight': self.weights.get(priority, 1),
+                'admitted': stats['admitted'],
+                'running': stats['running'],
+                'queued': self.queued(priority),
+                'users_queued': len(self.waiting[priority]),
+                'wait': percentiles(stats['waits']),
+                'run': percentiles(stats['runs'])
+            } for priority, stats in self.stats.items()}
+        }
+
+def configure(slots: int, weights: dict | None = None):
+    global scheduler, WEIGHTS
+
+    if weights is not None:
+        WEIGHTS = {**WEIGHTS, **{Priority(name): weight for name, weight in weights.items()}}
+    scheduler = FairScheduler(slots, WEIGHTS)
+
+def get_scheduler() -> FairScheduler | None:
+    return scheduler
+
+def classify(priority: Priority, user: str | None):
+    """Class and user of the LLM calls made from here on by this request (and the tasks it starts)."""
+
+    request_class.set((Priority(priority), user))
+
+def current() -> tuple:
+    return request_class.get()
+
+@router.get("/scheduler/stats")
+def get_scheduler_stats(current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    if scheduler is None:
+        return {'enabled': False}
+    return scheduler.report()
+
+
+if __name__ == '__main__':
+  print ('Cannot execute as a program, it is a module')
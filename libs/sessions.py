@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+import asyncio
+from typing              import Annotated
+
+from fastapi             import Depends, APIRouter, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from langchain.schema    import HumanMessage, SystemMessage
+
+from libs.data           import ChatMessage, ChatExchange
+from libs.auth           import get_current_active_user, User, sqlite_dbname
+from libs.user_db        import UserDatabase, ChatSessionDatabase
+from libs.providers      import registry, resolve_model_kwargs, sampling_kwargs
+from libs.params         import MODELS
+from libs                import dispatch
+from libs                import tokens
+from libs                import usage
+from libs                import scheduler
+from libs.scheduler      import Priority
+
+__all__ = ["router", "configure", "load_session", "record_exchange", "SUMMARY_THRESHOLD"]
+
+SUMMARY_THRESHOLD = 2000    # Tokens of verbatim history beyond which older exchanges are summarized
+SUMMARY_MAX_TOKENS = 512    # Length of the running summary
+KEEP_RECENT = 2             # Latest exchanges always sent verbatim
+
+SUMMARY_INSTRUCTIONS = ("You maintain a running summary of a conversation between a user and an AI assistant about "
+                        "source code. Keep every decision, requirement, identifier and open question, drop the chit-chat. "
+                        "Answer with the updated summary only.")
+
+router = APIRouter()
+compacting = {}     # Session ID -> task folding its older exchanges into the summary
+
+def configure(threshold: int):
+    global SUMMARY_THRESHOLD
+
+    SUMMARY_THRESHOLD = threshold
+
+def get_user_id(username: str) -> int:
+    user_id = UserDatabase(sqlite_dbname).get_user_id_by_username(username)
+    if user_id is None:
+        raise HTTPException(status_code=404, detail={'msg':f"No user found with name [{username}]"})
+    return user_id
+
+def get_session(session_id: str, username: str) -> dict:
+    session = ChatSessionDatabase(sqlite_dbname).get_session(session_id, get_user_id(username))
+    if session is None:
+        raise HTTPException(status_code=404, detail={'msg':f"Chat session [{session_id}] not found"})
+    return session
+
+def session_history(session_id: str, username: str) -> tuple:
+    session = get_session(session_id, username)
+    exchanges = ChatSessionDatabase(sqlite_dbname).get_exchanges(session_id, session['summarized'])
+    return session, exchanges
+
+async def load_session(chat: ChatMessage, username: str) -> ChatMessage:
+    """Return the chat with the session's history filled in, the summary of older exchanges goes with the system prompt."""
+
+    if chat.session_id is None:
+        return chat
+
+    session, exchanges = await run_in_threadpool(session_history, chat.session_id, username)
+    params = chat.params
+    if session['summary']:
+        params = params.model_copy(update={'system_prompt': (params.system_prompt or "") +
+                                           "\n\nSummary of the earlier conversation:\n" + session['summary']})
+
+    history = [ChatExchange(user=exchg['user'], ai=exchg['ai']) for exchg in exchanges]
+    return chat.model_copy(update={'params': params, 'history': history})
+
+async def record_exchange(chat: ChatMessage, username: str, ai: str):
+    """Append the completed turn to the session and start compacting it if the history got too long."""
+
+    if chat.session_id is None:
+        return
+
+    model_obj = MODELS.get(chat.params.llmID)
+    count = tokens.count_tokens(model_obj, chat.params.user_prompt) + tokens.count_tokens(model_obj, ai)
+    await run_in_threadpool(lambda: ChatSessionDatabase(sqlite_dbname).add_exchange(chat.session_id, chat.params.user_prompt, ai, count))
+
+    session, exchanges = await run_in_threadpool(session_history, chat.session_id, username)
+    if sum(exchg['tokens'] for exchg in exchanges) > SUMMARY_THRESHOLD and len(exchanges) > KEEP_RECENT:
+        if chat.session_id not in compacting:
+            # Off the request path, the next turn uses the summary once it is ready
+            task = asyncio.create_task(compact(chat, username, session, exchanges))
+            compacting[chat.session_id] = task
+            task.add_done_callback(lambda _: compacting.pop(chat.session_id, None))
+
+async def compact(chat: ChatMessage, username: str, session: dict, exchanges: list):
+    # Fold all but the latest exchanges into the running summary, with the model of the session.
+    #   Behind the interactive calls of the request that started it
+    scheduler.classify(Priority.BATCH, username)
+    older = exchanges[:-KEEP_RECENT]
+    model_obj = MODELS.get(chat.params.llmID)
+    params = chat.params.model_copy(update={'temperature': 0.0, 'max_new_tokens': SUMMARY_MAX_TOKENS, 'use_cache': False})
+    kwargs = resolve_model_kwargs(model_obj, params)
+
+    transcript = "\n\n".join(f"User: {exchg['user']}\nAI: {exchg['ai']}" for exchg in older)
+    window = model_obj.get('context_window')
+    if window is not None:
+        transcript = tokens.truncate_tokens(model_obj, transcript, window - 2*SUMMARY_MAX_TOKENS - tokens.count_tokens(model_obj, session['summary']))
+
+    message = [
+        SystemMessage(content=SUMMARY_INSTRUCTIONS),
+        HumanMessage(content=f"Summary so far:\n{session['summary'] or '(none)'}\n\nExchanges to add:\n{transcript}")
+    ]
+    call = dispatch.LLMCall(params.llmID, model_obj, registry.bind(params.llmID, kwargs), message,
+                            sampling_kwargs(model_obj, kwargs), False)
+    try:
+        summary = dispatch.response_text(await dispatch.ainvoke(call))
+        usage.record(call.user, call.llmID, tokens.count_message(model_obj, message), tokens.count_tokens(model_obj, summary), call.coalesced)
+        await run_in_threadpool(lambda: ChatSessionDatabase(sqlite_dbname).set_summary(chat.session_id, summary, older[-1]['seq']))
+    except Exception as excp:
+        print(f"Summarizing chat session [{chat.session_id}] failed [{excp}]")
+
+@router.post("/chat/sessions/")
+def create_session(current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    session_id = ChatSessionDatabase(sqlite_dbname).create_session(get_user_id(current_user.username))
+    return {'session_id': session_id}
+
+@router.get("/chat/sessions/")
+def get_sessions(current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    return {'sessions': ChatSessionDatabase(sqlite_dbname).get_sessions(get_user_id(current_user.username))}
+
+@router.get("/chat/sessions/{session_id}")
+def get_session_history(session_id: str, current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    session = get_session(session_id, current_user.username)
+    return {**session, 'exchanges': ChatSessionDatabase(sqlite_dbname).get_exchanges(session_id)}
+
+@router.delete("/chat/sessions/{session_id}")
+def delete_session(session_id: str, current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    deleted = ChatSessionDatabase(sqlite_dbname).delete_session(session_id, get_user_id(current_user.username))
+    if deleted == 0:
+        raise HTTPException(status_code=404, detail={'msg':f"Chat session [{session_id}] not found"})
+    return {'deleted': deleted}
+
+
+if __name__ == '__main__':
+  print ('Cannot execute as a program, it is a module')
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+import os
+import time
+from contextlib          import contextmanager
+
+__all__ = ["mark", "phase", "report"]
+
+# Imported first thing by serve.py, so this is as close to the start of the process as it gets
+started = time.perf_counter()
+last = started
+pid = os.getpid()
+phases = []         # [pid, name, seconds] in the order they happened
+
+def mark(name: str):
+    # Everything since the previous mark is charged to this phase
+    global last
+
+    now = time.perf_counter()
+    phases.append([os.getpid(), name, now - last])
+    last = now
+
+@contextmanager
+def phase(name: str):
+    mark("(untracked)")
+    try:
+        yield
+    finally:
+        mark(name)
+
+def report() -> str:
+    """Time spent in each startup phase of this worker, phases run before the fork are flagged."""
+
+    lines = [f"Startup of worker [{os.getpid()}]"]
+    total = 0.0
+    for phase_pid, name, seconds in phases:
+        if name == "(untracked)" and seconds < 0.001:
+            continue
+        total += seconds
+        forked = " (before fork)" if phase_pid != os.getpid() else ""
+        lines.append(f"  {seconds*1000:9.1f} ms  {name}{forked}")
+    lines.append(f"  {total*1000:9.1f} ms  total, run with 'python -X importtime' for a per module breakdown")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+  print ('Cannot execute as a program, it is a module')
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+import time
+import asyncio
+from pathlib             import Path
+from typing              import Annotated
+
+from fastapi             import Depends, APIRouter, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from langchain.schema    import HumanMessage, SystemMessage
+
+from libs.data           import SummaryRequest
+from libs.auth           import get_current_active_user, User
+from libs.providers      import registry, resolve_model_kwargs, sampling_kwargs, prompt_provider, CHAT_PROVIDERS
+from libs.params         import MODELS
+from libs                import dispatch
+from libs                import tokens
+from libs                import files
+from libs                import scheduler
+from libs                import usage
+from libs.scheduler      import Priority
+
+__all__ = ["router", "configure", "summarize", "CHUNK_TOKENS"]
+
+CHUNK_TOKENS = 1500         # Tokens of the document in each map call, when the request does not say
+MAX_PARALLELISM = 8
+REDUCE_PROMPT = ("Combine the partial summaries below, each of a consecutive part of the same document, into a single "
+                 "functional summary. Merge the overlapping points, keep every distinct requirement and feature.")
+
+router = APIRouter()
+
+def configure(parallelism: int):
+    global MAX_PARALLELISM
+
+    MAX_PARALLELISM = parallelism
+
+async def gather_all(calls: list) -> list:
+    # Like gather, but the first failure cancels the other calls, their results would be thrown away
+    tasks = [asyncio.ensure_future(call) for call in calls]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+def make_message(model_obj: dict, system: str | None, instructions: str, text: str):
+    if prompt_provider(model_obj) in CHAT_PROVIDERS:
+        return [SystemMessage(content=system or ""), HumanMessage(content=f"{instructions}\n\n{text}")]
+    return f"{system or ''}\n\n{instructions}\n\n{text}".strip()
+
+class Summarizer:
+    """Map-reduce summary of one document: every chunk is summarized on its own, then the summaries
+    are combined in groups that fit the context window, level after level, until one is left.
+
+    All the calls are deterministic (temperature 0) so they are answered from the response cache
+    whenever the same chunk, or the same group of summaries, was summarized before.
+    """
+
+    def __init__(self, request: SummaryRequest, model_obj: dict):
+        self.params = request.params.model_copy(update={'temperature': 0.0})
+        self.model_obj = model_obj
+        self.kwargs = resolve_model_kwargs(model_obj, self.params)
+        self.runnable = registry.bind(self.params.llmID, self.kwargs)
+        self.sampling = sampling_kwargs(model_obj, self.kwargs)
+        self.reduce_prompt = request.reduce_prompt or REDUCE_PROMPT
+        self.slots = asyncio.Semaphore(min(request.parallelism or MAX_PARALLELISM, MAX_PARALLELISM))
+        self.usage = {'calls': 0, 'cached': 0, 'prompt': 0, 'completion': 0}
+
+        # What a single call can take in besides the instructions and the response it leaves room for
+        overhead = (tokens.count_tokens(model_obj, self.params.system_prompt) + tokens.PROMPT_OVERHEAD +
+                    max(tokens.count_tokens(model_obj, self.instructions()), tokens.count_tokens(model_obj, self.reduce_prompt)))
+        window = model_obj.get('context_window')
+        self.input_budget = window - overhead - self.kwargs['max_new_tokens'] if window is not None else None
+        if self.input_budget is not None and self.input_budget < 256:
+            raise HTTPException(status_code=413, detail={'msg': f"max_new_tokens leaves no room for the document in the {window} token context window of [{model_obj['name']}]"})
+        self.chunk_tokens = request.chunk_tokens or CHUNK_TOKENS
+        if self.input_budget is not None:
+            self.chunk_tokens = min(self.chunk_tokens, self.input_budget)
+
+    def instructions(self) -> str:
+        if self.params.context:
+            return f"{self.params.context}\n\n{self.params.user_prompt}"
+        return self.params.user_prompt
+
+    async def generate(self, instructions: str, text: str) -> tuple:
+        message = make_message(self.model_obj, self.params.system_prompt, instructions, text)
+        counts = {'prompt': tokens.count_message(self.model_obj, message), 'max_completion': self.kwargs['max_new_tokens']}
+        call = dispatch.LLMCall(self.params.llmID, self.model_obj, self.runnable, message, self.sampling, self.params.use_cache, counts)
+        async with self.slots:
+            text = dispatch.response_text(await dispatch.ainvoke(call))
+
+        completion = tokens.count_tokens(self.model_obj, text)
+        usage.record(call.user, call.llmID, counts['prompt'], completion, call.cached or call.coalesced)
+        self.usage['calls'] += 1
+        if call.cached or call.coalesced:
+            self.usage['cached'] += 1
+        else:
+            self.usage['prompt'] += counts['prompt']
+            self.usage['completion'] += completion
+        return text, call.cached
+
+    def group(self, summaries: list) -> list:
+        # Consecutive summaries packed into groups of at least two that fit a single reduce call
+        budget = self.input_budget or sum(tokens.count_tokens(self.model_obj, summary) for summary in summaries)
+        groups = []
+        current = []
+        size = 0
+        for summary in summaries:
+            count = tokens.count_tokens(self.model_obj, summary)
+            if count > budget // 2:
+                summary = tokens.truncate_tokens(self.model_obj, summary, budget // 2)
+                count = budget // 2
+            if size + count > budget and len(current) >= 2:
+                groups.append(current)
+                current, size = [], 0
+            current.append(summary)
+            size += count
+        if len(current) == 1 and len(groups) > 0:
+            groups[-1].append(current[0])
+        elif current:
+            groups.append(current)
+        return groups
+
+    async def run(self, text: str) -> dict:
+        chunks = tokens.split_tokens(self.model_obj, text, self.chunk_tokens)
+        if len(chunks) == 0:
+            raise HTTPException(status_code=400, detail={'msg': "Nothing to summarize, the document is empty"})
+
+        mapped = await gather_all([self.generate(self.instructions(), chunk) for chunk in chunks])
+        summaries = [summary for summary, cached in mapped]
+
+        levels = 0
+        while len(summaries) > 1:
+            levels += 1
+            groups = self.group(summaries)
+            reduced = await gather_all([self.generate(self.reduce_prompt, "\n\n".join(group)) for group in groups])
+            summaries = [summary for summary, cached in reduced]
+
+        return {
+            'summary': summaries[0],
+            'chunks': [{'index': index, 'tokens': tokens.count_tokens(self.model_obj, chunk), 'cached': cached}
+                       for index, (chunk, (summary, cached)) in enumerate(zip(chunks, mapped))],
+            'levels': levels,
+            'usage': self.usage
+        }
+
+async def summarize(request: SummaryRequest) -> dict:
+    if request.file_path.find("..") != -1:
+        raise HTTPException(status_code=403, detail={'msg': "Forbidden access"})
+    model_obj = MODELS.get(request.params.llmID)
+    if model_obj is None:
+        raise HTTPException(status_code=404, detail={'msg':f"Model ID {request.params.llmID} not available"})
+
+    filepath = Path(files.INPUT_CODE_DIR) / request.file_path
+    if not filepath.is_file():
+        raise HTTPException(status_code=404, detail={'msg': f"Could not read {filepath.name}"})
+    text = await run_in_threadpool(files.read_document, filepath)
+
+    start = time.perf_counter()
+    result = await Summarizer(request, model_obj).run(text)
+    return {'file_path': request.file_path, **result, 'total_ms': round((time.perf_counter() - start)*1000, 1)}
+
+@router.post("/summarize/")
+async def summarize_file(request: SummaryRequest,
+                         current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    scheduler.classify(Priority.BATCH, current_user.username)
+    return await summarize(request)
+
+
+if __name__ == '__main__':
+  print ('Cannot execute as a program, it is a module')
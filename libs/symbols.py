@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+import ast
+import time
+import sqlite3
+import threading
+from pathlib             import Path
+from typing              import Annotated
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None        # No file locks (Windows), every worker then syncs the index at start
+
+import esprima
+from fastapi             import Depends, APIRouter, HTTPException
+
+from libs.auth           import get_current_active_user, User
+from libs.metrics        import timed_connection
+from libs.params         import MODELS
+from libs                import functions
+from libs                import tokens
+from libs                import files
+
+__all__ = ["router", "SymbolIndex", "configure", "get_index", "startup_sync", "file_changed", "neighborhood", "NEIGHBORHOOD_TOKENS"]
+
+NEIGHBORHOOD_TOKENS = 1500  # Tokens of the callers' and callees' code, when the request does not say
+MAX_DEPTH = 3
+MAX_CANDIDATES = 3          # Definitions a call by name resolves to at most, the closest ones
+STARTUP_SYNC_SECONDS = 300  # A sync at start this recent, by another worker, is not repeated
+SOURCE_SUFFIXES = functions.JS_SUFFIXES + functions.DOC_PAGE_SUFFIXES + ('.py',)
+
+index = None
+settings = {'db_name': None}
+settings_lock = threading.Lock()
+router = APIRouter()
+
+def empty_symbols() -> dict:
+    return {'symbols': [], 'calls': [], 'imports': [], 'exports': set()}
+
+def js_symbols(source: str, suffix: str) -> dict:
+    """Functions, classes, calls, imports and exports of a JS file, or of the <script> blocks of a page."""
+
+    found = empty_symbols()
+
+    def add_export(name):
+        if name:
+            found['exports'].add(name.split(".")[-1])
+
+    def visit(node, parent, scope: list, owner: str, line_offset: int):
+        line = node.loc.start.line + line_offset if node.loc is not None else 0
+        if node.type in functions.FUNCTION_TYPES or (node.type in ('ClassDeclaration', 'ClassExpression') and node.id is not None):
+            if node.type in functions.FUNCTION_TYPES:
+                name = functions.function_name(node, parent, line_offset)
+                kind = 'method' if parent is not None and parent.type == 'MethodDefinition' else 'function'
+            else:
+                name = node.id.name
+                kind = 'class'
+            outer = parent if parent is not None and parent.type in ('Property', 'MethodDefinition', 'VariableDeclarator') else node
+            qualified = ".".join(scope + [name])
+            found['symbols'].append({'name': name.split(".")[-1], 'qualified': qualified, 'kind': kind,
+                                     'start_line': outer.loc.start.line + line_offset, 'end_line': node.loc.end.line + line_offset})
+            scope, owner = scope + [name], qualified
+        elif node.type == 'VariableDeclarator' and node.init is not None and node.init.type == 'ObjectExpression':
+            scope = scope + [functions.key_name(node.id) or "object"]
+        elif node.type in ('CallExpression', 'NewExpression'):
+            callee = node.callee
+            name = callee.name if callee.type == 'Identifier' else \
+                   callee.property.name if callee.type == 'MemberExpression' and not callee.computed else None
+            if name == 'require' and len(node.arguments) > 0 and node.arguments[0].type == 'Literal':
+                local = functions.key_name(parent.id) if parent is not None and parent.type == 'VariableDeclarator' else None
+                found['imports'].append({'name': local or "*", 'source': str(node.arguments[0].value), 'imported': "*"})
+            elif name is not None:
+                found['calls'].append({'caller': owner, 'callee': name, 'line': line})
+        elif node.type == 'ImportDeclaration':
+            for spec in node.specifiers:
+                imported = spec.imported.name if getattr(spec, 'imported', None) is not None else \
+                           'default' if spec.type == 'ImportDefaultSpecifier' else "*"
+                found['imports'].append({'name': spec.local.name, 'source': node.source.value, 'imported': imported})
+        elif node.type == 'ExportNamedDeclaration':
+            declaration = node.declaration
+            if declaration is not None and getattr(declaration, 'id', None) is not None:
+                add_export(declaration.id.name)
+            elif declaration is not None and declaration.type == 'VariableDeclaration':
+                for declarator in declaration.declarations:
+                    add_export(functions.key_name(declarator.id))
+            for spec in node.specifiers or []:
+                add_export(spec.local.name)
+        elif node.type == 'ExportDefaultDeclaration':
+            add_export(getattr(node.declaration, 'id', None) and node.declaration.id.name)
+        elif node.type == 'AssignmentExpression':
+            target = functions.member_name(node.left) or ""
+            if target == 'module.exports' and node.right.type == 'ObjectExpression':
+                for prop in node.right.properties:
+                    add_export(functions.key_name(prop.key))
+            elif target == 'module.exports' and node.right.type == 'Identifier':
+                add_export(node.right.name)
+            elif target.startswith(('module.exports.', 'exports.')):
+                add_export(target)
+
+        for child in functions.children(node):
+            visit(child, node, scope, owner, line_offset)
+
+    for offset, block in functions.script_blocks(source, suffix):
+        try:
+            tree = functions.parse(block)
+        except esprima.Error as excp:
+            print(f"Skipping a script that does not parse [{excp}]")
+            continue
+        visit(tree, None, [], "", source.count("\n", 0, offset))
+    return found
+
+def python_symbols(source: str) -> dict:
+    found = empty_symbols()
+    module_all = None
+
+    def visit(node, scope: list, owner: str):
+        for child in ast.iter_child_nodes(node):
+            child_scope, child_owner = scope, owner
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                qualified = ".".join(scope + [child.name])
+                found['symbols'].append({
+                    'name': child.name, 'qualified': qualified,
+                    'kind': 'class' if isinstance(child, ast.ClassDef) else 'method' if scope and isinstance(node, ast.ClassDef) else 'function',
+                    'start_line': min([child.lineno] + [decorator.lineno for decorator in child.decorator_list]),
+                    'end_line': child.end_lineno})
+                if len(scope) == 0 and not child.name.startswith('_'):
+                    found['exports'].add(child.name)
+                child_scope, child_owner = scope + [child.name], qualified
+            elif isinstance(child, ast.Call):
+                func = child.func
+                name = func.id if isinstance(func, ast.Name) else func.attr if isinstance(func, ast.Attribute) else None
+                if name is not None:
+                    found['calls'].append({'caller': owner, 'callee': name, 'line': child.lineno})
+            elif isinstance(child, ast.Import):
+                for alias in child.names:
+                    found['imports'].append({'name': alias.asname or alias.name, 'source': alias.name, 'imported': "*"})
+            elif isinstance(child, ast.ImportFrom):
+                for alias in child.names:
+                    found['imports'].append({'name': alias.asname or alias.name, 'source': "." * child.level + (child.module or ""),
+                                             'imported': alias.name})
+            visit(child, child_scope, child_owner)
+
+    tree = ast.parse(source)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id == '__all__' for target in node.targets):
+            if isinstance(node.value, (ast.List, ast.Tuple)):
+                module_all = {elt.value for elt in node.value.elts if isinstance(elt, ast.Constant)}
+    visit(tree, [], "")
+    if module_all is not None:
+        found['exports'] = module_all
+    return found
+
+def extract_symbols(source: str, suffix: str) -> dict:
+    if suffix == '.py':
+        return python_symbols(source)
+    return js_symbols(source, suffix)
+
+class SymbolIndex:
+    """Definitions, call sites, imports and exports of the code tree, in SQLite tables shared by all the workers.
+
+    Like the full text index, every input file is indexed in its latest saved version under the
+    name of the input file, and only parsed again when its size or modification time changed.
+    Calls are recorded by the name they use, and resolved to definitions when they are looked up.
+    """
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.lock = threading.Lock()
+        self.conn = timed_connection(sqlite3.connect(db_name, check_same_thread=False, timeout=10), db_name)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.cursor = self.conn.cursor()
+        self.create_tables()
+
+    def create_tables(self):
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS symbol_files (
+                path TEXT PRIMARY KEY,
+                source TEXT,
+                mtime INTEGER,
+                size INTEGER,
+                indexed INTEGER
+            )
+        ''')
+
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS symbols (
+                id INTEGER PRIMARY KEY,
+                path TEXT,
+                name TEXT,
+                qualified TEXT,
+                kind TEXT,
+                start_line INTEGER,
+                end_line INTEGER,
+                exported INTEGER
+            )
+        ''')
+
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS calls (
+                path TEXT,
+                caller TEXT,
+                callee TEXT,
+                line INTEGER
+            )
+        ''')
+
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS imports (
+                path TEXT,
+                name TEXT,
+                source TEXT,
+                imported TEXT
+            )
+        ''')
+
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS symbols_name_idx ON symbols (name)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS symbols_path_idx ON symbols (path, qualified)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS calls_callee_idx ON calls (callee)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS calls_caller_idx ON calls (path, caller)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS imports_path_idx ON imports (path)')
+        self.conn.commit()
+
+    def update_file(self, relative: Path) -> bool:
+        # Returns whether the file had to be parsed again
+        source = files.get_latest_version(relative)
+        path = relative.as_posix()
+        if not source.is_file():
+            return self.remove_file(path)
+
+        stat = source.stat()
+        with self.lock:
+            self.cursor.execute('SELECT source, mtime, size FROM symbol_files WHERE path = ?', (path,))
+            if self.cursor.fetchone() == (source.as_posix(), stat.st_mtime_ns, stat.st_size):
+                return False
+
+        try:
+            found = extract_symbols(source.read_text(), source.suffix.lower())
+        except (OSError, UnicodeDecodeError, SyntaxError, ValueError) as excp:
+            print(f"Could not index the symbols of [{source}] [{excp}]")
+            found = empty_symbols()
+
+        with self.lock:
+            for table in ('symbols', 'calls', 'imports'):
+                self.cursor.execute(f'DELETE FROM {table} WHERE path = ?', (path,))
+            self.cursor.executemany('INSERT INTO symbols (path, name, qualified, kind, start_line, end_line, exported) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    [(path, symbol['name'], symbol['qualified'], symbol['kind'], symbol['start_line'], symbol['end_line'],
+                                      int(symbol['name'] in found['exports'] and "." not in symbol['qualified']))
+                                     for symbol in found['symbols']])
+            self.cursor.executemany('INSERT INTO calls VALUES (?, ?, ?, ?)',
+                                    [(path, call['caller'], call['callee'], call['line']) for call in found['calls']])
+            self.cursor.executemany('INSERT INTO imports VALUES (?, ?, ?, ?)',
+                                    [(path, imp['name'], imp['source'], imp['imported']) for imp in found['imports']])
+            self.cursor.execute('INSERT OR REPLACE INTO symbol_files VALUES (?, ?, ?, ?, ?)',
+                                (path, source.as_posix(), stat.st_mtime_ns, stat.st_size, int(time.time()*1000)))
+            self.conn.commit()
+        return True
+
+    def remove_file(self, path: str) -> bool:
+        with self.lock:
+            for table in ('symbols', 'calls', 'imports'):
+                self.cursor.execute(f'DELETE FROM {table} WHERE path = ?', (path,))
+            removed = self.cursor.execute('DELETE FROM symbol_files WHERE path = ?', (path,)).rowcount
+            self.conn.commit()
+        return removed > 0
+
+    def sync(self) -> dict:
+        # Parse the new and changed source files of the input directory, drop the deleted ones
+        start = time.perf_counter()
+        root = Path(files.INPUT_CODE_DIR)
+        found = set()
+        updated = 0
+        for filepath in root.rglob("*"):
+            relative = filepath.relative_to(root)
+            if (not filepath.is_file() or filepath.suffix.lower() not in SOURCE_SUFFIXES or
+                    any(part.startswith(('_', '.')) for part in relative.parts)):
+                continue
+            found.add(relative.as_posix())
+            updated += self.update_file(relative)
+
+        with self.lock:
+            self.cursor.execute('SELECT path FROM symbol_files')
+            gone = [path for (path,) in self.cursor.fetchall() if path not in found]
+        for path in gone:
+            self.remove_file(path)
+        return {'files': len(found), 'updated': updated, 'removed': len(gone), 'total_ms': round((time.perf_counter() - start)*1000, 1)}
+
+    def query(self, sql: str, args: tuple) -> list:
+        with self.lock:
+            self.cursor.execute(sql, args)
+            columns = [column[0] for column in self.cursor.description]
+            return [dict(zip(columns, row)) for row in self.cursor.fetchall()]
+
+    def find(self, name: str, path: str | None = None) -> list:
+        # By qualified name, or by name when that finds nothing
+        where = ' AND path = ?' if path else ''
+        args = (path,) if path else ()
+        found = self.query('SELECT * FROM symbols WHERE qualified = ?' + where, (name,) + args)
+        return found or self.query('SELECT * FROM symbols WHERE name = ?' + where, (name.split(".")[-1],) + args)
+
+    def resolve(self, callee: str, path: str) -> list:
+        """Definitions a call by this name from the file most likely reaches: in the file itself,
+        else in the files it imports the name from, else the exported ones, else any."""
+
+        candidates = self.query('SELECT * FROM symbols WHERE name = ?', (callee,))
+        if len(candidates) == 0:
+            return []
+        local = [symbol for symbol in candidates if symbol['path'] == path]
+        if local:
+            return local[:MAX_CANDIDATES]
+        sources = [Path(row['source']).stem for row in self.query('SELECT source FROM imports WHERE path = ? AND (name = ? OR imported = ? OR imported = ?)',
+                                                                  (path, callee, callee, "*"))]
+        imported = [symbol for symbol in candidates if Path(symbol['path']).stem in sources]
+        if imported:
+            return imported[:MAX_CANDIDATES]
+        exported = [symbol for symbol in candidates if symbol['exported']]
+        return (exported or candidates)[:MAX_CANDIDATES]
+
+    def callees(self, symbol: dict) -> list:
+        calls = self.query('SELECT DISTINCT callee FROM calls WHERE path = ? AND caller = ?', (symbol['path'], symbol['qualified']))
+        return [target for call in calls for target in self.resolve(call['callee'], symbol['path']) if target['id'] != symbol['id']]
+
+    def callers(self, symbol: dict) -> list:
+        # The functions calling its name that resolve the call to this very definition
+        found = []
+        for call in self.query('SELECT DISTINCT path, caller FROM calls WHERE callee = ? AND caller != ?', (symbol['name'], "")):
+            if any(target['id'] == symbol['id'] for target in self.resolve(symbol['name'], call['path'])):
+                found.extend(caller for caller in self.query('SELECT * FROM symbols WHERE path = ? AND qualified = ?', (call['path'], call['caller']))
+                             if caller['id'] != symbol['id'])
+        return found
+
+    def stats(self) -> dict:
+        counts = {}
+        for table in ('symbol_files', 'symbols', 'calls', 'imports'):
+            counts[table] = self.query(f'SELECT COUNT(*) AS count FROM {table}', ())[0]['count']
+        return counts
+
+def configure(db_name: str, context_tokens: int):
+    global index, NEIGHBORHOOD_TOKENS
+
+    # The database is opened on first use, in the worker process that uses it
+    settings['db_name'] = db_name
+    NEIGHBORHOOD_TOKENS = context_tokens
+    index = None
+
+def get_index() -> SymbolIndex:
+    global index
+
+    if index is None:
+        with settings_lock:
+            if index is None:
+                index = SymbolIndex(settings['db_name'])
+    return index
+
+def startup_sync() -> dict | None:
+    """Sync of the symbols at server start, run once for all the workers sharing the database.
+
+    Same scheme as the retrieval index, with its own stamp file as both share the database.
+    Returns None when another worker synced or is syncing.
+    """
+
+    if fcntl is None:
+        return get_index().sync()
+
+    with open(settings['db_name'] + ".symbols.sync", 'a+') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        try:
+            lock_file.seek(0)
+            try:
+                if time.time() - float(lock_file.read()) < STARTUP_SYNC_SECONDS:
+                    return None
+            except ValueError:
+                pass            # Not stamped yet
+            result = get_index().sync()
+            lock_file.truncate(0)
+            lock_file.write(str(time.time()))
+            return result
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def file_changed(file_name: str):
+    # Called when an input file is uploaded or a new version of it saved, the name with or without version
+    split_name = Path(file_name).name.split('.')
+    if len(split_name) >= 3 and split_name[-2].isdigit():
+        split_name.pop(-2)
+    elif len(split_name) == 2 and split_name[-1].isdigit():
+        split_name.pop(-1)
+    relative = Path(file_name).with_name(".".join(split_name))
+    if relative.suffix.lower() not in SOURCE_SUFFIXES:
+        return
+    try:
+        get_index().update_file(relative)
+    except Exception as excp:
+        print(f"Indexing the symbols of [{file_name}] failed [{excp}]")
+
+def symbol_source(symbol: dict, cache: dict) -> str:
+    path = symbol['path']
+    if path not in cache:
+        try:
+            cache[path] = files.get_latest_version(Path(path)).read_text().split("\n")
+        except OSError:
+            cache[path] = []
+    return "\n".join(cache[path][symbol['start_line'] - 1:symbol['end_line']])
+
+def neighborhood(model_obj: dict, name: str, path: str | None = None, depth: int = 2, budget: int | None = None) -> dict:
+    """The functions a function calls and is called by, transitively up to depth, nearest first and
+    with their code as long as it fits the token budget."""
+
+    start = time.perf_counter()
+    symbol_index = get_index()
+    roots = symbol_index.find(name, path)
+    if len(roots) == 0:
+        raise HTTPException(status_code=404, detail={'msg': f"No function or class named [{name}] in the index"})
+    root = roots[0]
+    budget = budget if budget is not None else NEIGHBORHOOD_TOKENS
+    depth = max(1, min(depth, MAX_DEPTH))
+
+    seen = {root['id']}
+    nodes = []
+    frontier = [(root, None)]
+    for distance in range(1, depth + 1):
+        following = []
+        for symbol, direction in frontier:
+            # Callees of callees and callers of callers, not the other callers of a callee
+            if direction in (None, 'callee'):
+                following.extend((target, 'callee') for target in symbol_index.callees(symbol))
+            if direction in (None, 'caller'):
+                following.extend((target, 'caller') for target in symbol_index.callers(symbol))
+        frontier = []
+        for symbol, direction in following:
+            if symbol['id'] in seen:
+                continue
+            seen.add(symbol['id'])
+            nodes.append({**symbol, 'direction': direction, 'distance': distance})
+            frontier.append((symbol, direction))
+
+    sources = {}
+    used = 0
+    for node in nodes:
+        code = symbol_source(node, sources)
+        count = tokens.count_tokens(model_obj, code)
+        node['tokens'] = count
+        if used + count <= budget:
+            node['source'] = code
+            used += count
+        else:
+            node['source'] = None       # Listed, its code does not fit
+
+    return {
+        'symbol': {**root, 'source': symbol_source(root, sources)},
+        'others': [{key: value for key, value in candidate.items()} for candidate in roots[1:]],
+        'neighbors': nodes,
+        'tokens': used,
+        'total_ms': round((time.perf_counter() - start)*1000, 1)
+    }
+
+def neighborhood_context(result: dict) -> str:
+    parts = []
+    for node in result['neighbors']:
+        if node['source'] is not None:
+            relation = "Called by" if node['direction'] == 'caller' else "Calls"
+            parts.append(f"// {relation} {node['qualified']} ({node['path']} lines {node['start_line']}-{node['end_line']})\n{node['source']}")
+    return "\n\n".join(parts)
+
+@router.get("/symbols/")
+def find_symbols(name: str, current_user: Annotated[User, Depends(get_current_active_user)], path: str | None = None) -> dict:
+    return {'symbols': get_index().find(name, path)}
+
+@router.get("/symbols/neighborhood")
+def get_neighborhood(name: str, current_user: Annotated[User, Depends(get_current_active_user)],
+                     path: str | None = None, depth: int = 2, budget: int | None = None, llmID: str | None = None) -> dict:
+    model_obj = MODELS.get(llmID) if llmID is not None else next(iter(MODELS.values()), None)
+    if model_obj is None:
+        raise HTTPException(status_code=404, detail={'msg':f"Model ID {llmID} not available"})
+    result = neighborhood(model_obj, name, path, depth, budget)
+    return {**result, 'context': neighborhood_context(result)}
+
+@router.get("/symbols/stats")
+def get_index_stats(current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    return get_index().stats()
+
+@router.post("/symbols/reindex")
+def reindex(current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    return get_index().sync()
+
+
+if __name__ == '__main__':
+  print ('Cannot execute as a program, it is a module')
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+import re
+import hashlib
+from functools           import lru_cache
+
+import tiktoken
+from fastapi             import HTTPException
+from langchain.schema    import BaseMessage
+
+__all__ = ["get_encoder", "count_tokens", "count_message", "truncate_tokens", "split_tokens", "fit_prompt", "cap_completion", "preload", "configure", "TRUNCATION_POLICY"]
+
+TRUNCATION_POLICY = ['context', 'history', 'code']   # Order in which sections give up tokens
+TRUNCATION_MARKER = "\n...[truncated to fit the model's context window]"
+MESSAGE_OVERHEAD = 4      # Role and separators the chat format adds to each message
+PROMPT_OVERHEAD = 32      # Fixed instructions format_prompt wraps around the sections
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
+BOUNDARY_ODDS = 4         # One sentence in this many may end a chunk early, see split_tokens()
+
+class ApproximateEncoder:
+    """Stand-in when a BPE file cannot be fetched (no internet access), about 4 characters a token."""
+
+    def encode(self, text: str, disallowed_special=()) -> list:
+        return [text[i:i+4] for i in range(0, len(text), 4)]
+
+    def decode(self, tokens: list) -> str:
+        return "".join(tokens)
+
+@lru_cache(maxsize=None)
+def get_encoder(model: str):
+    # Loading a BPE is expensive, one encoder per model for the life of the worker
+    name = model
+    if model.startswith('gpt-35'):
+        # Azure deployment names drop the dot of the OpenAI model names
+        name = model.replace('gpt-35', 'gpt-3.5', 1)
+
+    try:
+        try:
+            return tiktoken.encoding_for_model(name)
+        except KeyError:
+            # Not an OpenAI model, cl100k is a close enough estimate for budgeting
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception as excp:
+        print(f"Tokenizer for [{model}] not available, approximating token counts [{excp}]")
+        return ApproximateEncoder()
+
+def count_tokens(model_obj: dict, text: str | None) -> int:
+    if not text:
+        return 0
+    return len(get_encoder(model_obj['id_for_prvdr']).encode(text, disallowed_special=()))
+
+def count_message(model_obj: dict, message) -> int:
+    # Exact count of a formatted prompt, either a plain string or a list of chat messages
+    if isinstance(message, list):
+        return sum(count_tokens(model_obj, str(msg.content if isinstance(msg, BaseMessage) else msg)) + MESSAGE_OVERHEAD
+                   for msg in message)
+    return count_tokens(model_obj, str(message))
+
+def truncate_tokens(model_obj: dict, text: str, keep: int) -> str:
+    # Keep the leading `keep` tokens of text, marker included
+    encoder = get_encoder(model_obj['id_for_prvdr'])
+    keep -= len(encoder.encode(TRUNCATION_MARKER))
+    if keep <= 0:
+        return ""
+    tokens = encoder.encode(text, disallowed_special=())
+    return encoder.decode(tokens[:keep]) + TRUNCATION_MARKER
+
+def split_tokens(model_obj: dict, text: str, max_tokens: int) -> list:
+    """Split text at sentence ends into chunks of at most max_tokens tokens.
+
+    Once a chunk is half full it also ends after any sentence whose hash picks it as a boundary.
+    Boundaries so depend on the nearby text only, after an edit the chunks fall back in step with
+    those of the earlier version and only the chunks around the edit change.
+    """
+
+    encoder = get_encoder(model_obj['id_for_prvdr'])
+    chunks = []
+    current = []
+    size = 0
+    for sentence in SENTENCE_END.split(text):
+        if not sentence or sentence.isspace():
+            continue
+        tokens = encoder.encode(sentence + " ", disallowed_special=())
+        while len(tokens) > max_tokens:
+            # A sentence longer than a chunk is cut at token boundaries
+            if current:
+                chunks.append(" ".join(current))
+                current, size = [], 0
+            chunks.append(encoder.decode(tokens[:max_tokens]))
+            tokens = tokens[max_tokens:]
+            sentence = encoder.decode(tokens)
+        if size + len(tokens) > max_tokens and current:
+            chunks.append(" ".join(current))
+            current, size = [], 0
+        current.append(sentence.strip())
+        size += len(tokens)
+        if size >= max_tokens // 2 and int(hashlib.md5(sentence.encode()).hexdigest(), 16) % BOUNDARY_ODDS == 0:
+            chunks.append(" ".join(current))
+            current, size = [], 0
+
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+def fit_prompt(model_obj: dict, system: str, context: str, code: str, user: str, history: list | None, max_new_tokens: int) -> dict:
+    """Count the tokens of every prompt section and trim them to fit the model's context window.
+
+    Sections are trimmed in TRUNCATION_POLICY order, history loses its oldest exchanges first.
+    The completion gets max_new_tokens but never more than half of the window is held back for it,
+    what is left after the prompt caps the completion instead (see cap_completion()). Raises 413
+    when even fully trimmed sections do not fit.
+    """
+
+    history = list(history) if history else []
+    counts = {
+        'system': count_tokens(model_obj, system),
+        'context': count_tokens(model_obj, context),
+        'code': count_tokens(model_obj, code),
+        'user': count_tokens(model_obj, user),
+        'history': [count_tokens(model_obj, exchg.user) + count_tokens(model_obj, exchg.ai) + 2*MESSAGE_OVERHEAD for exchg in history]
+    }
+
+    def prompt_total():
+        return PROMPT_OVERHEAD + counts['system'] + counts['context'] + counts['code'] + counts['user'] + sum(counts['history'])
+
+    truncated = []
+    window = model_obj.get('context_window')
+    if window is not None:
+        reserve = min(max_new_tokens, window // 2)
+        over = prompt_total() - (window - reserve)
+        for section in TRUNCATION_POLICY:
+            if over <= 0:
+                break
+            if section == 'history':
+                while over > 0 and len(history) > 0:
+                    history.pop(0)
+                    over -= counts['history'].pop(0)
+                    if 'history' not in truncated:
+                        truncated.append('history')
+            elif section in ('context', 'code') and counts[section] > 0:
+                keep = max(0, counts[section] - over)
+                if section == 'context':
+                    context = truncate_tokens(model_obj, context, keep)
+                else:
+                    code = truncate_tokens(model_obj, code, keep)
+                over -= counts[section]
+                counts[section] = count_tokens(model_obj, context if section == 'context' else code)
+                over += counts[section]
+                truncated.append(section)
+
+        if over > 0:
+            raise HTTPException(status_code=413, detail={'msg': f"Prompt of {prompt_total()} tokens does not fit the {window} token context window of [{model_obj['name']}]",
+                                                         'tokens': {**counts, 'history': sum(counts['history'])}})
+
+    return {
+        'context': context,
+        'code': code,
+        'history': history,
+        'tokens': {
+            'system': counts['system'],
+            'context': counts['context'],
+            'code': counts['code'],
+            'user': counts['user'],
+            'history': sum(counts['history']),
+            'context_window': window,
+            'truncated': truncated
+        }
+    }
+
+def cap_completion(model_obj: dict, prompt_tokens: int, max_new_tokens: int) -> int:
+    # Whatever the formatted prompt leaves of the context window is all the completion can get
+    window = model_obj.get('context_window')
+    if window is None:
+        return max_new_tokens
+    if prompt_tokens >= window:
+        raise HTTPException(status_code=413, detail={'msg': f"Prompt of {prompt_tokens} tokens does not fit the {window} token context window of [{model_obj['name']}]"})
+    return min(max_new_tokens, window - prompt_tokens)
+
+def preload(models: dict):
+    # Tokenizers of the enabled models, loaded before forking the workers share their tables
+    for model_obj in models.values():
+        if model_obj.get('enabled'):
+            get_encoder(model_obj['id_for_prvdr'])
+
+def configure(policy: list):
+    global TRUNCATION_POLICY
+
+    for section in policy:
+        if section not in ('context', 'history', 'code'):
+            raise ValueError(f"Unknown prompt section [{section}] in truncation policy")
+    TRUNCATION_POLICY = policy
+
+
+if __name__ == '__main__':
+  print ('Cannot execute as a program, it is a module')
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+import time
+import asyncio
+from datetime            import date, timedelta
+from typing              import Annotated
+
+from fastapi             import Depends, APIRouter, HTTPException
+from fastapi.concurrency import run_in_threadpool
+
+from libs.auth           import get_current_active_user, User, sqlite_dbname
+from libs.user_db        import UserDatabase, UsageDatabase
+
+__all__ = ["router", "configure", "record", "check_quota", "flusher", "flush", "DAILY_QUOTA", "MONTHLY_QUOTA"]
+
+DAILY_QUOTA = 0         # Tokens a user may use per day, when the user has no quota of their own. 0 is no limit
+MONTHLY_QUOTA = 0
+FLUSH_SECONDS = 5       # Usage is written to the database this often
+FLUSH_RECORDS = 200     #   or as soon as this many users, models & days have some
+TOTALS_SECONDS = 30     # Usage totals read from the database are trusted this long, other workers add to them
+
+router = APIRouter()
+pending = {}            # (username, llmID, day) -> [calls, cached, prompt tokens, completion tokens] not yet written
+totals = {}             # username -> user ID, quota and usage of the day & month as last read from the database
+wakeup = None
+quota_check = {'set': False, 'checked': 0.0}
+
+def configure(daily: int, monthly: int):
+    global DAILY_QUOTA, MONTHLY_QUOTA
+
+    DAILY_QUOTA = daily
+    MONTHLY_QUOTA = monthly
+
+def record(username: str | None, llmID: str, prompt: int, completion: int, cached: bool):
+    """Account a call to the user, written to the database by the flusher."""
+
+    entry = pending.setdefault((username or "anonymous", llmID, date.today().isoformat()), [0, 0, 0, 0])
+    entry[0] += 1
+    if cached:
+        entry[1] += 1
+    else:
+        entry[2] += prompt
+        entry[3] += completion
+    if len(pending) >= FLUSH_RECORDS and wakeup is not None:
+        wakeup.set()
+
+def pending_tokens(username: str, since_day: str) -> int:
+    return sum(entry[2] + entry[3] for (name, llmID, day), entry in pending.items() if name == username and day >= since_day)
+
+def load_totals(username: str) -> dict:
+    today = date.today()
+    user_id = UserDatabase(sqlite_dbname).get_user_id_by_username(username)
+    usage_db = UsageDatabase(sqlite_dbname)
+    quota = usage_db.get_quota(user_id) if user_id is not None else None
+    return {
+        'user_id': user_id,
+        'day': today.isoformat(),
+        'quota': quota or {'daily': DAILY_QUOTA or None, 'monthly': MONTHLY_QUOTA or None},
+        'daily': usage_db.get_tokens_used(user_id, today.isoformat()) if user_id is not None else 0,
+        'monthly': usage_db.get_tokens_used(user_id, today.replace(day=1).isoformat()) if user_id is not None else 0,
+        'loaded': time.monotonic()
+    }
+
+def stale(entry: dict | None) -> bool:
+    return entry is None or entry['day'] != date.today().isoformat() or time.monotonic() - entry['loaded'] > TOTALS_SECONDS
+
+def quotas_set() -> bool:
+    # Without default quotas, only users with a quota of their own need their usage read
+    if time.monotonic() - quota_check['checked'] > TOTALS_SECONDS:
+        quota_check.update({'set': UsageDatabase(sqlite_dbname).has_quotas(), 'checked': time.monotonic()})
+    return quota_check['set']
+
+async def check_quota(username: str | None, estimated: int):
+    """Refuse a call that would take the user over their daily or monthly token quota."""
+
+    if username is None:
+        return
+    if DAILY_QUOTA == 0 and MONTHLY_QUOTA == 0 and not await run_in_threadpool(quotas_set):
+        return
+    entry = totals.get(username)
+    if stale(entry):
+        entry = totals[username] = await run_in_threadpool(load_totals, username)
+    today = date.today()
+    daily = entry['daily'] + pending_tokens(username, today.isoformat())
+    monthly = entry['monthly'] + pending_tokens(username, today.replace(day=1).isoformat())
+    quota = entry['quota']
+    if quota['daily'] is not None and daily + estimated > quota['daily']:
+        raise HTTPException(status_code=429, detail={'msg': f"Daily token quota of {quota['daily']} reached, {daily} used today"})
+    if quota['monthly'] is not None and monthly + estimated > quota['monthly']:
+        raise HTTPException(status_code=429, detail={'msg': f"Monthly token quota of {quota['monthly']} reached, {monthly} used this month"})
+
+def write_pending(batch: dict):
+    users_db = UserDatabase(sqlite_dbname)
+    ids = {}
+    records = []
+    for (username, llmID, day), (calls, cached, prompt, completion) in batch.items():
+        if username not in ids:
+            ids[username] = users_db.get_user_id_by_username(username)
+        records.append((ids[username], llmID, day, calls, cached, prompt, completion))
+    UsageDatabase(sqlite_dbname).add_usage(records)
+
+    # Totals of the users who just used the models, they now include what was written
+    for username in ids:
+        if username in totals:
+            totals[username] = load_totals(username)
+
+async def flush():
+    global pending
+
+    if len(pending) == 0:
+        return
+    batch, pending = pending, {}
+    try:
+        await run_in_threadpool(write_pending, batch)
+    except Exception as excp:
+        print(f"Writing token usage failed [{excp}], keeping it for the next flush")
+        for key, values in batch.items():
+            entry = pending.setdefault(key, [0, 0, 0, 0])
+            for index, value in enumerate(values):
+                entry[index] += value
+
+async def flusher():
+    global wakeup
+
+    wakeup = asyncio.Event()
+    while True:
+        try:
+            await asyncio.wait_for(wakeup.wait(), FLUSH_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
+        await flush()
+
+@router.get("/usage/")
+async def get_usage(current_user: Annotated[User, Depends(get_current_active_user)], days: int = 30) -> dict:
+    await flush()
+    user_id = await run_in_threadpool(lambda: UserDatabase(sqlite_dbname).get_user_id_by_username(current_user.username))
+    if user_id is None:
+        raise HTTPException(status_code=404, detail={'msg':f"No user found with name [{current_user.username}]"})
+    since = (date.today() - timedelta(days=max(days, 1) - 1)).isoformat()
+    usage = await run_in_threadpool(lambda: UsageDatabase(sqlite_dbname).get_usage(user_id, since))
+    return {'since': since, 'usage': usage,
+            'prompt_tokens': sum(row['prompt_tokens'] for row in usage),
+            'completion_tokens': sum(row['completion_tokens'] for row in usage)}
+
+@router.get("/usage/quota")
+async def get_quota(current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    await flush()
+    entry = await run_in_threadpool(load_totals, current_user.username)
+    totals[current_user.username] = entry
+    return {'quota': entry['quota'], 'used': {'daily': entry['daily'], 'monthly': entry['monthly']}}
+
+
+if __name__ == '__main__':
+  print ('Cannot execute as a program, it is a module')
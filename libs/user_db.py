@@ -24,10 +24,13 @@ __author__  = "Shalin Garg"
 
 import sqlite3 
 import hashlib
+import uuid
 from enum import StrEnum
 from datetime import datetime
 
-__all__ = ['User', 'UserCredentials', 'UserDatabase', 'ParamsType', 'ParamsDatabase']
+from libs.metrics import timed_connection
+
+__all__ = ['User', 'UserCredentials', 'UserDatabase', 'ParamsType', 'ParamsDatabase', 'ChatSessionDatabase', 'JobsDatabase', 'JobStatus', 'UsageDatabase']
 
 class ParamsType(StrEnum):
     LLM_PARAMS = 'llm_params'
@@ -79,7 +82,7 @@ class LLMParamsRec:
 class UserDatabase: 
     def __init__(self, db_name): 
         self.db_name = db_name
-        self.conn = sqlite3.connect(db_name) 
+        self.conn = timed_connection(sqlite3.connect(db_name), db_name)
         self.cursor = self.conn.cursor() 
         self.create_tables()
     
@@ -209,7 +212,7 @@ class UserDatabase:
 class ParamsDatabase:
     def __init__(self, db_name): 
         self.db_name = db_name
-        self.conn = sqlite3.connect(db_name) 
+        self.conn = timed_connection(sqlite3.connect(db_name), db_name)
         self.cursor = self.conn.cursor() 
         self.create_tables()
     
@@ -386,4 +389,316 @@ class ParamsDatabase:
         return self.cursor.rowcount
 
     def hash_data(self, data:str):
-        return hashlib.sha256(data.encode()).hexdigest()
\ No newline at end of file
+        return hashlib.sha256(data.encode()).hexdigest()
+
+class ChatSessionDatabase:
+    def __init__(self, db_name): 
+        self.db_name = db_name
+        self.conn = timed_connection(sqlite3.connect(db_name, timeout=10), db_name)
+        self.cursor = self.conn.cursor() 
+        self.create_tables()
+
+    # Exchanges up to the 'summarized' seq of a session have been folded into its summary, only the
+    #   ones after it are sent to the model verbatim
+    def create_tables(self):
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_sessions (
+                id TEXT PRIMARY KEY,
+                user_id INTEGER,
+                created INTEGER,
+                updated INTEGER,
+                summary TEXT,
+                summarized INTEGER,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
+
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_exchanges (
+                session_id TEXT,
+                seq INTEGER,
+                tm INTEGER,
+                user TEXT,
+                ai TEXT,
+                tokens INTEGER,
+                PRIMARY KEY (session_id, seq),
+                FOREIGN KEY (session_id) REFERENCES chat_sessions (id)
+            )
+        ''')
+        self.conn.commit()
+
+    def create_session(self, user_id):
+        session_id = uuid.uuid4().hex
+        now = int(datetime.now().timestamp()*1000)
+        self.cursor.execute("INSERT INTO chat_sessions ('id', 'user_id', 'created', 'updated', 'summary', 'summarized') VALUES (?, ?, ?, ?, NULL, 0)",
+                            (session_id, user_id, now, now))
+        self.conn.commit()
+        return session_id
+
+    def get_session(self, session_id, user_id):
+        self.cursor.execute('SELECT id, created, updated, summary, summarized FROM chat_sessions WHERE id = ? AND user_id = ?', (session_id, user_id))
+        row = self.cursor.fetchone()
+        if row:
+            id, created, updated, summary, summarized = row
+            return {'id': id, 'created': created, 'updated': updated, 'summary': summary, 'summarized': summarized}
+        return None
+
+    def get_sessions(self, user_id):
+        self.cursor.execute('''
+            SELECT s.id, s.created, s.updated, count(e.seq) FROM chat_sessions s LEFT JOIN chat_exchanges e ON e.session_id = s.id
+                WHERE s.user_id = ? GROUP BY s.id ORDER BY s.updated DESC
+        ''', (user_id,))
+        return [{'id': id, 'created': created, 'updated': updated, 'exchanges': count} for id, created, updated, count in self.cursor.fetchall()]
+
+    def add_exchange(self, session_id, user, ai, tokens):
+        now = int(datetime.now().timestamp()*1000)
+        # Next seq taken in the insert itself, concurrent writers to a session never read the same max
+        self.cursor.execute("INSERT INTO chat_exchanges ('session_id', 'seq', 'tm', 'user', 'ai', 'tokens') "
+                            "SELECT ?, coalesce(max(seq), 0) + 1, ?, ?, ?, ? FROM chat_exchanges WHERE session_id = ? RETURNING seq",
+                            (session_id, now, user, ai, tokens, session_id))
+        seq = self.cursor.fetchone()[0]
+        self.cursor.execute('UPDATE chat_sessions SET updated = ? WHERE id = ?', (now, session_id))
+        self.conn.commit()
+        return seq
+
+    def get_exchanges(self, session_id, after_seq=0):
+        self.cursor.execute('SELECT seq, user, ai, tokens FROM chat_exchanges WHERE session_id = ? AND seq > ? ORDER BY seq', (session_id, after_seq))
+        return [{'seq': seq, 'user': user, 'ai': ai, 'tokens': tokens} for seq, user, ai, tokens in self.cursor.fetchall()]
+
+    def set_summary(self, session_id, summary, upto_seq):
+        # Never move back, another worker may already have folded in more exchanges
+        self.cursor.execute('UPDATE chat_sessions SET summary = ?, summarized = ? WHERE id = ? AND summarized < ?',
+                            (summary, upto_seq, session_id, upto_seq))
+        self.conn.commit()
+        return self.cursor.rowcount
+
+    def delete_session(self, session_id, user_id):
+        self.cursor.execute('DELETE FROM chat_sessions WHERE id = ? AND user_id = ?', (session_id, user_id))
+        deleted = self.cursor.rowcount
+        if deleted:
+            self.cursor.execute('DELETE FROM chat_exchanges WHERE session_id = ?', (session_id,))
+        self.conn.commit()
+        return deleted
+
+class JobStatus(StrEnum):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+class JobsDatabase:
+    def __init__(self, db_name): 
+        self.db_name = db_name
+        self.conn = timed_connection(sqlite3.connect(db_name, timeout=10), db_name)
+        self.cursor = self.conn.cursor() 
+        self.create_tables()
+
+    # A running job belongs to the worker process named in 'owner', which keeps 'heartbeat' fresh
+    #   while it runs. Jobs of a worker that stopped beating are picked up again by the others.
+    #   Every claim gets a new 'claim' token, only the run holding it may beat or finish the job
+    def create_tables(self):
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                user_id INTEGER,
+                created INTEGER,
+                updated INTEGER,
+                status TEXT,
+                attempts INTEGER,
+                params TEXT,
+                result TEXT,
+                error TEXT,
+                owner TEXT,
+                claim TEXT,
+                heartbeat INTEGER,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)')
+        self.conn.commit()
+
+    def job_dict(self, row):
+        id, user_id, created, updated, status, attempts, params, result, error = row
+        return {'id': id, 'user_id': user_id, 'created': created, 'updated': updated, 'status': status,
+                'attempts': attempts, 'params': params, 'result': result, 'error': error}
+
+    def add_job(self, user_id, params):
+        job_id = uuid.uuid4().hex
+        now = int(datetime.now().timestamp()*1000)
+        self.cursor.execute("INSERT INTO jobs ('id', 'user_id', 'created', 'updated', 'status', 'attempts', 'params') VALUES (?, ?, ?, ?, ?, 0, ?)",
+                            (job_id, user_id, now, now, JobStatus.QUEUED, params))
+        self.conn.commit()
+        return job_id
+
+    def get_job(self, job_id, user_id=None):
+        if user_id is None:
+            self.cursor.execute('SELECT id, user_id, created, updated, status, attempts, params, result, error FROM jobs WHERE id = ?', (job_id,))
+        else:
+            self.cursor.execute('SELECT id, user_id, created, updated, status, attempts, params, result, error FROM jobs WHERE id = ? AND user_id = ?', (job_id, user_id))
+        row = self.cursor.fetchone()
+        if row:
+            return self.job_dict(row)
+        return None
+
+    def get_jobs(self, user_id, limit=100):
+        self.cursor.execute('SELECT id, created, updated, status, attempts, error FROM jobs WHERE user_id = ? ORDER BY created DESC LIMIT ?', (user_id, limit))
+        return [{'id': id, 'created': created, 'updated': updated, 'status': status, 'attempts': attempts, 'error': error}
+                for id, created, updated, status, attempts, error in self.cursor.fetchall()]
+
+    def claim_job(self, owner, stale_before, max_attempts, exclude=()):
+        # Oldest queued job, or one whose worker died, becomes the owner's. Exclusive across the workers.
+        #   The jobs in exclude are still running in the owner, they are not claimed a second time
+        now = int(datetime.now().timestamp()*1000)
+        claim = uuid.uuid4().hex
+        marks = ",".join("?" * len(exclude))
+        self.cursor.execute('BEGIN IMMEDIATE')
+        try:
+            self.cursor.execute("UPDATE jobs SET status = ?, error = ?, owner = NULL, claim = NULL, updated = ? WHERE status = ? AND heartbeat < ? AND attempts >= ?",
+                                (JobStatus.FAILED, "Worker stopped while running the job", now, JobStatus.RUNNING, stale_before, max_attempts))
+            self.cursor.execute(f'''
+                SELECT id FROM jobs WHERE (status = ? OR (status = ? AND heartbeat < ?)) AND id NOT IN ({marks}) ORDER BY created LIMIT 1
+            ''', (JobStatus.QUEUED, JobStatus.RUNNING, stale_before, *exclude))
+            row = self.cursor.fetchone()
+            if row:
+                self.cursor.execute('UPDATE jobs SET status = ?, owner = ?, claim = ?, heartbeat = ?, updated = ?, attempts = attempts + 1 WHERE id = ?',
+                                    (JobStatus.RUNNING, owner, claim, now, now, row[0]))
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+
+        if row:
+            return {**self.get_job(row[0]), 'claim': claim}
+        return None
+
+    def heartbeat(self, claims):
+        # Returns the claims no longer held, their jobs cancelled by their users, retried or taken over by another worker
+        if len(claims) == 0:
+            return []
+        now = int(datetime.now().timestamp()*1000)
+        marks = ",".join("?" * len(claims))
+        self.cursor.execute(f'UPDATE jobs SET heartbeat = ? WHERE status = ? AND claim IN ({marks}) RETURNING claim', (now, JobStatus.RUNNING, *claims))
+        held = {row[0] for row in self.cursor.fetchall()}
+        self.conn.commit()
+        return [claim for claim in claims if claim not in held]
+
+    def finish_job(self, job_id, claim, status, result=None, error=None):
+        now = int(datetime.now().timestamp()*1000)
+        self.cursor.execute('UPDATE jobs SET status = ?, result = ?, error = ?, owner = NULL, claim = NULL, updated = ? WHERE id = ? AND claim = ? AND status = ?',
+                            (status, result, error, now, job_id, claim, JobStatus.RUNNING))
+        self.conn.commit()
+        return self.cursor.rowcount
+
+    def requeue_jobs(self, owner):
+        # The owner is shutting down, its jobs start over elsewhere without counting as a failed attempt
+        now = int(datetime.now().timestamp()*1000)
+        self.cursor.execute('UPDATE jobs SET status = ?, owner = NULL, claim = NULL, attempts = attempts - 1, updated = ? WHERE owner = ? AND status = ?',
+                            (JobStatus.QUEUED, now, owner, JobStatus.RUNNING))
+        self.conn.commit()
+        return self.cursor.rowcount
+
+    def cancel_job(self, job_id, user_id):
+        now = int(datetime.now().timestamp()*1000)
+        self.cursor.execute('UPDATE jobs SET status = ?, owner = NULL, claim = NULL, updated = ? WHERE id = ? AND user_id = ? AND status IN (?, ?)',
+                            (JobStatus.CANCELLED, now, job_id, user_id, JobStatus.QUEUED, JobStatus.RUNNING))
+        self.conn.commit()
+        return self.cursor.rowcount
+
+    def retry_job(self, job_id, user_id):
+        now = int(datetime.now().timestamp()*1000)
+        self.cursor.execute('UPDATE jobs SET status = ?, attempts = 0, result = NULL, error = NULL, updated = ? WHERE id = ? AND user_id = ? AND status IN (?, ?)',
+                            (JobStatus.QUEUED, now, job_id, user_id, JobStatus.FAILED, JobStatus.CANCELLED))
+        self.conn.commit()
+        return self.cursor.rowcount
+
+class UsageDatabase:
+    def __init__(self, db_name): 
+        self.db_name = db_name
+        self.conn = timed_connection(sqlite3.connect(db_name, timeout=10), db_name)
+        self.cursor = self.conn.cursor() 
+        self.create_tables()
+
+    # Usage is kept as running totals per user, model and day ('YYYY-MM-DD'). Quotas are in tokens,
+    #   prompt and completion together, NULL being no limit
+    def create_tables(self):
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS token_usage (
+                user_id INTEGER,
+                llm_id TEXT,
+                day TEXT,
+                calls INTEGER,
+                cached INTEGER,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                PRIMARY KEY (user_id, llm_id, day),
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
+
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS token_quotas (
+                user_id INTEGER PRIMARY KEY,
+                daily INTEGER,
+                monthly INTEGER,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS token_usage_day ON token_usage (day)')
+        self.conn.commit()
+
+    def add_usage(self, records):
+        # records: (user_id, llm_id, day, calls, cached, prompt_tokens, completion_tokens), added to the totals
+        self.cursor.executemany('''
+            INSERT INTO token_usage VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, llm_id, day) DO UPDATE SET
+                calls = calls + excluded.calls,
+                cached = cached + excluded.cached,
+                prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                completion_tokens = completion_tokens + excluded.completion_tokens
+        ''', records)
+        self.conn.commit()
+
+    def get_usage(self, user_id, since_day):
+        self.cursor.execute('''
+            SELECT llm_id, day, calls, cached, prompt_tokens, completion_tokens FROM token_usage
+            WHERE user_id = ? AND day >= ? ORDER BY day DESC, llm_id
+        ''', (user_id, since_day))
+        return [{'llmID': llm_id, 'day': day, 'calls': calls, 'cached': cached, 'prompt_tokens': prompt, 'completion_tokens': completion}
+                for llm_id, day, calls, cached, prompt, completion in self.cursor.fetchall()]
+
+    def get_tokens_used(self, user_id, since_day):
+        self.cursor.execute('SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0) FROM token_usage WHERE user_id = ? AND day >= ?',
+                            (user_id, since_day))
+        return self.cursor.fetchone()[0]
+
+    def get_usage_report(self, since_day):
+        # Totals of every user and model since the day, largest first
+        self.cursor.execute('''
+            SELECT user_credentials.username, token_usage.llm_id, SUM(calls), SUM(cached), SUM(prompt_tokens), SUM(completion_tokens)
+            FROM token_usage LEFT JOIN user_credentials ON user_credentials.user_id = token_usage.user_id
+            WHERE day >= ? GROUP BY token_usage.user_id, token_usage.llm_id
+            ORDER BY SUM(prompt_tokens) + SUM(completion_tokens) DESC
+        ''', (since_day,))
+        return [{'username': username, 'llmID': llm_id, 'calls': calls, 'cached': cached, 'prompt_tokens': prompt, 'completion_tokens': completion}
+                for username, llm_id, calls, cached, prompt, completion in self.cursor.fetchall()]
+
+    def get_quota(self, user_id):
+        self.cursor.execute('SELECT daily, monthly FROM token_quotas WHERE user_id = ?', (user_id,))
+        row = self.cursor.fetchone()
+        if row:
+            return {'daily': row[0], 'monthly': row[1]}
+        return None
+
+    def has_quotas(self):
+        self.cursor.execute('SELECT EXISTS (SELECT 1 FROM token_quotas)')
+        return self.cursor.fetchone()[0] == 1
+
+    def set_quota(self, user_id, daily, monthly):
+        self.cursor.execute('INSERT OR REPLACE INTO token_quotas VALUES (?, ?, ?)', (user_id, daily, monthly))
+        self.conn.commit()
+
+    def delete_quota(self, user_id):
+        self.cursor.execute('DELETE FROM token_quotas WHERE user_id = ?', (user_id,))
+        self.conn.commit()
+        return self.cursor.rowcount
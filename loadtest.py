@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+__version__ = "0.1"
+__author__  = "Shalin Garg"
+
+# Load test of serve.py without spending any provider quota. By default it starts fake_llm.py and
+#   serve.py (MODELS replaced by the fake ones through CODEDOC_FAKE_LLM) in a scratch directory
+#   with their own user DB and code files, then has --users simulated users log in and send a
+#   weighted mix of /llm/, /chat/, /files/ and /params/ requests for --duration seconds.
+#
+#   python loadtest.py --users 50 --duration 60 --latency 1 --tokenRate 50 --failRate 0.02
+#   python loadtest.py --url https://host:9999 --username me --password ... --llmID azure-openai-chat
+#
+# Every run is appended to --results, a run is compared with the last earlier run of the same
+#   configuration.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from datetime            import datetime
+
+import httpx
+
+parser = argparse.ArgumentParser(description="Load test the Code Documentation Tool Server")
+parser.add_argument("--url", help="Server to test, by default one is started against a fake provider")
+parser.add_argument("--username", default="loadtest", help="User to log in as")
+parser.add_argument("--password", default="loadtest", help="Password of the user")
+parser.add_argument("--llmID", default=None, help="Model to call, fake-chat/fake-llm when the server is started here")
+parser.add_argument("--users", type=int, default="20", help="Concurrent simulated users")
+parser.add_argument("--duration", type=float, default="30", help="Seconds to run the mix for")
+parser.add_argument("--rampUp", type=float, default="5", help="Seconds over which the users start")
+parser.add_argument("--thinkTime", type=float, default="0.5", help="Mean seconds a user waits between requests")
+parser.add_argument("--mix", default="llm=4,chat=2,files=2,params=2", help="Relative weights of the request kinds")
+parser.add_argument("--port", type=int, default="8900", help="Port of the server started here")
+parser.add_argument("--workers", type=int, default="1", help="Worker processes of the server started here")
+parser.add_argument("--serverArgs", default="", help="Extra arguments for the server started here")
+parser.add_argument("--fakePort", type=int, default="9900", help="Port of the fake provider started here")
+parser.add_argument("--latency", type=float, default="0.5", help="Fake provider seconds before a response starts")
+parser.add_argument("--jitter", type=float, default="0.2", help="Fake provider random extra latency")
+parser.add_argument("--tokenRate", type=float, default="0", help="Fake provider tokens per second, 0 is instant")
+parser.add_argument("--completionTokens", type=int, default="100", help="Fake provider tokens per response")
+parser.add_argument("--failRate", type=float, default="0", help="Fraction of fake provider calls failing with a 500")
+parser.add_argument("--throttleRate", type=float, default="0", help="Fraction of fake provider calls answered with a 429")
+parser.add_argument("--results", default="./loadtest_results.jsonl", help="File the results of every run are appended to")
+parser.add_argument("--label", default="", help="Free text saved with the results, like the change being measured")
+parser.add_argument("--keep", action='store_true', help="Keep the scratch directory of the server started here")
+args = parser.parse_args()
+
+CODE_FILES = 20         # Generated files the /files/ requests read
+CODE_LINES = 200
+
+def wait_for_port(port: int, timeout: float = 60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        time.sleep(0.2)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout}s")
+
+def code_file(index: int) -> str:
+    lines = [f"// Module {index} of the load test code base"]
+    for func in range(CODE_LINES // 5):
+        lines.extend([f"function handler{index}_{func}(request, response) {{",
+                      f"  const value = request.params['key{func}'];",
+                      f"  response.send(value * {func});",
+                      "}", ""])
+    return "\n".join(lines)
+
+class LocalServer:
+    """fake_llm.py and serve.py running in a scratch directory for the length of the test."""
+
+    def __init__(self):
+        self.workdir = tempfile.mkdtemp(prefix="codedoc_loadtest_")
+        self.procs = []
+
+    def start(self):
+        repo = os.path.dirname(os.path.abspath(__file__))
+        idir = os.path.join(self.workdir, "oldcode")
+        os.makedirs(idir)
+        os.makedirs(os.path.join(self.workdir, "newcode"))
+        for index in range(CODE_FILES):
+            with open(os.path.join(idir, f"module{index}.js"), "w") as code:
+                code.write(code_file(index))
+        self.create_user(repo)
+
+        env = {key: value for key, value in os.environ.items() if key != 'PROMETHEUS_MULTIPROC_DIR'}
+        env['CODEDOC_FAKE_LLM'] = f"http://127.0.0.1:{args.fakePort}"
+        env.setdefault('TOKEN_ENC_KEY', 'loadtest-secret')
+        log = open(os.path.join(self.workdir, "server.log"), "w")
+
+        self.procs.append(subprocess.Popen(
+            [sys.executable, os.path.join(repo, "fake_llm.py"), "--port", str(args.fakePort),
+             "--latency", str(args.latency), "--jitter", str(args.jitter), "--tokenRate", str(args.tokenRate),
+             "--completionTokens", str(args.completionTokens), "--failRate", str(args.failRate),
+             "--throttleRate", str(args.throttleRate)],
+            cwd=self.workdir, env=env, stdout=log, stderr=subprocess.STDOUT))
+        self.procs.append(subprocess.Popen(
+            [sys.executable, os.path.join(repo, "serve.py"), "--port", str(args.port), "--workers", str(args.workers),
+             "--html", os.path.join(repo, "html", "src"), "--idir", idir, "--odir", os.path.join(self.workdir, "newcode"),
+             "--cacheDB", os.path.join(self.workdir, "llm_cache.db")] + args.serverArgs.split(),
+            cwd=self.workdir, env=env, stdout=log, stderr=subprocess.STDOUT))
+
+        wait_for_port(args.fakePort)
+        wait_for_port(args.port)
+        print(f"Server started in [{self.workdir}], log in server.log")
+
+    def create_user(self, repo: str):
+        # Same steps as dbadm.py, in the scratch directory's user DB
+        sys.path.insert(0, repo)
+        cwd = os.getcwd()
+        os.chdir(self.workdir)
+        try:
+            from libs.user_db import UserDatabase, User, UserCredentials
+            from passlib.context import CryptContext
+
+            users_db = UserDatabase("codegen_user.db")
+            users_db.add_user(User(None, f"{args.username}@loadtest", "Load Test", False))
+            user = users_db.get_user_by_email(f"{args.username}@loadtest")
+            password = CryptContext(schemes=["bcrypt"], deprecated="auto").hash(args.password)
+            users_db.add_user_credentials(UserCredentials(user.id, args.username, password))
+            users_db.conn.close()
+        finally:
+            os.chdir(cwd)
+
+    def stop(self):
+        for proc in reversed(self.procs):
+            proc.terminate()
+        for proc in self.procs:
+            try:
+                proc.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if not args.keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+class Stats:
+    def __init__(self):
+        self.samples = {}       # Request kind -> [(seconds, ok, status)]
+
+    def add(self, kind: str, seconds: float, ok: bool, status):
+        self.samples.setdefault(kind, []).append((seconds, ok, status))
+
+    def summary(self, elapsed: float) -> dict:
+        result = {}
+        for kind, samples in sorted(self.samples.items()):
+            latencies = sorted(seconds for seconds, ok, status in samples if ok)
+            errors = {}
+            for seconds, ok, status in samples:
+                if not ok:
+                    errors[str(status)] = errors.get(str(status), 0) + 1
+            result[kind] = {
+                'requests': len(samples),
+                'rps': round(len(samples) / elapsed, 2),
+                'error_rate': round(sum(errors.values()) / len(samples), 4),
+                'errors': errors,
+                'p50_ms': percentile(latencies, 50),
+                'p95_ms': percentile(latencies, 95),
+                'p99_ms': percentile(latencies, 99)
+            }
+        return result
+
+def percentile(ordered: list, pct: float) -> float | None:
+    if len(ordered) == 0:
+        return None
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))] * 1000, 1)
+
+def llm_params(user_prompt: str, code: str) -> dict:
+    return {
+        'llmID': args.llmID,
+        'temperature': random.choice([0.0, 0.5, 0.9]),
+        'max_new_tokens': args.completionTokens,
+        'topp_nucleus_sampling': 0.9,
+        'user_prompt': user_prompt,
+        'context': "Document the code for a new developer joining the team",
+        'code_snippet': code
+    }
+
+class SimulatedUser:
+    """Logs in once, then picks a request kind by weight, sends it and thinks for a while, until the end."""
+
+    def __init__(self, number: int, client: httpx.AsyncClient, stats: Stats, weights: dict):
+        self.number = number
+        self.client = client
+        self.stats = stats
+        self.weights = weights
+        self.files = []
+        self.history = []
+
+    async def timed(self, kind: str, request, accept=(200,)):
+        start = time.perf_counter()
+        try:
+            response = await request
+            ok = response.status_code in accept
+            if ok and kind in ('llm', 'chat'):
+                # The handlers report provider failures as text rather than a status
+                ok = 'tokens' in response.json()
+            self.stats.add(kind, time.perf_counter() - start, ok, response.status_code)
+            return response if ok else None
+        except httpx.HTTPError as excp:
+            self.stats.add(kind, time.perf_counter() - start, False, type(excp).__name__)
+            return None
+
+    async def login(self) -> bool:
+        response = await self.timed('token', self.client.post("/token", data={'grant_type': 'password', 'username': args.username, 'password': args.password}))
+        return response is not None
+
+    async def llm(self):
+        code = await self.some_code()
+        await self.timed('llm', self.client.post("/llm/", json=llm_params("Write the JSDoc comments for this code", code)))
+
+    async def chat(self):
+        code = await self.some_code()
+        params = llm_params(f"Question {len(self.history)} about this code from user {self.number}", code)
+        params['llmID'] = args.llmID if args.llmID is not None and 'llm' not in args.llmID else 'fake-chat'
+        response = await self.timed('chat', self.client.post("/chat/", json={'params': params, 'history': self.history[-4:]}))
+        if response is not None:
+            self.history.append({'user': params['user_prompt'], 'ai': response.json()['model_resp']})
+
+    async def files_request(self):
+        response = await self.timed('files', self.client.get("/files/"))
+        if response is not None:
+            self.files = response.json()['files']
+        if len(self.files) > 0:
+            await self.timed('files', self.client.get(f"/files/{random.choice(self.files)}"))
+
+    async def params(self):
+        if random.random() < 0.3:
+            snap = {'user': args.username, 'purpose': f"load test {self.number}", 'params': llm_params("Saved prompt", "")}
+            snap['params']['temperature'] = round(random.random(), 6)
+            await self.timed('params', self.client.put(f"/params/{args.llmID}", json=snap))
+        else:
+            await self.timed('params', self.client.get(f"/params/{args.llmID}"), accept=(200, 404))
+
+    async def some_code(self) -> str:
+        if len(self.files) == 0:
+            return "function add(a, b) { return a + b; }"
+        return code_file(random.randrange(CODE_FILES))[:2000]
+
+    async def run(self, deadline: float):
+        if not await self.login():
+            return
+        actions = {'llm': self.llm, 'chat': self.chat, 'files': self.files_request, 'params': self.params}
+        kinds = list(self.weights.keys())
+        while time.monotonic() < deadline:
+            kind = random.choices(kinds, weights=[self.weights[kind] for kind in kinds])[0]
+            await actions[kind]()
+            await asyncio.sleep(random.expovariate(1 / args.thinkTime) if args.thinkTime > 0 else 0)
+
+async def run_users(base_url: str, weights: dict) -> tuple:
+    stats = Stats()
+    deadline = time.monotonic() + args.rampUp + args.duration
+    limits = httpx.Limits(max_connections=args.users * 2)
+    clients = [httpx.AsyncClient(base_url=base_url, timeout=300, limits=limits, verify=False) for _ in range(args.users)]
+    start = time.monotonic()
+    try:
+        tasks = []
+        for number, client in enumerate(clients):
+            tasks.append(asyncio.create_task(SimulatedUser(number, client, stats, weights).run(deadline)))
+            await asyncio.sleep(args.rampUp / args.users)
+        await asyncio.gather(*tasks)
+    finally:
+        for client in clients:
+            await client.aclose()
+    return stats, time.monotonic() - start
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def previous_run(config: dict) -> dict | None:
+    if not os.path.exists(args.results):
+        return None
+    last = None
+    with open(args.results) as results:
+        for line in results:
+            run = json.loads(line)
+            if run['config'] == config:
+                last = run
+    return last
+
+def print_report(run: dict, previous: dict | None):
+    print(f"\n{'kind':8} {'requests':>8} {'rps':>8} {'errors':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for kind, result in run['results'].items():
+        print(f"{kind:8} {result['requests']:>8} {result['rps']:>8} {result['error_rate']:>8.2%} "
+              f"{str(result['p50_ms']):>9} {str(result['p95_ms']):>9} {str(result['p99_ms']):>9}  {result['errors'] or ''}")
+
+    if previous is None:
+        return
+    print(f"\nCompared with the run of {previous['time']} at commit [{previous['commit']}] {previous['label']}")
+    for kind, result in run['results'].items():
+        before = previous['results'].get(kind)
+        if before is None:
+            continue
+        changes = []
+        for key in ('rps', 'p50_ms', 'p95_ms', 'p99_ms', 'error_rate'):
+            if result[key] is not None and before[key]:
+                changes.append(f"{key} {(result[key] - before[key]) / before[key]:+.1%}")
+        print(f"{kind:8} {', '.join(changes)}")
+
+def main():
+    weights = {kind: float(weight) for kind, weight in (item.split("=") for item in args.mix.split(","))}
+    server = None
+    base_url = args.url
+    if base_url is None:
+        server = LocalServer()
+        server.start()
+        base_url = f"http://127.0.0.1:{args.port}"
+        if args.llmID is None:
+            args.llmID = 'fake-llm'
+    elif args.llmID is None:
+        sys.exit("--llmID is required with --url")
+
+    try:
+        stats, elapsed = asyncio.run(run_users(base_url, weights))
+    finally:
+        if server is not None:
+            server.stop()
+
+    config = {key: value for key, value in vars(args).items() if key not in ('results', 'label', 'keep', 'password')}
+    run = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'label': args.label,
+        'config': config,
+        'elapsed': round(elapsed, 1),
+        'results': stats.summary(elapsed)
+    }
+    previous = previous_run(config)
+    with open(args.results, "a") as results:
+        results.write(json.dumps(run) + "\n")
+    print_report(run, previous)
+
+if __name__ == "__main__":
+    main()
@@ -22,11 +22,14 @@
 __version__ = "0.1"
 __author__  = "Shalin Garg"
 
+from libs                import startup     # First, it times the rest of the startup
 
 from sys                 import exit
 import ssl
 import os
-import copy
+import json
+import time
+import asyncio
 import uvicorn
 import argparse
 
@@ -35,30 +38,46 @@ from typing import Annotated
 
 from fastapi             import Depends, FastAPI, HTTPException
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses   import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from sse_starlette.sse   import EventSourceResponse
 
 import openai
 from langchain.globals   import set_verbose
 from langchain.globals   import set_debug
-from langchain.globals   import set_llm_cache
-from langchain_community.cache     import InMemoryCache
 from langchain.prompts   import PromptTemplate
 from langchain.schema    import BaseOutputParser
-from langchain.schema    import HumanMessage, SystemMessage, AIMessage
-from langchain_community.chat_models import AzureChatOpenAI
-from langchain_community.chat_models import ChatOpenAI
-from langchain_community.llms      import OpenAI
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAI
-from langchain_community.llms      import AzureOpenAI
-from langchain.chains    import LLMChain
+from langchain.schema    import HumanMessage, SystemMessage, AIMessage, BaseMessage
+from langchain_core.runnables import RunnableLambda
 from langserve           import add_routes
+startup.mark("import fastapi, langchain & langserve")
 
 from libs.data           import *
-from libs.llms           import HuggingFaceSpaces, EnvVars
+from libs.providers      import registry, resolve_model_kwargs, sampling_kwargs, prompt_provider
+from libs                import dispatch
+from libs.dispatch       import LLMCall, response_text
+from libs                import llm_cache
+from libs                import ratelimit
+from libs                import tokens
+from libs                import sessions
+from libs                import jobs
+from libs                import summarize
+from libs                import functions
+from libs                import comments
+from libs                import retrieval
+from libs                import symbols
+from libs                import scheduler
+from libs.scheduler      import Priority
+from libs                import usage
+from libs                import failover
+from libs                import metrics
 from libs                import auth
 from libs.auth           import get_current_active_user, User
 from libs                import files
+from libs                import dirtree
 from libs                import params
 from libs.params         import MODELS
+startup.mark("import libs")
 
    
 parser = argparse.ArgumentParser(description="Start the Code Documentation Tool Server")
@@ -68,10 +87,40 @@ parser.add_argument("--html", default="./html/src", help="Static Content directo
 parser.add_argument("--port", type=int, default="8000", help="Port to listen on")
 parser.add_argument("--useHTTPS", action='store_true', help="Enable HTTPS")
 parser.add_argument("--workers", type=int, default="1", help="Number of Worker processes to start")
+parser.add_argument("--preload", action='store_true', help="Load provider clients & tokenizers once and fork the Workers from it (gunicorn)")
+parser.add_argument("--startupReport", action='store_true', help="Print the time each Worker spent in the phases of its startup")
+parser.add_argument("--llmConcurrency", type=int, default="32", help="Max LLM generations in flight per Worker process")
+parser.add_argument("--schedulerWeights", default="chat=8,llm=4,batch=1", help="Shares of the LLM slots of the chat, single /llm/ and batch requests")
+parser.add_argument("--batchParallelism", type=int, default="8", help="Max items of one /llm/batch request run concurrently")
+parser.add_argument("--truncationPolicy", default="context,history,code", help="Prompt sections trimmed, in order, to fit the context window")
+parser.add_argument("--chatSummaryTokens", type=int, default="2000", help="Tokens of chat session history beyond which older exchanges get summarized")
+parser.add_argument("--jobConcurrency", type=int, default="4", help="Max background jobs run concurrently per Worker process")
+parser.add_argument("--cacheDB", default="./llm_cache.db", help="SQLite file of the LLM response cache")
+parser.add_argument("--cacheTTL", type=int, default="604800", help="Seconds a cached LLM response stays valid")
+parser.add_argument("--cacheSize", type=int, default="10000", help="Max LLM responses kept in the cache, 0 disables caching")
+parser.add_argument("--indexDB", default="./code_index.db", help="SQLite file of the full text and symbol indexes of the input directory")
+parser.add_argument("--contextTokens", type=int, default="1500", help="Tokens of code retrieved into the context of auto_context requests")
+parser.add_argument("--dailyTokenQuota", type=int, default="0", help="Tokens a user may use per day unless set for the user with dbadm.py, 0 is no limit")
+parser.add_argument("--monthlyTokenQuota", type=int, default="0", help="Tokens a user may use per month unless set for the user with dbadm.py, 0 is no limit")
 args = parser.parse_args()
 
 files.INPUT_CODE_DIR = args.idir
 files.OUTPUT_CODE_DIR = args.odir
+dispatch.configure(args.llmConcurrency, dict(weight.split('=') for weight in args.schedulerWeights.split(',')))
+ratelimit.configure(args.workers)
+tokens.configure(args.truncationPolicy.split(","))
+llm_cache.configure(args.cacheDB, args.cacheTTL, args.cacheSize)
+retrieval.configure(args.indexDB, args.contextTokens)
+symbols.configure(args.indexDB, args.contextTokens)
+sessions.configure(args.chatSummaryTokens)
+summarize.configure(args.batchParallelism)
+usage.configure(args.dailyTokenQuota, args.monthlyTokenQuota)
+
+if args.preload:
+    # Read only from here on, forked Workers share these pages copy-on-write
+    registry.preload()
+    with startup.phase("load tokenizers"):
+        tokens.preload(MODELS)
 
 #checkEnviron()
 
@@ -131,6 +180,19 @@ app.mount("/html", StaticFiles(directory=args.html, html=True), name="html")
 app.include_router(auth.router)
 app.include_router(files.router)
 app.include_router(params.router)
+app.include_router(llm_cache.router)
+app.include_router(sessions.router)
+app.include_router(jobs.router)
+app.include_router(summarize.router)
+app.include_router(functions.router)
+app.include_router(comments.router)
+app.include_router(retrieval.router)
+app.include_router(symbols.router)
+app.include_router(scheduler.router)
+app.include_router(usage.router)
+app.include_router(failover.router)
+app.include_router(metrics.router)
+app.middleware("http")(metrics.instrument)
 
 user_template = """{user_prompt}."""
 
@@ -146,175 +208,293 @@ prompt = PromptTemplate(
 #    model_kwargs={'system_prompt':'You are a helpful agent', 'max_new_tokens':256,'temperature':0.1,'topp_nucleus_sampling': 0.9,'topk':40,'repetition_penalty':1,'api_name':'/chat'}
 #)
 
-gem_llm = ChatGoogleGenerativeAI(model="gemini-pro", convert_system_message_to_human=True)
+gem_llm = None
+
+def gemini_chat(prompt_value):
+    # Built by the first /gem_chain call, Google GenAI takes a good part of a Worker's import time.
+    #   The returned model is then run with the prompt, streaming included
+    global gem_llm
+    if gem_llm is None:
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        gem_llm = ChatGoogleGenerativeAI(model="gemini-pro", convert_system_message_to_human=True)
+    return gem_llm
 
 #category_chain = prompt | gem_llm | CommaSeparatedListOutputParser()
-category_chain = prompt | gem_llm
+category_chain = prompt | RunnableLambda(gemini_chat)
 
 add_routes(
     app,
     category_chain,
     path="/gem_chain",
 )
+startup.mark("create app & routes")
 
-@app.post("/chat/")
-async def chat_llm(chat: ChatMessage,
-                   current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+async def prepare_chat(chat: ChatMessage):
+    # Returns the call with the runnable bound with this request's sampling parameters and its input
     params = chat.params
     model_obj = MODELS.get(chat.params.llmID)
     if model_obj is None:
         raise HTTPException(status_code=404, detail={'msg':f"Model ID {params.llmID} not available"})
 
-    kwargs = copy.deepcopy(model_obj['model_kwargs'])
-    kwargs['temperature'] = params.temperature
-    kwargs['max_new_tokens'] = params.max_new_tokens
-    kwargs['topp_nucleus_sampling'] = params.topp_nucleus_sampling
-    if params.topk is not None and 'topk' in kwargs:
-        kwargs['topk'] = params.topk
-    if params.repetition_penalty is not None and 'repetition_penalty' in kwargs:
-        kwargs['repetition_penalty'] = params.repetition_penalty
-    if params.presence_penalty is not None and 'presence_penalty' in kwargs:
-        kwargs['presence_penalty'] = params.presence_penalty
-    if 'system_prompt' in kwargs:
-        kwargs['system_prompt'] = params.system_prompt
-
-    if model_obj['provider'] == 'AzureChatOpenAI':
-        model = AzureChatOpenAI(
-            openai_api_key=model_obj['api-key'],
-            deployment_name=model_obj['id_for_prvdr'],
-            model_name=model_obj['id_for_prvdr'],
-            openai_api_version=model_obj['api_version'],
-            azure_endpoint=model_obj['endpoint'],
-            temperature=kwargs['temperature'], max_tokens=kwargs['max_new_tokens'], 
-            model_kwargs={ "top_p": kwargs['topp_nucleus_sampling'], 
-            "frequency_penalty": kwargs['repetition_penalty'], 
-            "presence_penalty": kwargs['presence_penalty'] }
-        )
-        message = format_prompt(False, params.system_prompt, params.context, params.code_snippet, params.user_prompt, chat.history)
-        model_resp = None
-        try:
-            model_resp = model(message)
-            if isinstance(model_resp, AIMessage):
-                return { 'model_resp': str(model_resp.content) }
-            else:
-                return { 'model_resp': str(model_resp) }
-        except openai.BadRequestError as excp:
-            return { 'model_resp': str(excp) }
-        except Exception as e:
-            return { 'model_resp': str(e) }
-    else:
+    if prompt_provider(model_obj) != 'AzureChatOpenAI':
         raise HTTPException(status_code=404, detail={'msg':f"Model Provider {model_obj['provider']} not available"})
+    if params.auto_context:
+        params = await run_in_threadpool(retrieval.auto_context, params, model_obj)
 
+    kwargs = resolve_model_kwargs(model_obj, params)
+    fitted = tokens.fit_prompt(model_obj, params.system_prompt, params.context, params.code_snippet, params.user_prompt,
+                               chat.history, kwargs['max_new_tokens'])
 
-@app.post("/llm/")
-async def call_llm(params: LLMParams,
-                   current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    message = format_prompt(False, params.system_prompt, fitted['context'], fitted['code'], params.user_prompt, fitted['history'])
+    return make_call(params, model_obj, kwargs, message, fitted['tokens'])
 
+async def prepare_llm(params: LLMParams):
+    # Returns the call with the runnable bound with this request's sampling parameters and its input
     model_obj = MODELS.get(params.llmID)
     if model_obj is None:
         raise HTTPException(status_code=404, detail={'msg':f"Model ID {params.llmID} not available"})
+    if params.auto_context:
+        params = await run_in_threadpool(retrieval.auto_context, params, model_obj)
 
-    kwargs = copy.deepcopy(model_obj['model_kwargs'])
-    kwargs['temperature'] = params.temperature
-    kwargs['max_new_tokens'] = params.max_new_tokens
-    kwargs['topp_nucleus_sampling'] = params.topp_nucleus_sampling
-    if params.topk is not None and 'topk' in kwargs:
-        kwargs['topk'] = params.topk
-    if params.repetition_penalty is not None and 'repetition_penalty' in kwargs:
-        kwargs['repetition_penalty'] = params.repetition_penalty
-    if params.presence_penalty is not None and 'presence_penalty' in kwargs:
-        kwargs['presence_penalty'] = params.presence_penalty
-    if 'system_prompt' in kwargs:
-        kwargs['system_prompt'] = params.system_prompt
-
-    local_llm = None
+    kwargs = resolve_model_kwargs(model_obj, params)
+    fitted = tokens.fit_prompt(model_obj, params.system_prompt, params.context, params.code_snippet, params.user_prompt,
+                               None, kwargs['max_new_tokens'])
+    context = fitted['context']
+    code = fitted['code']
+
+    provider = prompt_provider(model_obj)
     local_template = "Context:{ctxt} \n\nCode:{code} \n\n{user}."
 
-    if model_obj['provider'] == 'AzureChatOpenAI':
-        model = AzureChatOpenAI(
-            openai_api_key=model_obj['api-key'],
-            deployment_name=model_obj['id_for_prvdr'],
-            model_name=model_obj['id_for_prvdr'],
-            openai_api_version=model_obj['api_version'],
-            azure_endpoint=model_obj['endpoint'],
-            temperature=kwargs['temperature'], max_tokens=kwargs['max_new_tokens'], 
-            model_kwargs={ "top_p": kwargs['topp_nucleus_sampling'], 
-            "frequency_penalty": kwargs['repetition_penalty'], 
-            "presence_penalty": kwargs['presence_penalty'] }
-        )
-        message = format_prompt(False, params.system_prompt, params.context, params.code_snippet, params.user_prompt)
-        model_resp = None
-        try:
-            model_resp = model(message)
-            if isinstance(model_resp, AIMessage):
-                return { 'model_resp': str(model_resp.content) }
-            else:
-                return { 'model_resp': str(model_resp) }
-        except openai.BadRequestError as excp:
-            return { 'model_resp': str(excp) }
-        except Exception as e:
-            return { 'model_resp': str(e) }
-
-    elif model_obj['provider'] == 'AzureOpenAILLM':
-        model = AzureOpenAI(
-            openai_api_key=model_obj['api-key'],
-            deployment_name=model_obj['id_for_prvdr'],
-            model_name=model_obj['id_for_prvdr'],
-            openai_api_version=model_obj['api_version'],
-            azure_endpoint=model_obj['endpoint'],
-            temperature=kwargs['temperature'], max_tokens=kwargs['max_new_tokens'], 
-            top_p=kwargs['topp_nucleus_sampling'], frequency_penalty=kwargs['repetition_penalty'], 
-            presence_penalty=kwargs['presence_penalty']
-        )
-        message = format_prompt(True, params.system_prompt, params.context, params.code_snippet, params.user_prompt)
-        model_resp = None
-        try:
-            model_resp = model(message)
-            return { 'model_resp': str(model_resp) }
-        except openai.BadRequestError as excp:
-            return { 'model_resp': str(excp) }
-        except Exception as e:
-            return { 'model_resp': str(e) }
-
-    elif model_obj['provider'] == 'OpenAI':
-        local_llm = OpenAI(temperature=kwargs['temperature'], max_tokens=kwargs['max_new_tokens'], 
-            top_p=kwargs['topp_nucleus_sampling'], frequency_penalty=kwargs['repetition_penalty'], 
-            presence_penalty=kwargs['presence_penalty'], model_name=model_obj['id_for_prvdr'])
-    elif model_obj['provider'] == 'ChatOpenAI':
-        model = ChatOpenAI()
-        message = HumanMessage(params.user_prompt)
-        return { 'model_resp': str(model([message])) }
-    elif model_obj['provider'] == 'HuggingFaceSpaces':
-        local_llm = HuggingFaceSpaces(
-            task="summarization",
-            repo_id=model_obj['id_for_prvdr'],
-            model_kwargs=kwargs)
-    elif model_obj['provider'] == 'ChatGeminiPro':
-        if model_obj['api-key'] is not None:
-            local_llm = GoogleGenerativeAI(model=model_obj['id_for_prvdr'], google_api_key=model_obj['api-key'],
-                        temperature=kwargs['temperature'], top_k=kwargs['topk'], top_p=kwargs['topp_nucleus_sampling'],
-                        max_output_tokens=kwargs['max_new_tokens'])  # convert_system_message_to_human=True
+    if provider == 'AzureChatOpenAI':
+        message = format_prompt(False, params.system_prompt, context, code, params.user_prompt)
+    elif provider == 'AzureOpenAILLM':
+        message = format_prompt(True, params.system_prompt, context, code, params.user_prompt)
+    elif provider == 'ChatOpenAI':
+        message = [HumanMessage(params.user_prompt)]
+    elif provider in ('ChatGeminiPro', 'OpenAI', 'HuggingFaceSpaces'):
+        if provider == 'ChatGeminiPro':
+            # convert_system_message_to_human=True
             local_template = (kwargs['system_prompt'] if kwargs['system_prompt'] is not None else "") + " " + local_template
-            local_prompt = PromptTemplate(
+        local_prompt = PromptTemplate(
                 template=local_template,
                 input_variables=['ctxt', 'code', 'user'])
-            return {
-                'model_resp': str(local_llm(local_prompt.invoke({'ctxt':params.context, 'code':params.code_snippet, 'user':params.user_prompt}).to_string()))
-            }
+        message = local_prompt.invoke({'ctxt':context, 'code':code, 'user':params.user_prompt}).to_string()
     else:
-        raise HTTPException(status_code=404, detail={'msg':f"Model Provider {model_obj['provider']} not available"})
+        raise HTTPException(status_code=404, detail={'msg':f"Model Provider {provider} not available"})
+
+    return make_call(params, model_obj, kwargs, message, fitted['tokens'])
+
+def make_call(params: LLMParams, model_obj: dict, kwargs: dict, message, counts: dict) -> LLMCall:
+    # Bind the model only once the exact prompt size is known, it caps the completion size
+    counts = {**counts, 'prompt': tokens.count_message(model_obj, message)}
+    kwargs['max_new_tokens'] = tokens.cap_completion(model_obj, counts['prompt'], kwargs['max_new_tokens'])
+    counts['max_completion'] = kwargs['max_new_tokens']
+
+    model = registry.bind(params.llmID, kwargs)
+    return LLMCall(params.llmID, model_obj, model, message, sampling_kwargs(model_obj, kwargs), params.use_cache, counts)
+
+def count_usage(call: LLMCall, text: str):
+    call.tokens['completion'] = tokens.count_tokens(call.model_obj, text)
+    usage.record(call.user, call.llmID, call.tokens['prompt'], call.tokens['completion'], call.cached or call.coalesced)
+    if not call.cached and not call.coalesced:
+        # Only what actually went to and came from the provider
+        metrics.PROMPT_TOKENS.labels(call.llmID).inc(call.tokens['prompt'])
+        metrics.COMPLETION_TOKENS.labels(call.llmID).inc(call.tokens['completion'])
+
+def call_result(call: LLMCall, model_resp) -> dict:
+    text = response_text(model_resp)
+    count_usage(call, text)
+    return { 'model_resp': text, 'cached': call.cached, 'coalesced': call.coalesced, 'queue': call.admission, 'route': call.route, 'tokens': call.tokens }
+
+async def run_job(params: LLMParams) -> dict:
+    # Same as /llm/ for libs.jobs and libs.functions, except that failures raise
+    call = await prepare_llm(params)
+    return call_result(call, await dispatch.ainvoke(call))
+
+jobs.configure(args.jobConcurrency, run_job)
+functions.configure(args.batchParallelism, run_job)
+
+async def stream_events(call: LLMCall, on_complete=None):
+    # SSE events: 'token' for every piece of text as the provider emits it, 'error' if the
+    #   generation fails midway and always a final 'usage' with the timings of the stream.
+    #   on_complete(text) is awaited only when the whole response came through
+    start = time.perf_counter()
+    first_token = None
+    chunks = 0
+    texts = []
+    try:
+        async for chunk in dispatch.astream(call):
+            text = response_text(chunk)
+            if len(text) == 0:
+                continue
+            if first_token is None:
+                first_token = time.perf_counter()
+            chunks += 1
+            texts.append(text)
+            yield {'event': 'token', 'data': json.dumps({'text': text})}
+        if on_complete is not None:
+            await on_complete("".join(texts))
+    except Exception as e:
+        yield {'event': 'error', 'data': json.dumps({'msg': str(e)})}
+
+    end = time.perf_counter()
+    count_usage(call, "".join(texts))
+    usage_event = {
+        'chunks': chunks,
+        'chars': sum(len(text) for text in texts),
+        'ttft_ms': round((first_token - start)*1000, 1) if first_token is not None else None,
+        'total_ms': round((end - start)*1000, 1),
+        'cached': call.cached,
+        'queue': call.admission,
+        'route': call.route,
+        'tokens': call.tokens
+    }
+    yield {'event': 'usage', 'data': json.dumps(usage_event)}
+
+async def save_exchange(chat: ChatMessage, username: str, text: str):
+    # The response is already generated and billed, failing to keep it in the session must not lose it
+    try:
+        await sessions.record_exchange(chat, username, text)
+    except Exception as excp:
+        print(f"Saving the exchange of session [{chat.session_id}] failed [{excp}]")
 
-    local_prompt = PromptTemplate(
-            template=local_template,
-            input_variables=['ctxt', 'code', 'user'])
-
-    local_chain = local_prompt | local_llm
-    resp = local_chain.invoke({'ctxt':params.context, 'code':params.code_snippet, 'user':params.user_prompt})
+@app.post("/chat/")
+async def chat_llm(chat: ChatMessage,
+                   current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    scheduler.classify(Priority.INTERACTIVE, current_user.username)
+    call = await prepare_chat(await sessions.load_session(chat, current_user.username))
+    try:
+        model_resp = await dispatch.ainvoke(call)
+        result = call_result(call, model_resp)
+    except HTTPException:
+        raise
+    except openai.BadRequestError as excp:
+        return { 'model_resp': str(excp) }
+    except Exception as e:
+        return { 'model_resp': str(e) }
+    await save_exchange(chat, current_user.username, result['model_resp'])
+    return result
+
+@app.post("/chat/stream")
+async def stream_chat_llm(chat: ChatMessage,
+                          current_user: Annotated[User, Depends(get_current_active_user)]):
+    scheduler.classify(Priority.INTERACTIVE, current_user.username)
+    call = await prepare_chat(await sessions.load_session(chat, current_user.username))
+
+    async def record(text: str):
+        await save_exchange(chat, current_user.username, text)
+
+    return EventSourceResponse(stream_events(call, record))
 
-    return { 'model_resp': resp }
+@app.post("/llm/")
+async def call_llm(params: LLMParams,
+                   current_user: Annotated[User, Depends(get_current_active_user)]) -> dict:
+    scheduler.classify(Priority.SINGLE, current_user.username)
+    call = await prepare_llm(params)
+    try:
+        model_resp = await dispatch.ainvoke(call)
+        return call_result(call, model_resp)
+    except HTTPException:
+        raise
+    except openai.BadRequestError as excp:
+        return { 'model_resp': str(excp) }
+    except Exception as e:
+        return { 'model_resp': str(e) }
+
+@app.post("/llm/stream")
+async def stream_llm(params: LLMParams,
+                     current_user: Annotated[User, Depends(get_current_active_user)]):
+    scheduler.classify(Priority.SINGLE, current_user.username)
+    return EventSourceResponse(stream_events(await prepare_llm(params)))
+
+async def run_batch_item(index: int, params: LLMParams, slots: asyncio.Semaphore) -> dict:
+    # Errors stay with their item, one bad request must not fail the rest of the batch
+    async with slots:
+        try:
+            call = await prepare_llm(params)
+            model_resp = await dispatch.ainvoke(call)
+            return { 'index': index, **call_result(call, model_resp) }
+        except HTTPException as excp:
+            msg = excp.detail.get('msg') if isinstance(excp.detail, dict) else str(excp.detail)
+            return { 'index': index, 'error': msg, 'status': excp.status_code }
+        except Exception as e:
+            return { 'index': index, 'error': str(e) }
+
+async def stream_batch(tasks: List[asyncio.Task]):
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield json.dumps(await next_done) + "\n"
+    finally:
+        # Client went away, nobody is going to read the rest
+        for task in tasks:
+            task.cancel()
+
+@app.post("/llm/batch")
+async def call_llm_batch(batch: LLMBatch,
+                         current_user: Annotated[User, Depends(get_current_active_user)]):
+    scheduler.classify(Priority.BATCH, current_user.username)
+    if batch.items is not None:
+        items = batch.items
+    elif batch.template is not None and batch.code_snippets is not None:
+        items = [batch.template.model_copy(update={'code_snippet': code}) for code in batch.code_snippets]
+    else:
+        raise HTTPException(status_code=400, detail={'msg': "Either items or template with code_snippets required"})
+
+    parallelism = args.batchParallelism
+    if batch.parallelism is not None and batch.parallelism > 0:
+        parallelism = min(batch.parallelism, args.batchParallelism)
+    slots = asyncio.Semaphore(parallelism)
+
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(run_batch_item(index, params, slots)) for index, params in enumerate(items)]
+    if batch.stream:
+        return StreamingResponse(stream_batch(tasks), media_type="application/x-ndjson")
+
+    results = await asyncio.gather(*tasks)
+    return { 'results': results, 'total_ms': round((time.perf_counter() - start)*1000, 1) }
+
+background_tasks = set()    # Strong references, the loop only keeps weak ones
+
+def start_sync(name: str, sync):
+    # Index sync in the thread pool, nobody awaits it so its failure is printed here
+    def done(task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Startup sync of the {name} index failed [{task.exception()}]")
+        elif not task.cancelled() and task.result() is not None:
+            print(f"Startup sync of the {name} index {task.result()}")
+
+    task = asyncio.create_task(run_in_threadpool(sync))
+    task.add_done_callback(done)
+    background_tasks.add(task)
+
+@app.on_event("startup")
+async def warmup_providers():
+    # Build the long lived provider clients and open their connections before the first request
+    background_tasks.add(asyncio.create_task(metrics.monitor_event_loop()))
+    background_tasks.update(jobs.start())
+    background_tasks.add(asyncio.create_task(usage.flusher()))
+    background_tasks.add(asyncio.create_task(llm_cache.flusher()))
+    background_tasks.update(dirtree.start([files.INPUT_CODE_DIR, files.OUTPUT_CODE_DIR]))
+    start_sync("retrieval", retrieval.startup_sync)
+    start_sync("symbols", symbols.startup_sync)
+    with startup.phase("provider warmup"):
+        await run_in_threadpool(registry.warmup)
+        await registry.awarmup()
+    if args.startupReport:
+        print(startup.report())
+
+@app.on_event("shutdown")
+async def close_providers():
+    await jobs.stop()
+    await dirtree.stop()
+    await usage.flush()
+    await llm_cache.flush()
+    registry.close()
 
 
 def checkEnviron():
+    from libs.llms import EnvVars
+
     res = True
     for model in params.MODELS.values():
         res &= EnvVars.checkEnviron(model["provider"])
@@ -322,8 +502,40 @@ def checkEnviron():
     if not res:
         exit(1)
 
-if __name__ == "__main__":
+def run_preloaded():
+    # uvicorn spawns its Workers, each importing the app again. gunicorn forks them from this
+    #   process instead, after everything above has been loaded once
+    from gunicorn.app.base import BaseApplication
+
+    class PreloadedServer(BaseApplication):
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+    options = {
+        'bind': f"0.0.0.0:{args.port}",
+        'workers': args.workers,
+        'worker_class': 'uvicorn.workers.UvicornWorker',
+        'preload_app': True,
+        'child_exit': lambda server, worker: metrics.mark_process_dead(worker.pid)
+    }
     if args.useHTTPS:
+        options['certfile'] = './cert.pem'
+        options['keyfile'] = './key.pem'
+    PreloadedServer(app, options).run()
+
+if __name__ == "__main__":
+    if args.preload:
+        run_preloaded()
+    elif args.useHTTPS:
         ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
         ssl_context.load_cert_chain('./cert.pem', keyfile='./key.pem')
         uvicorn.run("serve:app", host="0.0.0.0", port=args.port, ssl_keyfile="./key.pem", ssl_certfile="./cert.pem", workers=args.workers)
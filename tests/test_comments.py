@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+import pytest
+
+from libs import comments
+
+def insert_and_strip(filepath, source, file_doc, docs):
+    filepath.write_text(source)
+    syntax = comments.syntax_for(filepath)
+    insertions, stats = comments.plan(filepath, syntax, 'insert', file_doc, docs, 80)
+    inserted = "".join(comments.transform(comments.file_lines(filepath), syntax, insertions, stats))
+    filepath.write_text(inserted)
+    insertions, stats = comments.plan(filepath, syntax, 'strip', None, None, 80)
+    stripped = "".join(comments.transform(comments.file_lines(filepath), syntax, insertions, stats))
+    return inserted, stripped
+
+@pytest.mark.parametrize("source", ["#!/usr/bin/env python", "#!/usr/bin/env python\n"])
+def test_block_after_last_line(tmp_path, source):
+    inserted, stripped = insert_and_strip(tmp_path / "run.py", source, "Runs it", {})
+    assert inserted == "#!/usr/bin/env python\n# codedoc: run.py\n# Runs it\n# /codedoc\n"
+    assert stripped == "#!/usr/bin/env python\n"
+
+@pytest.mark.parametrize("source", ["def f():\n    return 1\n", "def f():\n    return 1"])
+def test_roundtrip(tmp_path, source):
+    inserted, stripped = insert_and_strip(tmp_path / "mod.py", source, "The module", {'f': "Returns one"})
+    assert inserted == "# codedoc: mod.py\n# The module\n# /codedoc\n# codedoc: f\n# Returns one\n# /codedoc\n" + source
+    assert stripped == source
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+
+import sys
+import time
+import socket
+import asyncio
+import subprocess
+from pathlib import Path
+
+import httpx
+import pytest
+from langchain.schema import HumanMessage
+
+from libs import dispatch, failover, ratelimit
+from libs.params import MODELS
+from libs.providers import registry
+
+FAKE_LLM = Path(__file__).resolve().parent.parent / "fake_llm.py"
+DEPLOYMENT = 'gpt-35-turbo-16k'
+SLOW = 3.0              # Latency of the slow server, the hedged calls must not wait for it
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_fake_llm() -> tuple:
+    port = free_port()
+    process = subprocess.Popen([sys.executable, str(FAKE_LLM), "--port", str(port), "--latency", "0", "--jitter", "0"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    endpoint = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            httpx.get(endpoint + "/stats")
+            return process, endpoint
+        except httpx.TransportError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError(f"fake_llm.py did not start on port {port}")
+            time.sleep(0.1)
+
+class FakeLLM:
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.name = f"{endpoint}/{DEPLOYMENT}"      # As failover.Backend names it
+
+    def settings(self, **values):
+        httpx.post(self.endpoint + "/settings", json=values).raise_for_status()
+
+    def calls(self) -> int:
+        return httpx.get(self.endpoint + "/stats").json()['calls']
+
+@pytest.fixture(scope="module")
+def servers():
+    # One server that fails or is slow, depending on the test, in front of one that answers at once
+    started = [start_fake_llm(), start_fake_llm()]
+    yield [FakeLLM(endpoint) for process, endpoint in started]
+    for process, endpoint in started:
+        process.terminate()
+        process.wait()
+
+@pytest.fixture
+def model(servers, monkeypatch, request):
+    # A fresh model ID per test, its clients and circuit breakers start from scratch
+    flaky, healthy = servers
+    flaky.settings(latency=0, failRate=0)
+    healthy.settings(latency=0, failRate=0)
+    monkeypatch.setattr(ratelimit, "controllers", {})
+    monkeypatch.setattr(failover, "backends", {})
+    llmID = f"failover-{request.node.name}"
+    monkeypatch.setitem(MODELS, llmID, {
+        'enabled': True,
+        'id_for_prvdr': DEPLOYMENT,
+        'api_version': '2023-07-01-preview',
+        'endpoint': flaky.endpoint,
+        'name': 'Failover test',
+        'code': 'FoT',
+        'context_window': 16384,
+        'api-key': 'fake',
+        'provider': 'AzureChatOpenAI',
+        'backends': [{'endpoint': healthy.endpoint}],
+        'model_kwargs': {'max_new_tokens': 16, 'temperature': 1.0}
+    })
+    return llmID
+
+def make_call(llmID: str) -> dispatch.LLMCall:
+    # Sampled and uncached, every call goes to the provider
+    sampling = {'temperature': 1.0, 'max_tokens': 16}
+    return dispatch.LLMCall(llmID, MODELS[llmID], registry.bind_sampling(llmID, sampling), [HumanMessage(content="Hello")],
+                            sampling, use_cache=False)
+
+async def invoke(llmID: str) -> dict:
+    call = make_call(llmID)
+    await dispatch.ainvoke(call)
+    return call.route
+
+def run(test):
+    # The whole test in one event loop, the clients of the model keep their connections in it
+    async def main():
+        dispatch.configure(4)       # The scheduler of the previous test belongs to its event loop
+        return await test()
+    return asyncio.run(main())
+
+def test_breaker_opens_and_recovers(servers, model, monkeypatch):
+    flaky, healthy = servers
+    monkeypatch.setattr(failover, "OPEN_SECONDS", 0.5)
+    flaky.settings(failRate=1)
+    primary = failover.get_backends(model)[0]
+
+    async def test():
+        before = flaky.calls()
+        for _ in range(failover.FAILURE_THRESHOLD):
+            assert await invoke(model) == {'backend': healthy.name, 'failovers': 1, 'hedged': False}
+        assert primary.breaker.state == 'open'
+
+        # Open, the failing server is not even tried
+        assert await invoke(model) == {'backend': healthy.name, 'failovers': 0, 'hedged': False}
+        assert flaky.calls() - before == failover.FAILURE_THRESHOLD
+
+        # The trial call after OPEN_SECONDS closes the circuit once the server answers again
+        flaky.settings(failRate=0)
+        await asyncio.sleep(0.6)
+        assert await invoke(model) == {'backend': flaky.name, 'failovers': 0, 'hedged': False}
+        assert primary.breaker.state == 'closed'
+
+    run(test)
+
+def test_failed_trial_reopens(servers, model, monkeypatch):
+    flaky, healthy = servers
+    monkeypatch.setattr(failover, "OPEN_SECONDS", 0.5)
+    flaky.settings(failRate=1)
+    primary = failover.get_backends(model)[0]
+
+    async def test():
+        for _ in range(failover.FAILURE_THRESHOLD):
+            await invoke(model)
+        await asyncio.sleep(0.6)
+        assert primary.breaker.available()
+        assert await invoke(model) == {'backend': healthy.name, 'failovers': 1, 'hedged': False}
+        assert primary.breaker.state == 'open' and not primary.breaker.available()
+
+    run(test)
+
+def test_stream_fails_over_before_the_first_chunk(servers, model):
+    flaky, healthy = servers
+    flaky.settings(failRate=1)
+
+    async def test():
+        call = make_call(model)
+        text = "".join([dispatch.response_text(chunk) async for chunk in dispatch.astream(call)])
+        assert text.startswith("Fake answer")
+        assert call.route == {'backend': healthy.name, 'failovers': 1, 'hedged': False}
+
+    run(test)
+
+@pytest.mark.parametrize("slow_server", [0, 1])
+def test_hedge_winner_cancels_the_other_call(servers, model, monkeypatch, slow_server):
+    # The primary (server 0) is slower than the hedge delay, then either it or the hedge answers first
+    monkeypatch.setattr(failover, "DEFAULT_HEDGE_DELAY", 0.3)
+    monkeypatch.setitem(MODELS[model], 'hedge', True)
+    servers[0].settings(latency=0.6 if slow_server == 1 else SLOW)
+    servers[1].settings(latency=SLOW if slow_server == 1 else 0)
+    winner = servers[1 - slow_server]
+    loser = failover.get_backends(model)[slow_server]
+
+    async def test():
+        start = time.perf_counter()
+        assert await invoke(model) == {'backend': winner.name, 'failovers': 0, 'hedged': True}
+        assert time.perf_counter() - start < SLOW
+
+        # Cancelled, the losing call is gone without failing its backend or adding a latency sample
+        await asyncio.sleep(0.1)
+        assert [task for task in asyncio.all_tasks() if task is not asyncio.current_task()] == []
+        assert loser.breaker.failures == 0 and len(loser.latencies) == 0
+
+    run(test)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+from libs.functions import extract_functions
+
+SOURCE = """class Cart extends Store {
+  constructor() { this.items = [] }
+  total() { return this.items.length }
+}
+function helper() { return 0 }
+"""
+
+def hashes(source: str) -> dict:
+    extracted = extract_functions(source)
+    return {(unit['kind'], unit['name']): unit['hash'] for unit in extracted['functions'] + extracted['classes']}
+
+def test_class_change_changes_its_methods():
+    before = hashes(SOURCE)
+    after = hashes(SOURCE.replace("extends Store", "extends Base"))
+    assert before[('class', 'Cart')] != after[('class', 'Cart')]
+    assert before[('method', 'total')] != after[('method', 'total')]
+    assert before[('function', 'helper')] == after[('function', 'helper')]
+
+def test_method_change_leaves_the_class():
+    before = hashes(SOURCE)
+    after = hashes(SOURCE.replace("this.items.length", "this.items.length + 1"))
+    assert before[('class', 'Cart')] == after[('class', 'Cart')]
+    assert before[('method', 'constructor')] == after[('method', 'constructor')]
+    assert before[('method', 'total')] != after[('method', 'total')]
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+##################################################################################################
+#
+# Copyright 2024, Shalin Garg
+#
+# This file is part of CodeDoc Gen AI Tool.
+#
+# CodeDoc is free software: you can redistribute it and/or modify it under the terms of the 
+# GNU General Public License as published by the Free Software Foundation, either version 3 
+# of the License, or (at your option) any later version.
+#
+# CodeDoc is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with CodeDoc. 
+# If not, see <https://www.gnu.org/licenses/>.
+#
+##################################################################################################
+
+
+from libs.user_db import JobsDatabase, JobStatus
+
+STALE_BEFORE = 0        # No job is stale
+MAX_ATTEMPTS = 3
+
+def test_retried_job_is_not_claimed_while_it_runs(tmp_path):
+    jobs = JobsDatabase(str(tmp_path / "jobs.db"))
+    job_id = jobs.add_job(1, "{}")
+    first = jobs.claim_job("worker", STALE_BEFORE, MAX_ATTEMPTS)
+
+    # Cancelled and retried before the worker noticed, its first run is still going
+    assert jobs.cancel_job(job_id, 1) == 1
+    assert jobs.retry_job(job_id, 1) == 1
+    assert jobs.claim_job("worker", STALE_BEFORE, MAX_ATTEMPTS, [job_id]) is None
+
+    second = jobs.claim_job("worker", STALE_BEFORE, MAX_ATTEMPTS)
+    assert second['id'] == job_id and second['claim'] != first['claim']
+
+def test_only_the_current_claim_beats_and_finishes(tmp_path):
+    jobs = JobsDatabase(str(tmp_path / "jobs.db"))
+    job_id = jobs.add_job(1, "{}")
+    first = jobs.claim_job("worker", STALE_BEFORE, MAX_ATTEMPTS)
+    jobs.cancel_job(job_id, 1)
+    jobs.retry_job(job_id, 1)
+    second = jobs.claim_job("worker", STALE_BEFORE, MAX_ATTEMPTS)
+
+    assert jobs.heartbeat([first['claim'], second['claim']]) == [first['claim']]
+    assert jobs.finish_job(job_id, first['claim'], JobStatus.DONE, '"stale"') == 0
+    assert jobs.finish_job(job_id, second['claim'], JobStatus.DONE, '"current"') == 1
+    assert jobs.get_job(job_id)['result'] == '"current"'